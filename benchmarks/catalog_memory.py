@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Measures the peak memory use and time taken to load a large catalog
+
+Each measurement is taken in a fresh interpreter (so that memory freed by one run can't hide the peak of the next),
+loading a synthetic catalog from stub_server.py that has been primed into a throwaway catalog cache. Two ways of
+loading the firmware list are compared:
+
+    streamed  parsed as it is read from the cache, with long text left on disk until needed (what BrewFlasher does)
+    parsed    read and parsed all at once, then converted to Firmware (as when data is passed to the loaders)
+
+    python benchmarks/catalog_memory.py [--firmware 10000] [--repeat 3] [--json]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+from statistics import median
+from time import perf_counter
+
+from stub_server import StubServer, add_catalog_arguments, catalog_options_from_arguments
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = ["streamed", "parsed"]
+# Long enough that the primed cache is always used as-is
+CATALOG_MAX_AGE = 24 * 60 * 60
+
+
+def peak_rss() -> int:
+    """Returns the peak resident set size of this process so far, in bytes"""
+    try:
+        # On Linux, ru_maxrss carries over the parent's peak (here, the stub server's) into a child process
+        with open("/proc/self/status", "r") as f:
+            return next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmHWM:"))
+    except (OSError, StopIteration):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024  # Linux reports this in KB
+
+
+def load_catalog(mode: str) -> dict:
+    """Loads the catalog using the given mode. Run in a fresh interpreter (see measure)."""
+    sys.path.insert(0, os.path.join(REPO_ROOT, "src"))
+    from brewflasher_cli.brewflasher_com_integration import FirmwareList
+
+    firmware_list = FirmwareList()
+    before = peak_rss()
+    start = perf_counter()
+    if mode == "streamed":
+        loaded = firmware_list.load_from_website(load_esptool_only=False, max_catalog_age=CATALOG_MAX_AGE)
+    else:
+        catalog = firmware_list.fetch_catalog(CATALOG_MAX_AGE)
+        loaded = firmware_list.load_projects_from_website(data=catalog['projects']) and \
+            firmware_list.load_families_from_website(load_esptool_only=False, data=catalog['families']) and \
+            firmware_list.load_firmware_from_website(data=catalog['firmware'])
+        del catalog
+        firmware_list.cleanse_projects()
+        firmware_list.build_indexes()
+    seconds = perf_counter() - start
+    if not loaded:
+        raise RuntimeError("Unable to load the catalog")
+    return {'seconds': seconds, 'peak_rss': peak_rss() - before, 'firmware': len(firmware_list.Firmwares)}
+
+
+def measure(mode: str, environment: dict) -> dict:
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", mode], env=environment,
+                            stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    return json.loads(result.stdout)
+
+
+def run(options: argparse.Namespace) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="brewflasher-benchmark-") as cache_root, \
+            StubServer(catalog_options_from_arguments(options)) as server:
+        environment = dict(os.environ, BREWFLASHER_CACHE_DIR=cache_root, BREWFLASHER_COM_URL=server.url)
+        measure("streamed", environment)  # Prime the catalog cache
+        for mode in MODES:
+            runs = [measure(mode, environment) for _ in range(options.repeat)]
+            results[mode] = {
+                'seconds': median(r['seconds'] for r in runs),
+                'peak_rss': median(r['peak_rss'] for r in runs),
+                'firmware': runs[0]['firmware'],
+            }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_catalog_arguments(parser)
+    parser.set_defaults(firmware=10000, binary_size=1024)  # The binaries are never downloaded
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs per measurement (the median is reported)")
+    parser.add_argument("--json", action="store_true", help="Output the results as JSON")
+    parser.add_argument("--child", choices=MODES, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.child:
+        print(json.dumps(load_catalog(options.child)))
+        return
+
+    results = run(options)
+    if options.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print("Catalog of {} firmware (median of {} runs)".format(options.firmware, options.repeat))
+    for mode, result in results.items():
+        print("  {:<10} {:>8.1f} ms  {:>8.1f} MB peak RSS increase".format(mode, result['seconds'] * 1000,
+                                                                          result['peak_rss'] / (1024 * 1024)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""A simulated ESP ROM bootloader on a pseudo-terminal, for exercising incremental flashing without a device
+
+Answers the esptool commands that incremental flashing relies on - syncing, chip detection, loading the flasher stub,
+and the flash MD5 command - holding the device's flash in memory. Responses are delayed to match the line speed, so
+timings are close to a real device. By default, a device is simulated with a previous build of a firmware already on
+it, and the new build (in which only the app image differs) is compared against it with plan_incremental_flash:
+
+    python benchmarks/esp_rom_simulator.py --chip esp32 --firmware-size 1500000 --filesystem-size 1500000
+
+With --serve, the simulated device is left running for other tools (e.g. esptool, or brewflasher) to be pointed at:
+
+    python benchmarks/esp_rom_simulator.py --chip esp8266 --serve
+"""
+import argparse
+import hashlib
+import os
+import random
+import select
+import struct
+import sys
+import tempfile
+import threading
+import tty
+from time import perf_counter, sleep
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Use the working tree, rather than whatever copy of brewflasher_cli happens to be installed
+sys.path.insert(0, os.path.join(REPO_ROOT, "src"))
+
+from brewflasher_cli.incremental import COMPARE_BAUD, plan_incremental_flash  # noqa: E402
+
+# The value each chip's ROM returns when esptool reads CHIP_DETECT_MAGIC_REG_ADDR, and the number of status bytes its
+# ROM appends to every response (the flasher stub always sends 2)
+CHIPS = {
+    "esp8266": (0xfff0c101, 2),
+    "esp32": (0x00f01d83, 4),
+}
+CHIP_DETECT_MAGIC_REG_ADDR = 0x40001000
+FLASH_SIZE = 4 * 1024 * 1024
+
+# (address, name) of each region in the simulated firmware, in the order esptool would be given them
+LAYOUTS = {
+    "esp8266": [("0x0", "firmware"), ("0x300000", "filesystem")],
+    "esp32": [("0x1000", "bootloader"), ("0x8000", "partitions"), ("0x10000", "firmware"),
+              ("0x290000", "filesystem")],
+}
+REGION_SIZES = {"bootloader": 26000, "partitions": 3072}
+
+# esptool command opcodes
+SYNC = 0x08
+READ_REG = 0x0a
+MEM_BEGIN = 0x05
+MEM_END = 0x06
+MEM_DATA = 0x07
+SPI_FLASH_MD5 = 0x13
+
+
+class _Stopped(Exception):
+    pass
+
+
+class SimulatedRomBootloader:
+    """Simulates chip's ROM bootloader (and, once it has been loaded, esptool's flasher stub) on a pseudo-terminal
+    from a background thread. Use as a context manager, then open .port as if it were the device's serial port."""
+
+    def __init__(self, chip: str, line_speed: int = COMPARE_BAUD):
+        self.chip = chip
+        self.magic_value, self.rom_status_length = CHIPS[chip]
+        self.flash = bytearray(b"\xff" * FLASH_SIZE)
+        self.stub_running = False
+        # Bytes per second that requests & responses are limited to (10 bits a byte, as with 8N1). 0 means no limit.
+        self.line_speed = line_speed / 10
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)  # Until esptool opens it, anything received would otherwise be echoed back
+        self.port = os.ttyname(self._slave)
+        self._buffer = bytearray()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="esp-rom-simulator", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stopping.set()
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _read(self, length: int) -> bytes:
+        while len(self._buffer) < length:
+            if self._stopping.is_set():
+                raise _Stopped
+            if select.select([self._master], [], [], 0.1)[0]:
+                self._buffer.extend(os.read(self._master, 4096))
+        data = bytes(self._buffer[:length])
+        del self._buffer[:length]
+        return data
+
+    def _read_packet(self) -> bytes:
+        # Requests are SLIP framed: delimited by 0xC0, with 0xC0 and 0xDB escaped as 0xDB 0xDC and 0xDB 0xDD
+        while self._read(1) != b"\xc0":
+            pass
+        packet = bytearray()
+        while True:
+            byte = self._read(1)
+            if byte == b"\xc0":
+                if len(packet) > 0:
+                    return bytes(packet)
+            elif byte == b"\xdb":
+                packet += b"\xc0" if self._read(1) == b"\xdc" else b"\xdb"
+            else:
+                packet += byte
+
+    def _write(self, request_length: int, packet: bytes):
+        framed = b"\xc0" + packet.replace(b"\xdb", b"\xdb\xdd").replace(b"\xc0", b"\xdb\xdc") + b"\xc0"
+        if self.line_speed > 0:
+            sleep((request_length + len(framed)) / self.line_speed)
+        os.write(self._master, framed)
+
+    def _respond(self, request_length: int, op: int, value: int = 0, data: bytes = b"", success: bool = True):
+        status_length = 2 if self.stub_running else self.rom_status_length
+        # A failed command's status is 0x01 followed by the reason - 0x05 being "invalid message" (unsupported)
+        status = (b"\x00\x00" if success else b"\x01\x05") + b"\x00" * (status_length - 2)
+        body = data + status
+        self._write(request_length, struct.pack("<BBHI", 0x01, op, len(body), value) + body)
+
+    def _run(self):
+        try:
+            while True:
+                self._handle_command()
+        except _Stopped:
+            pass
+
+    def _handle_command(self):
+        packet = self._read_packet()
+        if len(packet) < 8 or packet[0] != 0x00:
+            return  # Not a request
+        _, op, _, _ = struct.unpack("<BBHI", packet[:8])
+        data = packet[8:]
+
+        if op == SYNC:
+            # The ROM answers a sync eight times, with a non-zero value. The flasher stub's value is 0.
+            for _ in range(8):
+                self._respond(len(packet), op, 0 if self.stub_running else 0x20120707)
+        elif op == READ_REG:
+            address = struct.unpack("<I", data[:4])[0]
+            self._respond(len(packet), op, self.magic_value if address == CHIP_DETECT_MAGIC_REG_ADDR else 0)
+        elif op in (MEM_BEGIN, MEM_DATA):
+            self._respond(len(packet), op)  # The stub's code is accepted, but not kept
+        elif op == MEM_END:
+            self._respond(len(packet), op)
+            self.stub_running = True
+            self._write(0, b"OHAI")  # The stub announces itself once it starts
+        elif op == SPI_FLASH_MD5 and self.stub_running:
+            address, size = struct.unpack("<II", data[:8])
+            if address + size > len(self.flash):
+                self._respond(len(packet), op, success=False)
+                return
+            # The stub sends the raw digest, where the ROM sends it as hex
+            self._respond(len(packet), op, data=hashlib.md5(self.flash[address:address + size]).digest())
+        else:
+            self._respond(len(packet), op, success=False)
+
+    def write_image(self, address: str, path: str):
+        """Puts the image at path into the simulated flash, as esptool would write it"""
+        with open(path, "rb") as f:
+            image = f.read()
+        image += b"\xff" * (-len(image) % 4)
+        start = int(address, 0)
+        self.flash[start:start + len(image)] = image
+
+
+def compare_simulated_device(chip: str, firmware_size: int, filesystem_size: int, line_speed: int = COMPARE_BAUD):
+    """Compares a new build of a firmware against a simulated device running the previous build (in which only the app
+    image differs), returning the IncrementalPlan. Raises RuntimeError if the wrong regions are skipped."""
+    sizes = dict(REGION_SIZES, firmware=firmware_size, filesystem=filesystem_size)
+    rng = random.Random(firmware_size ^ filesystem_size)
+    with tempfile.TemporaryDirectory(prefix="brewflasher-esp-") as directory:
+        with SimulatedRomBootloader(chip, line_speed) as simulator:
+            regions = []
+            for address, name in LAYOUTS[chip]:
+                path = os.path.join(directory, name + ".bin")
+                with open(path, "wb") as f:
+                    f.write(bytes(rng.getrandbits(8) for _ in range(sizes[name])))
+                simulator.write_image(address, path)
+                regions.append((address, path))
+
+            # Rebuild the app image, which leaves the device with an older copy of it than we're about to flash
+            firmware_path = os.path.join(directory, "firmware.bin")
+            with open(firmware_path, "r+b") as f:
+                f.write(b"\x00" * 16)
+
+            plan = plan_incremental_flash(regions, simulator.port, chip)
+
+    if plan.kept_regions != [(address, path) for address, path in regions if path == firmware_path]:
+        raise RuntimeError("Expected only the app image to be written, but {} would be".format(
+            ", ".join(address for address, _ in plan.kept_regions) or "nothing"))
+    return plan
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chip", choices=sorted(CHIPS), default="esp32", help="The chip to simulate")
+    parser.add_argument("--firmware-size", type=int, default=1000000, help="Size (in bytes) of the app image")
+    parser.add_argument("--filesystem-size", type=int, default=1000000,
+                        help="Size (in bytes) of the filesystem (SPIFFS) image")
+    parser.add_argument("--line-speed", type=int, default=COMPARE_BAUD,
+                        help="Baud rate to simulate (0 for no limit)")
+    parser.add_argument("--flash-baud", type=int, default=460800,
+                        help="Baud rate a full flash would be written at, for estimating the time saved")
+    parser.add_argument("--serve", action="store_true", help="Run a simulated device until interrupted")
+    options = parser.parse_args()
+
+    if options.serve:
+        with SimulatedRomBootloader(options.chip, options.line_speed) as simulator:
+            print("Simulating an {} ROM bootloader on {} - press Ctrl+C to stop".format(options.chip, simulator.port))
+            try:
+                while True:
+                    sleep(1)
+            except KeyboardInterrupt:
+                pass
+        return
+
+    plan = compare_simulated_device(options.chip, options.firmware_size, options.filesystem_size, options.line_speed)
+    print("")
+    print(plan.describe(options.flash_baud))
+    print("Compared {} region{} in {:.2f}s".format(
+        len(plan.kept_regions) + len(plan.skipped_regions),
+        "s" if len(plan.kept_regions) + len(plan.skipped_regions) != 1 else "", plan.compare_seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""Simulated USB plug/unplug sequences, for checking which boards production line mode would flash
+
+Each scenario feeds a timeline of serial ports appearing & disappearing to a PortWatcher (with its timings scaled
+down so the whole run takes a few seconds), flashing whatever it reports, and checks that exactly the right boards
+were flashed:
+
+    python benchmarks/hotplug_simulator.py
+"""
+import argparse
+import os
+import sys
+from time import monotonic, sleep
+from types import SimpleNamespace
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Use the working tree, rather than whatever copy of brewflasher_cli happens to be installed
+sys.path.insert(0, os.path.join(REPO_ROOT, "src"))
+
+from brewflasher_cli import hotplug  # noqa: E402
+
+# PortWatcher's timings, scaled down (by default, SETTLE_TIME is 0.5s, REMOVAL_TIME 2s and FLASH_COOLDOWN 10s)
+SETTLE_TIME = 0.05
+REMOVAL_TIME = 0.2
+FLASH_COOLDOWN = 1.0
+POLL_INTERVAL = 0.01
+# How long each simulated flash takes
+FLASH_TIME = 0.3
+
+
+def board(device: str, pid: int = 0x7523, vid: int = 0x1a86, serial_number: str = None):
+    # A stand-in for a ListPortInfo. Defaults to a CH340, which - like many cheap USB to UART bridges - has no serial
+    # number.
+    return SimpleNamespace(device=device, vid=vid, pid=pid, serial_number=serial_number, description=device)
+
+
+LEONARDO = board("/dev/ttyACM0", pid=0x8036, vid=0x2341, serial_number="HIDPC")
+LEONARDO_BOOTLOADER = board("/dev/ttyACM0", pid=0x0036, vid=0x2341, serial_number="HIDPC")
+CH340 = board("/dev/ttyUSB0")
+ANOTHER_CH340 = board("/dev/ttyUSB0")
+
+# name -> (timeline, boards that should be flashed). Each timeline entry is (seconds from the start, the ports that are
+# connected from then on). Boards that are flashed take FLASH_TIME to finish.
+SCENARIOS = {
+    "a new board is flashed": (
+        [(0.0, []), (0.1, [CH340])],
+        [CH340]),
+    "a board resetting after it is flashed isn't flashed again": (
+        [(0.0, []), (0.1, [CH340]), (0.5, []), (0.6, [CH340])],
+        [CH340]),
+    "a board coming back from its bootloader after a 1200bps touch isn't flashed again": (
+        [(0.0, []), (0.1, [LEONARDO]), (0.2, [LEONARDO_BOOTLOADER]), (0.7, []), (1.0, [LEONARDO])],
+        [LEONARDO]),
+    "a new board plugged into the same port (without a serial number) is flashed": (
+        [(0.0, []), (0.1, [CH340]), (0.6, []), (1.0, [ANOTHER_CH340])],
+        [CH340, ANOTHER_CH340]),
+}
+
+
+class SimulatedPorts:
+    def __init__(self, timeline: list):
+        self.timeline = timeline
+        self.started_at = monotonic()
+
+    def comports(self) -> list:
+        elapsed = monotonic() - self.started_at
+        ports = []
+        for at, connected in self.timeline:
+            if elapsed >= at:
+                ports = connected
+        return list(ports)
+
+
+def run_scenario(timeline: list, duration: float) -> list:
+    """Returns the boards that production line mode would have flashed, in the order they were flashed"""
+    ports = SimulatedPorts(timeline)
+    hotplug.comports = ports.comports
+    watcher = hotplug.PortWatcher(include_existing=True, settle_time=SETTLE_TIME, removal_time=REMOVAL_TIME)
+    flashed = []
+    in_flight = {}  # Board -> when its flash finishes
+
+    while monotonic() - ports.started_at < duration:
+        for port in watcher.poll():
+            watcher.mark_busy(port)
+            in_flight[id(port)] = (port, monotonic() + FLASH_TIME)
+            flashed.append(port)
+        for key, (port, finishes_at) in list(in_flight.items()):
+            if monotonic() >= finishes_at:
+                watcher.mark_done(port, FLASH_COOLDOWN)
+                del in_flight[key]
+        sleep(POLL_INTERVAL)
+    return flashed
+
+
+def main():
+    argparse.ArgumentParser(description=__doc__.splitlines()[0]).parse_args()
+    failures = 0
+    for name, (timeline, expected) in SCENARIOS.items():
+        flashed = run_scenario(timeline, duration=timeline[-1][0] + FLASH_COOLDOWN + REMOVAL_TIME)
+        passed = [id(port) for port in flashed] == [id(port) for port in expected]
+        failures += 0 if passed else 1
+        print("{}  {}{}".format("ok    " if passed else "FAILED", name, "" if passed else " (flashed {})".format(
+            ", ".join("{:04x}:{:04x}".format(port.vid, port.pid) for port in flashed) or "nothing")))
+    if failures > 0:
+        raise RuntimeError("{} of {} scenarios failed".format(failures, len(SCENARIOS)))
+
+
+if __name__ == "__main__":
+    main()
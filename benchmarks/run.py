@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""Benchmarks the catalog, lookup, download, hashing and command construction paths against a local stub server
+
+Everything runs offline against stub_server.py, using a throwaway cache directory, so results are comparable across
+commits (and machines, to a lesser degree). Save the results from one commit and compare another against them:
+
+    python benchmarks/run.py --output before.json
+    git checkout other-branch
+    python benchmarks/run.py --compare before.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from dataclasses import asdict, dataclass, field
+from statistics import mean, median
+from time import perf_counter
+from typing import Callable, Dict, List
+
+from stub_server import StubServer, add_catalog_arguments, catalog_options_from_arguments
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Benchmark the working tree, rather than whatever copy of brewflasher_cli happens to be installed
+sys.path.insert(0, os.path.join(REPO_ROOT, "src"))
+
+from brewflasher_cli import brewflasher_com_integration, fhash  # noqa: E402
+from brewflasher_cli.binary_cache import configure_binary_cache  # noqa: E402
+from brewflasher_cli.brewflasher_com_integration import FirmwareList  # noqa: E402
+from brewflasher_cli.flashing import build_flash_command, build_flash_job  # noqa: E402
+
+# Lookups are timed in batches of up to this many queries
+LOOKUP_BATCH_SIZE = 1000
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    runs: List[float] = field(default_factory=list)
+    # Number of operations performed per run (e.g. lookups per batch), so per-operation costs can be worked out
+    operations: int = 1
+
+    def to_dict(self) -> dict:
+        return {'median': median(self.runs), 'min': min(self.runs), 'mean': mean(self.runs), 'runs': len(self.runs),
+                'operations': self.operations}
+
+
+def measure(name: str, function: Callable, repeat: int, setup: Callable = None, operations: int = 1) -> BenchmarkResult:
+    """Times function() repeat times. setup() (if given) is run - untimed - before each run, and its result is passed
+    to function."""
+    result = BenchmarkResult(name=name, operations=operations)
+    for _ in range(repeat):
+        argument = setup() if setup is not None else None
+        # Anything the code under test prints (e.g. download progress) would otherwise swamp the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = perf_counter()
+            function(argument) if setup is not None else function()
+            result.runs.append(perf_counter() - start)
+    return result
+
+
+def git_revision() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_ROOT,
+                                stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': "unknown", 'dirty': None}
+    return {'commit': commit, 'dirty': len(status) > 0}
+
+
+def load_firmware_list(max_catalog_age: float = None) -> FirmwareList:
+    firmware_list = FirmwareList()
+    if not firmware_list.load_from_website(load_esptool_only=False, max_catalog_age=max_catalog_age):
+        raise RuntimeError("Unable to load the catalog from the stub server")
+    return firmware_list
+
+
+def unloaded_firmware_list(catalog: Dict[str, list]) -> Callable:
+    # Returns a setup function that builds (but doesn't cleanse) a FirmwareList from an already fetched catalog
+    def setup() -> FirmwareList:
+        firmware_list = FirmwareList()
+        firmware_list.load_projects_from_website(data=catalog['projects'])
+        firmware_list.load_families_from_website(load_esptool_only=False, data=catalog['families'])
+        firmware_list.load_firmware_from_website(data=catalog['firmware'])
+        return firmware_list
+    return setup
+
+
+def run_catalog_benchmarks(repeat: int) -> List[BenchmarkResult]:
+    load_firmware_list(max_catalog_age=0)  # Prime the on-disk catalog cache
+    catalog = FirmwareList().fetch_catalog()
+
+    return [
+        measure("catalog.load.network", lambda: load_firmware_list(max_catalog_age=None), repeat),
+        measure("catalog.load.revalidated", lambda: load_firmware_list(max_catalog_age=0), repeat),
+        measure("catalog.load.cached", lambda: load_firmware_list(max_catalog_age=24 * 60 * 60), repeat),
+        measure("catalog.cleanse_projects", lambda firmware_list: firmware_list.cleanse_projects(), repeat,
+                setup=unloaded_firmware_list(catalog)),
+    ]
+
+
+def run_lookup_benchmarks(firmware_list: FirmwareList, repeat: int) -> List[BenchmarkResult]:
+    firmware = list(firmware_list.Firmwares.values())[:LOOKUP_BATCH_SIZE]
+    projects = [(str(firmware_list.Projects[f.project_id]), f.project_id) for f in firmware]
+    families = [(f.project_id, str(f.family)) for f in firmware]
+    names = [(f.project_id, f.family_id, str(f)) for f in firmware]
+    ids = [str(f.id) for f in firmware]
+
+    def lookup_all(lookup: Callable, queries: list) -> Callable:
+        return lambda: [lookup(*query) for query in queries]
+
+    return [
+        measure("lookup.get_project_id", lookup_all(firmware_list.get_project_id, [(p,) for p, _ in projects]),
+                repeat, operations=len(projects)),
+        measure("lookup.get_device_family_id", lookup_all(firmware_list.get_device_family_id, families), repeat,
+                operations=len(families)),
+        measure("lookup.get_firmware", lookup_all(firmware_list.get_firmware, names), repeat, operations=len(names)),
+        measure("lookup.get_firmware_by_id", lookup_all(firmware_list.get_firmware_by_id, [(i,) for i in ids]),
+                repeat, operations=len(ids)),
+        measure("lookup.build_indexes", firmware_list.build_indexes, repeat),
+    ]
+
+
+def run_download_benchmarks(firmware_list: FirmwareList, repeat: int, cache_root: str) -> List[BenchmarkResult]:
+    # An ESP32 firmware, so that every part (bootloader, partitions, app, SPIFFS & otadata) gets downloaded
+    firmware = next(f for f in firmware_list.Firmwares.values() if f.family.name == "ESP32")
+    cold_caches = iter(range(repeat))
+
+    def empty_cache():
+        configure_binary_cache(directory=os.path.join(cache_root, "binaries-{}".format(next(cold_caches))))
+
+    def download():
+        if not firmware.download_to_file():
+            raise RuntimeError("Unable to download firmware from the stub server")
+
+    results = [measure("download.cold", lambda _: download(), repeat, setup=empty_cache)]
+    # ...then again, now that everything is already in the cache (so only the checksums get checked)
+    results.append(measure("download.cached", download, repeat))
+    results.append(measure("verify.web", lambda: firmware.pre_flash_web_verify("benchmark", max_age=0), repeat))
+    firmware.pre_flash_web_verify("benchmark")  # So that every run of verify.cached is a cache hit
+    results.append(measure("verify.cached", lambda: firmware.pre_flash_web_verify("benchmark"), repeat))
+    return results
+
+
+def run_hash_benchmarks(firmware_list: FirmwareList, repeat: int) -> List[BenchmarkResult]:
+    firmware = next(f for f in firmware_list.Firmwares.values() if f.family.name == "ESP32")
+    path = firmware.full_filepath("firmware")
+    return [
+        measure("hash.hash_of_file", lambda: fhash.hash_of_file(path, use_memo=False), repeat),
+        measure("hash.hash_of_file.memo", lambda: fhash.hash_of_file(path), repeat),
+    ]
+
+
+def run_command_benchmarks(firmware_list: FirmwareList, repeat: int) -> List[BenchmarkResult]:
+    firmware = [f for f in firmware_list.Firmwares.values() if f.family.flash_method == "esptool"][:LOOKUP_BATCH_SIZE]
+
+    def build_commands():
+        for this_firmware in firmware:
+            build_flash_command(build_flash_job(this_firmware, "460800", True), "/dev/ttyUSB0")
+
+    return [measure("flash_command.build", build_commands, repeat, operations=len(firmware))]
+
+
+def run_benchmarks(options: argparse.Namespace) -> dict:
+    catalog_options = catalog_options_from_arguments(options)
+    with tempfile.TemporaryDirectory(prefix="brewflasher-benchmark-") as cache_root, \
+            StubServer(catalog_options) as server:
+        # Nothing from a previous run (or from the user's own cache) should be reused
+        os.environ['BREWFLASHER_CACHE_DIR'] = cache_root
+        brewflasher_com_integration.BREWFLASHER_COM_URL = server.url
+        configure_binary_cache(directory=os.path.join(cache_root, "binaries"))
+
+        results = run_catalog_benchmarks(options.repeat)
+        firmware_list = load_firmware_list(max_catalog_age=None)
+        results += run_lookup_benchmarks(firmware_list, options.repeat)
+        results += run_download_benchmarks(firmware_list, options.repeat, cache_root)
+        results += run_hash_benchmarks(firmware_list, options.repeat)
+        results += run_command_benchmarks(firmware_list, options.repeat)
+
+    return dict(git_revision(), **{
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': options.repeat,
+        'catalog': asdict(catalog_options),
+        'results': {result.name: result.to_dict() for result in results},
+    })
+
+
+def format_results(results: dict, baseline: dict = None) -> str:
+    lines = ["Commit {}{} (median of {} runs)".format(results['commit'][:12], " (modified)" if results['dirty'] else "",
+                                                    results['repeat'])]
+    if baseline is not None:
+        lines.append("Compared against {}".format(baseline['commit'][:12]))
+        if baseline['catalog'] != results['catalog']:
+            lines.append("WARNING: The baseline used a different catalog ({})".format(baseline['catalog']))
+
+    for name, result in results['results'].items():
+        line = "  {:<30} {:>10.3f} ms".format(name, result['median'] * 1000)
+        if result['operations'] > 1:
+            line += "  ({:.2f} us each)".format(result['median'] / result['operations'] * 1e6)
+        if baseline is not None and name in baseline['results']:
+            before = baseline['results'][name]['median']
+            line += "  {:+.1f}%".format((result['median'] - before) / before * 100 if before > 0 else 0)
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_catalog_arguments(parser)
+    parser.add_argument("--repeat", type=int, default=5, help="Number of times each benchmark is run")
+    parser.add_argument("--output", help="Save the results (as JSON) to this file")
+    parser.add_argument("--compare", help="Compare the results against those previously saved using --output")
+    options = parser.parse_args()
+
+    baseline = None
+    if options.compare:
+        with open(options.compare, "r") as f:
+            baseline = json.load(f)
+
+    results = run_benchmarks(options)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2)
+    print(format_results(results, baseline))
+
+
+if __name__ == "__main__":
+    main()
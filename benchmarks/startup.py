@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""Measures how long BrewFlasher takes to start up
+
+Reports the (cumulative) import time of each brewflasher_cli module and the heavy third party modules it depends on,
+along with the wall clock time of a few commands that should return near-instantly. Each measurement is taken in a
+fresh interpreter, so nothing is already sitting in sys.modules.
+
+    python benchmarks/startup.py [--repeat 5] [--json]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from statistics import median
+from time import perf_counter
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = [
+    "brewflasher_cli.brewflasher_cli_edition",
+    "brewflasher_cli.brewflasher_com_integration",
+    "brewflasher_cli.flashing",
+    "brewflasher_cli.fleet",
+    "brewflasher_cli.hotplug",
+    "brewflasher_cli.chip_detection",
+    "brewflasher_cli.serial_integration",
+    "brewflasher_cli.transport",
+    "click",
+    "requests",
+    "serial.tools.list_ports",
+    "esptool",
+]
+
+# Modules that shouldn't be loaded just to start the CLI (they are imported when they're needed)
+DEFERRED_MODULES = ["esptool", "serial", "requests", "urllib3"]
+
+COMMANDS = {
+    "--help": ["-m", "brewflasher_cli.brewflasher_cli_edition", "--help"],
+    "--version": ["-m", "brewflasher_cli.brewflasher_cli_edition", "--version"],
+}
+
+
+def _environment() -> dict:
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.join(REPO_ROOT, "src"), env.get('PYTHONPATH')]))
+    return env
+
+
+def import_time(module: str) -> float:
+    """Returns the cumulative time (in seconds) taken to import module in a fresh interpreter"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module], env=_environment(),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    # Lines look like "import time:   self [us] | cumulative | imported package", with the top level import last
+    for line in reversed(result.stderr.splitlines()):
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1e6
+    raise ValueError("No import time reported for " + module)
+
+
+def command_time(args: list) -> float:
+    start = perf_counter()
+    subprocess.run([sys.executable] + args, env=_environment(), stdout=subprocess.DEVNULL, check=True)
+    return perf_counter() - start
+
+
+def modules_loaded_at_startup() -> list:
+    """Returns which of DEFERRED_MODULES get imported along with the CLI"""
+    check = ("import sys, brewflasher_cli.brewflasher_cli_edition; "
+             "print(' '.join(m for m in sys.argv[1:] if m in sys.modules))")
+    result = subprocess.run([sys.executable, "-c", check] + DEFERRED_MODULES, env=_environment(),
+                            stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    return result.stdout.split()
+
+
+def run(repeat: int) -> dict:
+    return {
+        'imports': {module: median(import_time(module) for _ in range(repeat)) for module in MODULES},
+        'commands': {name: median(command_time(args) for _ in range(repeat)) for name, args in COMMANDS.items()},
+        'loaded_at_startup': modules_loaded_at_startup(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs per measurement (the median is reported)")
+    parser.add_argument("--json", action="store_true", help="Output the results as JSON")
+    options = parser.parse_args()
+
+    results = run(options.repeat)
+    if options.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print("Import time (cumulative, median of {} runs)".format(options.repeat))
+    for module, seconds in results['imports'].items():
+        print("  {:<45} {:>8.1f} ms".format(module, seconds * 1000))
+    print("Command time (wall clock, median of {} runs)".format(options.repeat))
+    for name, seconds in results['commands'].items():
+        print("  brewflasher {:<33} {:>8.1f} ms".format(name, seconds * 1000))
+    print("Deferred modules loaded at startup: {}".format(", ".join(results['loaded_at_startup']) or "none"))
+
+
+if __name__ == "__main__":
+    main()
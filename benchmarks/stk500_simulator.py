@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""A simulated Arduino bootloader on a pseudo-terminal, for exercising the built-in STK500 programmer without a device
+
+Speaks STK500v1 (as Optiboot does) or STK500v2 (as the Mega's stk500boot does) depending on the part, holding the
+part's flash in memory. Responses are delayed to match the part's baud rate, so timings are close to a real device.
+By default, a randomly generated firmware is flashed to one or more simulated devices at once, then checked against
+what each device ended up with:
+
+    python benchmarks/stk500_simulator.py --part atmega2560 --size 100000 --devices 8
+
+With --serve, the simulated device is left running for other tools (e.g. avrdude, or brewflasher) to be pointed at:
+
+    python benchmarks/stk500_simulator.py --part atmega328p --serve
+"""
+import argparse
+import os
+import random
+import select
+import sys
+import tempfile
+import threading
+import tty
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
+from time import perf_counter, sleep
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Use the working tree, rather than whatever copy of brewflasher_cli happens to be installed
+sys.path.insert(0, os.path.join(REPO_ROOT, "src"))
+
+from brewflasher_cli.stk500 import AVR_PARTS, STK500V1, AvrPart, program_avr  # noqa: E402
+
+# Space left at the end of the flash for the bootloader, which firmware can't be written over
+BOOTLOADER_SIZE = 4096
+
+
+class _Stopped(Exception):
+    pass
+
+
+class SimulatedBootloader:
+    """Simulates part's bootloader on a pseudo-terminal from a background thread. Use as a context manager, then open
+    .port as if it were the device's serial port."""
+
+    def __init__(self, part: AvrPart, line_speed: int = None):
+        self.part = part
+        self.flash = bytearray(b"\xff" * part.flash_size)
+        # Bytes per second that requests & responses are limited to (10 bits a byte, as with 8N1). 0 means no limit.
+        self.line_speed = (part.baud if line_speed is None else line_speed) / 10
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)  # Until the programmer opens it, anything received would otherwise be echoed back
+        self.port = os.ttyname(self._slave)
+        self._buffer = bytearray()
+        self._address = 0
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stk500-simulator", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stopping.set()
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _read(self, length: int) -> bytes:
+        while len(self._buffer) < length:
+            if self._stopping.is_set():
+                raise _Stopped
+            if select.select([self._master], [], [], 0.1)[0]:
+                self._buffer.extend(os.read(self._master, 4096))
+        data = bytes(self._buffer[:length])
+        del self._buffer[:length]
+        return data
+
+    def _write(self, request_length: int, response: bytes):
+        if self.line_speed > 0:
+            sleep((request_length + len(response)) / self.line_speed)
+        os.write(self._master, response)
+
+    def _run(self):
+        try:
+            while True:
+                if self.part.protocol == STK500V1:
+                    self._handle_stk500v1()
+                else:
+                    self._handle_stk500v2()
+        except _Stopped:
+            pass
+
+    def _handle_stk500v1(self):
+        command = self._read(1)[0]
+        parameter_lengths = {0x41: 1, 0x42: 20, 0x45: 5, 0x55: 2, 0x56: 4, 0x64: 3, 0x74: 3}
+        parameters = self._read(parameter_lengths.get(command, 0))
+        if command == 0x64:  # Program page - the page's data follows its length
+            parameters += self._read(parameters[0] << 8 | parameters[1])
+        if self._read(1) != b"\x20":
+            self._write(1, b"\x15")  # Not in sync
+            return
+
+        response = b""
+        if command == 0x41:  # Get parameter (e.g. the bootloader's version)
+            response = b"\x04" if parameters[0] == 0x81 else b"\x03"
+        elif command == 0x55:
+            self._address = (parameters[0] | parameters[1] << 8) * 2
+        elif command == 0x56:  # Universal (raw ISP) instruction
+            response = b"\x00"
+        elif command == 0x64:
+            data = parameters[3:]
+            self.flash[self._address:self._address + len(data)] = data
+        elif command == 0x74:
+            response = bytes(self.flash[self._address:self._address + (parameters[0] << 8 | parameters[1])])
+        elif command == 0x75:
+            response = self.part.signature
+        self._write(2 + len(parameters), b"\x14" + response + b"\x10")
+
+    def _handle_stk500v2(self):
+        if self._read(1) != b"\x1b":
+            return  # Wait for the start of the next message
+        header = b"\x1b" + self._read(4)
+        body = self._read(header[2] << 8 | header[3])
+        if header[4] != 0x0e or reduce(lambda a, b: a ^ b, header + body + self._read(1)) != 0:
+            return  # Garbled messages are dropped, as the real bootloader does
+
+        command = body[0]
+        answer = bytes([command, 0x00])
+        if command == 0x01:  # Sign on
+            answer += b"\x08STK500_2"
+        elif command == 0x03:  # Get parameter
+            answer += b"\x02"
+        elif command == 0x06:
+            self._address = (int.from_bytes(body[1:5], "big") & 0x7fffffff) * 2
+        elif command == 0x13:
+            length = body[1] << 8 | body[2]
+            self.flash[self._address:self._address + length] = body[10:10 + length]
+            self._address += length
+        elif command == 0x14:
+            length = body[1] << 8 | body[2]
+            answer += bytes(self.flash[self._address:self._address + length]) + b"\x00"
+            self._address += length
+        elif command == 0x1d:  # SPI multi - only reading the signature is supported
+            answer += bytes([0, body[4], 0, self.part.signature[body[6]] if body[4] == 0x30 else 0, 0x00])
+        elif command not in (0x02, 0x10, 0x11, 0x12):  # Set parameter, enter/leave programming mode, chip erase
+            answer = bytes([command, 0xc0])  # Failed
+        message = header[:2] + len(answer).to_bytes(2, "big") + b"\x0e" + answer
+        self._write(len(header) + len(body) + 1, message + bytes([reduce(lambda a, b: a ^ b, message)]))
+
+
+def to_intel_hex(data: bytes, address: int = 0) -> str:
+    lines = []
+    upper_address = None
+    for offset in range(0, len(data), 16):
+        record_address = address + offset
+        if record_address >> 16 != upper_address:
+            upper_address = record_address >> 16
+            record = bytes([2, 0, 0, 4]) + upper_address.to_bytes(2, "big")
+            lines.append(":" + (record + bytes([-sum(record) & 0xff])).hex().upper())
+        chunk = data[offset:offset + 16]
+        record = bytes([len(chunk), record_address >> 8 & 0xff, record_address & 0xff, 0]) + chunk
+        lines.append(":" + (record + bytes([-sum(record) & 0xff])).hex().upper())
+    lines.append(":00000001FF")
+    return "\n".join(lines) + "\n"
+
+
+def flash_simulated_devices(part: AvrPart, size: int, devices: int, line_speed: int = None) -> float:
+    """Flashes a random firmware of size bytes to devices simulated devices at once, returning how long it took.
+    Raises RuntimeError if any device ends up with anything other than the firmware."""
+    firmware = bytes(random.Random(size).getrandbits(8) for _ in range(size))
+    with tempfile.TemporaryDirectory(prefix="brewflasher-stk500-") as directory:
+        hex_path = os.path.join(directory, "firmware.hex")
+        with open(hex_path, "w") as f:
+            f.write(to_intel_hex(firmware))
+
+        simulators = [SimulatedBootloader(part, line_speed) for _ in range(devices)]
+        for simulator in simulators:
+            simulator.__enter__()
+        try:
+            start = perf_counter()
+            with ThreadPoolExecutor(max_workers=devices) as executor:
+                list(executor.map(lambda simulator: program_avr(simulator.port, part, hex_path, log=lambda _: None),
+                                  simulators))
+            seconds = perf_counter() - start
+        finally:
+            for simulator in simulators:
+                simulator.__exit__(None, None, None)
+
+    for simulator in simulators:
+        if simulator.flash[:size] != firmware:
+            raise RuntimeError("The firmware on {} doesn't match what was flashed".format(simulator.port))
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--part", choices=[name for name, part in AVR_PARTS.items() if part.protocol != ""],
+                        default="atmega328p", help="The part to simulate")
+    parser.add_argument("--size", type=int, default=None,
+                        help="Size (in bytes) of the firmware to flash (defaults to filling the part's flash)")
+    parser.add_argument("--devices", type=int, default=1, help="Number of simulated devices to flash at once")
+    parser.add_argument("--line-speed", type=int, default=None,
+                        help="Baud rate to simulate (defaults to the part's, 0 for no limit)")
+    parser.add_argument("--serve", action="store_true", help="Run a simulated device until interrupted")
+    options = parser.parse_args()
+    part = AVR_PARTS[options.part]
+
+    if options.serve:
+        with SimulatedBootloader(part, options.line_speed) as simulator:
+            print("Simulating an {} ({}) on {} - press Ctrl+C to stop".format(part.name, part.protocol, simulator.port))
+            try:
+                while True:
+                    sleep(1)
+            except KeyboardInterrupt:
+                pass
+        return
+
+    size = options.size or part.flash_size - BOOTLOADER_SIZE
+    seconds = flash_simulated_devices(part, size, options.devices, options.line_speed)
+    print("Flashed & verified {} bytes to {} simulated {} device{} in {:.2f}s".format(
+        size, options.devices, part.name, "s" if options.devices != 1 else "", seconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""A local stand-in for brewflasher.com, serving a synthetic catalog of configurable size
+
+The catalog endpoints support ETag/If-None-Match revalidation and the binaries support Range requests, the same as
+brewflasher.com, so the whole load -> download -> verify path can be exercised without a network connection. Everything
+is generated from a seed, so the same parameters always produce the same catalog (and the same checksums).
+
+Used by run.py, but can also be run on its own and pointed at using the BREWFLASHER_COM_URL environment variable:
+
+    python benchmarks/stub_server.py --projects 200 --firmware 5000 --port 8770
+    BREWFLASHER_COM_URL=http://127.0.0.1:8770/firmware brewflasher
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+
+
+# brewflasher.com serves the catalog from under /firmware, and BREWFLASHER_COM_URL includes that prefix
+URL_PREFIX = "/firmware"
+
+# (name, flash_method, detection_family, has bootloader/otadata) for each synthetic device family
+FAMILIES = [
+    ("ESP32", "esptool", "esp32", True),
+    ("ESP32-S2", "esptool", "esp32s2", True),
+    ("ESP32-C3", "esptool", "esp32c3", True),
+    ("ESP8266", "esptool", "esp8266", False),
+    ("Arduino Uno", "avrdude", "arduino", False),
+]
+
+BOOTLOADER_SIZE = 20 * 1024
+OTADATA_SIZE = 8 * 1024
+PARTITIONS_SIZE = 3 * 1024
+
+
+@dataclass
+class CatalogOptions:
+    projects: int = 200
+    firmware: int = 5000
+    binary_size: int = 1024 * 1024
+    # Firmware reuse this many distinct binaries (hashing a unique binary for each of thousands of firmware would make
+    # generating the catalog take longer than the benchmarks themselves)
+    distinct_binaries: int = 8
+    seed: int = 1
+
+
+class SyntheticCatalog:
+    """The catalog endpoints (as JSON) and binaries served by the stub"""
+
+    def __init__(self, options: CatalogOptions, base_url: str):
+        self.options = options
+        self.binaries = {}  # type: Dict[str, bytes]
+        self._checksums = {}  # type: Dict[str, str]
+        rng = random.Random(options.seed)
+
+        projects = [{
+            'name': "Project {}".format(project_id), 'weight': project_id, 'id': project_id,
+            'description': "Synthetic project {}".format(project_id), 'support_url': "", 'project_url': "",
+            'documentation_url': "", 'show_in_standalone_flasher': True,
+        } for project_id in range(1, options.projects + 1)]
+
+        families = []
+        for family_id, (name, flash_method, detection_family, esp32_based) in enumerate(FAMILIES, start=1):
+            family = {
+                'name': name, 'flash_method': flash_method, 'id': family_id, 'detection_family': detection_family,
+                'download_url_bootloader': "", 'download_url_otadata': "", 'otadata_address': "",
+                'checksum_bootloader': "", 'checksum_otadata': "", 'use_1200_bps_touch': False,
+            }
+            if esp32_based:
+                family['download_url_bootloader'], family['checksum_bootloader'] = self._add_binary(
+                    base_url, "bootloader-{}.bin".format(family_id), BOOTLOADER_SIZE, rng)
+                family['download_url_otadata'], family['checksum_otadata'] = self._add_binary(
+                    base_url, "otadata-{}.bin".format(family_id), OTADATA_SIZE, rng)
+                family['otadata_address'] = "0xe000"
+            families.append(family)
+
+        apps = [self._add_binary(base_url, "app-{}.bin".format(i), options.binary_size, rng)
+                for i in range(options.distinct_binaries)]
+        spiffs = [self._add_binary(base_url, "spiffs-{}.bin".format(i), options.binary_size, rng)
+                  for i in range(options.distinct_binaries)]
+        partitions = self._add_binary(base_url, "partitions.bin", PARTITIONS_SIZE, rng)
+
+        firmware = []
+        for firmware_id in range(1, options.firmware + 1):
+            family_id = (firmware_id - 1) % len(FAMILIES) + 1
+            project_id = ((firmware_id - 1) // len(FAMILIES)) % options.projects + 1
+            app_url, app_checksum = apps[firmware_id % len(apps)]
+            row = {
+                'name': "Firmware {}".format(project_id), 'version': "1.{}".format(firmware_id),
+                'family_id': family_id, 'variant': "Variant {}".format(firmware_id % 3) if firmware_id % 2 else "",
+                'is_fermentrack_supported': True, 'in_error': False,
+                'description': "Release notes for build {}. ".format(firmware_id) * 20,
+                'variant_description': "", 'download_url': app_url,
+                'post_install_instructions': "Reset the device once flashing completes.", 'weight': firmware_id,
+                'download_url_partitions': "", 'download_url_spiffs': "", 'checksum': app_checksum,
+                'checksum_partitions': "", 'checksum_spiffs': "", 'spiffs_address': "",
+                'project_id': project_id, 'id': firmware_id,
+            }
+            if FAMILIES[family_id - 1][3]:
+                row['download_url_partitions'], row['checksum_partitions'] = partitions
+                row['download_url_spiffs'], row['checksum_spiffs'] = spiffs[firmware_id % len(spiffs)]
+                row['spiffs_address'] = "0x290000"
+            firmware.append(row)
+
+        self.checksums_by_firmware_id = {row['id']: row['checksum'] for row in firmware}
+        self.endpoints = {
+            "/api/project_list/all/": json.dumps(projects).encode("utf-8"),
+            "/api/firmware_family_list/": json.dumps(families).encode("utf-8"),
+            "/api/firmware_list/all/": json.dumps(firmware).encode("utf-8"),
+        }
+        self.etags = {path: '"{}"'.format(hashlib.sha1(body).hexdigest()) for path, body in self.endpoints.items()}
+
+    def _add_binary(self, base_url: str, name: str, size: int, rng: random.Random) -> (str, str):
+        contents = rng.getrandbits(size * 8).to_bytes(size, "little") if size > 0 else b""
+        self.binaries[name] = contents
+        return base_url.rsplit(URL_PREFIX, 1)[0] + "/bin/" + name, hashlib.sha256(contents).hexdigest()
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, so the connection pooling in transport is exercised
+    catalog = None  # type: SyntheticCatalog
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: bytes = b"", headers: dict = None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+
+        if path.startswith(URL_PREFIX) and path[len(URL_PREFIX):] in self.catalog.endpoints:
+            endpoint = path[len(URL_PREFIX):]
+            etag = self.catalog.etags[endpoint]
+            if self.headers.get("If-None-Match") == etag:
+                self._send(304, headers={'ETag': etag})
+            else:
+                self._send(200, self.catalog.endpoints[endpoint], {'ETag': etag, 'Content-Type': "application/json"})
+
+        elif path.startswith("/bin/") and path[5:] in self.catalog.binaries:
+            contents = self.catalog.binaries[path[5:]]
+            requested_range = self.headers.get("Range", "")
+            if requested_range.startswith("bytes=") and requested_range.endswith("-"):
+                start = int(requested_range[6:-1])
+                if start >= len(contents):
+                    self._send(416, headers={'Content-Range': "bytes */{}".format(len(contents))})
+                else:
+                    self._send(206, contents[start:], {
+                        'Content-Range': "bytes {}-{}/{}".format(start, len(contents) - 1, len(contents))})
+            else:
+                self._send(200, contents, {'Accept-Ranges': "bytes"})
+
+        else:
+            self._send(404)
+
+    def do_POST(self):
+        if self.path != URL_PREFIX + "/api/flash_verify/":
+            self._send(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        checksum = self.catalog.checksums_by_firmware_id.get(request.get('firmware_id'))
+        if checksum is None:
+            response = {'status': "failed", 'message': "Invalid firmware ID"}
+        else:
+            response = {'status': "success", 'message': checksum}
+        self._send(200, json.dumps(response).encode("utf-8"), {'Content-Type': "application/json"})
+
+
+class StubServer:
+    """Serves a SyntheticCatalog from a background thread. Use as a context manager, then point at .url"""
+
+    def __init__(self, options: CatalogOptions = None, port: int = 0):
+        handler = type("Handler", (StubRequestHandler,), {})
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.httpd.daemon_threads = True
+        self.url = "http://127.0.0.1:{}{}".format(self.httpd.server_address[1], URL_PREFIX)
+        self.catalog = SyntheticCatalog(options or CatalogOptions(), self.url)
+        handler.catalog = self.catalog
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="stub-server", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def add_catalog_arguments(parser: argparse.ArgumentParser):
+    defaults = CatalogOptions()
+    parser.add_argument("--projects", type=int, default=defaults.projects, help="Number of projects in the catalog")
+    parser.add_argument("--firmware", type=int, default=defaults.firmware, help="Number of firmware in the catalog")
+    parser.add_argument("--binary-size", type=int, default=defaults.binary_size,
+                        help="Size (in bytes) of each firmware and SPIFFS binary")
+    parser.add_argument("--distinct-binaries", type=int, default=defaults.distinct_binaries,
+                        help="Number of distinct firmware binaries shared between the firmware in the catalog")
+    parser.add_argument("--seed", type=int, default=defaults.seed, help="Seed used to generate the catalog")
+
+
+def catalog_options_from_arguments(options: argparse.Namespace) -> CatalogOptions:
+    return CatalogOptions(projects=options.projects, firmware=options.firmware, binary_size=options.binary_size,
+                          distinct_binaries=options.distinct_binaries, seed=options.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_catalog_arguments(parser)
+    parser.add_argument("--port", type=int, default=8770, help="Port to listen on")
+    options = parser.parse_args()
+
+    with StubServer(catalog_options_from_arguments(options), options.port) as server:
+        print("Serving a catalog of {} projects and {} firmware at {}".format(options.projects, options.firmware,
+                                                                             server.url))
+        print("Press Ctrl+C to stop")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import json
+import os
+import threading
+from time import time
+from typing import List
+
+from .cache_dir import user_cache_dir, write_file_atomically
+from .serial_integration import comports
+
+
+# Passed in place of a baud rate to have BrewFlasher find the fastest rate that works for a device
+ADAPTIVE_BAUD = "auto"
+# The rates tried when flashing adaptively, fastest first
+ADAPTIVE_BAUD_RATES = [921600, 460800, 230400, 115200]
+
+
+def profile_key(serial_port: str, chip: str) -> str:
+    """Identifies a (port, USB bridge, chip) combination - the things that determine how fast we can reliably flash"""
+    vid, pid = None, None
+    for port in comports():
+        if port.device == serial_port:
+            vid, pid = port.vid, port.pid
+            break
+    if vid is None:
+        bridge = "unknown"
+    else:
+        bridge = "{:04x}:{:04x}".format(vid, pid)
+    return "{}|{}|{}".format(serial_port, bridge, chip)
+
+
+class BaudProfileStore:
+    """Remembers the fastest baud rate that has worked for each (port, USB bridge, chip), so later runs start there"""
+
+    def __init__(self, path: str = None):
+        self.path = path or os.path.join(user_cache_dir(), "baud_profiles.json")
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _update(self, key: str, **values):
+        with self._lock:
+            profiles = self._load()
+            profiles.setdefault(key, {}).update(values, updated_at=time())
+            try:
+                write_file_atomically(self.path, json.dumps(profiles, indent=2).encode("utf-8"))
+            except OSError:
+                pass  # Losing the profile just means we start from the top next time
+
+    def rates_to_try(self, key: str) -> List[int]:
+        """Returns the baud rates to try (in order), starting from the fastest rate known to work for key"""
+        best_rate = self._load().get(key, {}).get('best_rate')
+        if best_rate in ADAPTIVE_BAUD_RATES:
+            return ADAPTIVE_BAUD_RATES[ADAPTIVE_BAUD_RATES.index(best_rate):]
+        return list(ADAPTIVE_BAUD_RATES)
+
+    def record_success(self, key: str, baud: int):
+        self._update(key, best_rate=int(baud))
+
+    def record_failure(self, key: str, baud: int):
+        # If the rate we thought was reliable failed, forget it so we'll step down from it next time too
+        if self._load().get(key, {}).get('best_rate') == int(baud):
+            slower_rates = ADAPTIVE_BAUD_RATES[ADAPTIVE_BAUD_RATES.index(int(baud)) + 1:]
+            self._update(key, best_rate=slower_rates[0] if slower_rates else int(baud))
@@ -0,0 +1,120 @@
+import json
+import os
+import re
+import threading
+from time import time
+
+from .cache_dir import user_cache_dir, write_file_atomically
+
+
+# Default size budget for the binary cache. Least recently used binaries are removed once the cache grows past this.
+DEFAULT_MAX_CACHE_BYTES = 256 * 1024 * 1024
+
+# Binaries are stored under their sha256 checksum, or (for images merged by merged_image) "merged-" and the sha256 of
+# what went into them. Checksums come from the catalog, so anything else (e.g. "../../x") must never become a path.
+CACHE_KEY_PATTERN = re.compile(r"(merged-)?[0-9a-fA-F]{64}")
+
+
+def is_cacheable(checksum: str) -> bool:
+    """Whether checksum is safe to store a binary under (both in the binary cache and in a mirror)"""
+    return CACHE_KEY_PATTERN.fullmatch(checksum or "") is not None
+
+
+class BinaryCache:
+    """Content-addressed store of downloaded firmware binaries
+
+    Each binary is stored under its sha256 checksum, which means that the same build is only ever downloaded once no
+    matter how many devices it is flashed to, and that concurrent runs never overwrite each other's files. An index
+    of each binary's size and when it was last used is kept alongside, and is used to evict the least recently used
+    binaries once the cache grows past max_bytes."""
+
+    def __init__(self, directory: str = None, max_bytes: int = DEFAULT_MAX_CACHE_BYTES):
+        self.directory = directory or user_cache_dir("binaries")
+        os.makedirs(self.directory, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Binaries used during this run are never evicted out from under us (e.g. between download & flash)
+        self._pinned = set()
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.directory, "index.json")
+
+    def path_for(self, checksum: str) -> str:
+        if not is_cacheable(checksum):
+            raise ValueError("Not a valid checksum: {!r}".format(checksum))
+        return os.path.join(self.directory, checksum.lower() + ".bin")
+
+    def _load_index(self) -> dict:
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+
+        # Reconcile the index with what is actually on disk, as other processes may have added or evicted binaries
+        on_disk = {}
+        for filename in os.listdir(self.directory):
+            checksum = filename[:-4]
+            if not filename.endswith(".bin") or not is_cacheable(checksum):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, filename))
+            except OSError:
+                continue
+            on_disk[checksum] = index.get(checksum, {'last_used': stat.st_mtime})
+            on_disk[checksum]['size'] = stat.st_size
+        return on_disk
+
+    def _save_index(self, index: dict):
+        try:
+            write_file_atomically(self.index_path, json.dumps(index).encode("utf-8"))
+        except OSError:
+            pass  # The index is rebuilt from the directory listing if it is missing, so this isn't fatal
+
+    def record_use(self, checksum: str):
+        """Marks the binary with the given checksum as used just now, and pins it for the rest of this run"""
+        with self._lock:
+            self._pinned.add(checksum.lower())
+            index = self._load_index()
+            if checksum.lower() in index:
+                index[checksum.lower()]['last_used'] = time()
+            self._save_index(index)
+
+    def evict(self) -> int:
+        """Removes least recently used binaries until the cache fits within max_bytes. Returns the bytes freed."""
+        freed = 0
+        with self._lock:
+            index = self._load_index()
+            total = sum(entry['size'] for entry in index.values())
+            for checksum in sorted(index, key=lambda c: index[c]['last_used']):
+                if total <= self.max_bytes:
+                    break
+                if checksum in self._pinned:
+                    continue
+                try:
+                    os.remove(self.path_for(checksum))
+                except OSError:
+                    continue
+                total -= index[checksum]['size']
+                freed += index[checksum]['size']
+                del index[checksum]
+            self._save_index(index)
+        return freed
+
+
+_default_cache = None
+
+
+def get_binary_cache() -> BinaryCache:
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = BinaryCache()
+    return _default_cache
+
+
+def configure_binary_cache(directory: str = None, max_bytes: int = DEFAULT_MAX_CACHE_BYTES) -> BinaryCache:
+    """Replaces the cache used by Firmware.download_to_file (e.g. to apply a size budget from the command line)"""
+    global _default_cache
+    _default_cache = BinaryCache(directory=directory, max_bytes=max_bytes)
+    return _default_cache
@@ -1,19 +1,25 @@
 #!/usr/bin/env python3
-import subprocess
+import json
 import sys
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
 from shutil import which
 
 import click
-import esptool
-import serial
-from serial import SerialException
 
 from brewflasher_cli.brewflasher_com_integration import FirmwareList, Firmware
-from brewflasher_cli import serial_integration
+from brewflasher_cli.baud_profile import ADAPTIVE_BAUD
+from brewflasher_cli.binary_cache import DEFAULT_MAX_CACHE_BYTES, configure_binary_cache
+from brewflasher_cli.catalog_cache import DEFAULT_MAX_CATALOG_AGE
+from brewflasher_cli.flashing import build_flash_job, run_flash_job
+from brewflasher_cli.fleet import expand_serial_ports, format_fleet_results
+from brewflasher_cli.hotplug import run_production_line
+from brewflasher_cli.stk500 import part_for_family
+from brewflasher_cli import brewflasher_com_integration, chip_detection, mirror, serial_integration, tracing
 
 __version__ = "0.1.1"
 __supported_baud_rates__ = [9600, 57600, 74880, 115200, 230400, 460800, 921600]
+# The columns output by "brewflasher list", in order
+LIST_FIELDS = ["id", "project", "family", "name", "version", "variant", "flash_method"]
 
 
 def obtain_user_confirmation(prompt: str):
@@ -23,46 +29,89 @@ def obtain_user_confirmation(prompt: str):
         sys.exit(0)
 
 
-@click.command()
+@click.group(invoke_without_command=True)
 @click.version_option(__version__)
 @click.option('--firmware', '-f', default=None, help='Firmware ID to skip firmware selection')
+@click.option('--project', default=None, help='Project name to skip project selection')
+@click.option('--auto-detect', '-a', is_flag=True, default=False,
+              help='Identify the connected device, and pick the matching device family and firmware automatically')
 @click.option('--serial-port', '-p', default=None, help='Serial port to skip device detection')
-@click.option('--baud', '-b', default=None, help='Baud rate to flash at',
-              type=click.Choice([str(x) for x in __supported_baud_rates__]))
+@click.option('--baud', '-b', default=None,
+              help='Baud rate to flash at ("auto" to use the fastest rate that works reliably for the device)',
+              type=click.Choice([str(x) for x in __supported_baud_rates__] + [ADAPTIVE_BAUD]))
 @click.option('--erase-flash', '-e', is_flag=True, default=None, help='Erase flash memory before installing firmware')
 @click.option('--dont-erase-flash', '-n', is_flag=True, default=None, help='Don\'t erase flash memory before installing firmware')
-def main(firmware, serial_port, baud, erase_flash, dont_erase_flash):
+@click.option('--incremental', '-i', is_flag=True, default=False,
+              help='Only write the parts of the firmware that differ from what is already on the device (ESP only, '
+                   'ignored when erasing flash)')
+@click.option('--merge-images', is_flag=True, default=False,
+              help='Merge multi-part ESP32 firmware into a single image before flashing (only when erasing flash)')
+@click.option('--max-catalog-age', default=DEFAULT_MAX_CATALOG_AGE, type=click.IntRange(min=0), show_default=True,
+              help='Seconds a cached copy of the firmware list is used before rechecking BrewFlasher.com (0 to always '
+                   'recheck)')
+@click.option('--cache-size', default=DEFAULT_MAX_CACHE_BYTES // (1024 * 1024), type=click.IntRange(min=0),
+              show_default=True, help='Maximum size (in MB) of the cache of previously downloaded firmware')
+@click.option('--ports', multiple=True, default=None,
+              help='Flash several devices in parallel. Accepts a comma separated list of serial ports and/or globs '
+                   '(e.g. "/dev/ttyUSB*"), and can be repeated')
+@click.option('--jobs', '-j', default=None, type=click.IntRange(min=1),
+              help='Maximum number of devices to flash at once with --ports or --production-line (default: all of the '
+                   '--ports, or 4 for --production-line)')
+@click.option('--production-line', is_flag=True, default=False,
+              help='Keep running, and flash every matching device as soon as it is connected (stop with Ctrl+C)')
+@click.option('--trace', 'trace_file', default=None, type=click.Path(dir_okay=False, writable=True),
+              help='Write how long each phase of the run (loading the firmware list, downloading, flashing, etc.) took '
+                   'to this file, as JSON lines')
+@click.option('--profile', is_flag=True, default=False,
+              help='Print a summary of how long each phase of the run took once it completes')
+@click.option('--source', default=None,
+              help='Load firmware from this URL or mirror directory instead of BrewFlasher.com (see the mirror command)')
+@click.pass_context
+def main(ctx, firmware, project, auto_detect, serial_port, baud, erase_flash, dont_erase_flash, incremental, merge_images,
+         max_catalog_age, cache_size, ports, jobs, production_line, trace_file, profile, source):
+    """Flash BrewFlasher firmware to a device. Run without a command to select and flash firmware interactively."""
+    if source is not None:
+        brewflasher_com_integration.BREWFLASHER_COM_URL = source
+    start_tracing(trace_file, profile)
+    if ctx.invoked_subcommand is not None:
+        return  # e.g. "brewflasher mirror" - the subcommand does the rest
+
     if erase_flash and dont_erase_flash:
         print("You can't specify both --erase-flash and --dont-erase-flash. Exiting.")
         sys.exit(1)
 
+    configure_binary_cache(max_bytes=cache_size * 1024 * 1024)
+
     # Initialize the firmware list
-    print("Loading firmware list from BrewFlasher.com...")
+    print("Loading firmware list from {}...".format(source or "BrewFlasher.com"))
     firmware_list = FirmwareList()
-    if not firmware_list.load_from_website(load_esptool_only=False):
+    if not firmware_list.load_from_website(load_esptool_only=False, max_catalog_age=max_catalog_age):
         print("Failed to load data from the website.")
+        if len(firmware_list.load_errors) > 0:
+            print("({})".format(firmware_list.describe_load_errors()))
         return
-
-    if firmware is None:
+    print(f"Loaded firmware list ({firmware_list.describe_load_timings()})")
+    if firmware_list.is_offline():
+        print("Unable to reach BrewFlasher.com - using the previously downloaded firmware list.")
+
+    if firmware is None and auto_detect:
+        # Identify the connected device, and use that to pick the device family & firmware
+        selected_firmware, device_family, serial_port = auto_select_firmware(firmware_list, project, serial_port)
+    elif firmware is None:
         # If the user didn't specify a firmware, prompt them to select one
-        selected_firmware, device_family = select_firmware(firmware_list)
+        selected_firmware, device_family = select_firmware(firmware_list, project)
     else:
         # If the user specified a firmware, find it in the list and set both selected_firmware and device_family
-        selected_firmware = None
-        device_family = None
-        for project_id in firmware_list.Projects:
-            for family_id in firmware_list.Projects[project_id].device_families:
-                for this_firmware in firmware_list.Projects[project_id].device_families[family_id].firmware:
-                    if this_firmware.id == int(firmware):
-                        selected_firmware = this_firmware
-                        device_family = firmware_list.Projects[project_id].device_families[family_id]
+        selected_firmware = firmware_list.get_firmware_by_id(firmware)
+        device_family = selected_firmware.family if selected_firmware is not None else None
 
         if selected_firmware is None or device_family is None:
             print("Failed to find selected firmware. Exiting.")
             sys.exit(1)
 
     if device_family.flash_method == "avrdude":
-        if not check_for_avrdude():
+        # Most Arduino-based devices are flashed using the built-in STK500 programmer - only the rest need avrdude
+        if part_for_family(device_family).protocol == "" and not check_for_avrdude():
             print("avrdude is not on the path, which means that BrewFlasher cannot flash Arduino-based chips.")
             # TODO - Add OS-specific instructions for resolving this here
             print("Please check the avrdude documentation (https://github.com/avrdudes/avrdude/) for your operating system and install it.")
@@ -104,7 +153,19 @@ def main(firmware, serial_port, baud, erase_flash, dont_erase_flash):
 
     # Confirm firmware selection
     print(f"\nYou've selected the following firmware:\n{selected_firmware}\n")
-    obtain_user_confirmation(f"Do you want to flash this firmware at {selected_baud_rate}bps, {erase_flash_text}?")
+    if selected_baud_rate == ADAPTIVE_BAUD:
+        baud_rate_text = "the fastest reliable speed"
+    else:
+        baud_rate_text = f"{selected_baud_rate}bps"
+    obtain_user_confirmation(f"Do you want to flash this firmware at {baud_rate_text}, {erase_flash_text}?")
+
+    if production_line:
+        flash_devices_as_connected(selected_firmware, selected_baud_rate, erase_flash_flag, jobs or 4, incremental,
+                                   merge_images)
+
+    if ports:
+        flash_fleet_of_devices(selected_firmware, selected_baud_rate, expand_serial_ports(ports), erase_flash_flag, jobs,
+                               incremental, merge_images)
 
     # Device Detection Steps
     if serial_port is None:
@@ -120,13 +181,112 @@ def main(firmware, serial_port, baud, erase_flash, dont_erase_flash):
 
     obtain_user_confirmation(f"Do you want to flash device {selected_device} with {selected_firmware}?")
 
-    flash_firmware_using_whatever_is_appropriate(selected_firmware, selected_baud_rate, selected_device, erase_flash_flag)
+    flash_firmware_using_whatever_is_appropriate(selected_firmware, selected_baud_rate, selected_device, erase_flash_flag,
+                                                 incremental, merge_images)
     selected_firmware.remove_downloaded_firmware()  # Clean up the downloaded firmware files
     print("Done! Exiting.")
     sys.exit(0)
 
 
-def select_firmware(firmware_list):
+@main.command('mirror')
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--jobs', '-j', default=mirror.DEFAULT_MIRROR_JOBS, type=click.IntRange(min=1), show_default=True,
+              help='Number of files to download at once')
+@click.option('--prune', is_flag=True, default=False,
+              help='Remove firmware files from the mirror that are no longer in the firmware list')
+def mirror_command(directory, jobs, prune):
+    """Copy the firmware list and every firmware file into DIRECTORY
+
+    Run again to update the mirror - only new firmware is downloaded. Use the mirror when flashing by passing
+    --source DIRECTORY."""
+    source = brewflasher_com_integration.BREWFLASHER_COM_URL
+    print(f"Mirroring {source} to {directory}...")
+    try:
+        result = mirror.sync_mirror(directory, source, max_workers=jobs, prune=prune)
+    except Exception as e:
+        print(f"Unable to load the firmware list from {source} ({e}). Exiting.")
+        sys.exit(1)
+
+    for url in result.failed:
+        print(f"Error downloading {url}")
+    print(f"Mirror {'FAILED' if result.failed else 'updated'}: {result}")
+    if result.failed:
+        print("The previous copy of the firmware list (if any) has been left in place. Run again to retry.")
+        sys.exit(1)
+    print(f"Flash from the mirror using: brewflasher --source {directory}")
+
+
+@main.command('list')
+@click.option('--project', default=None, help='Only list firmware for this project')
+@click.option('--family', default=None, help='Only list firmware for this device family (e.g. ESP32)')
+@click.option('--version', default=None, help='Only list firmware with this version')
+@click.option('--variant', default=None, help='Only list firmware with this variant (use "" for no variant)')
+@click.option('--flash-method', default=None, help='Only list firmware flashed using this tool (esptool or avrdude)')
+@click.option('--format', 'output_format', type=click.Choice(['tsv', 'json']), default='tsv', show_default=True,
+              help='Output format')
+@click.pass_context
+def list_command(ctx, project, family, version, variant, flash_method, output_format):
+    """List the available firmware, optionally filtered (ignoring case)
+
+    The firmware list is served from the cache where possible (see --max-catalog-age), so this is quick enough to call
+    from scripts - e.g. to look up the id to pass to --firmware. Exits with status 1 if nothing matches."""
+    firmware_list = FirmwareList()
+    if not firmware_list.load_from_website(load_esptool_only=False,
+                                           max_catalog_age=ctx.parent.params['max_catalog_age']):
+        print("Failed to load data from the website.", file=sys.stderr)
+        if len(firmware_list.load_errors) > 0:
+            print("({})".format(firmware_list.describe_load_errors()), file=sys.stderr)
+        sys.exit(1)
+
+    matches = [describe_firmware(firmware_list, this_firmware) for this_firmware in
+               firmware_list.search_firmware(project, family, version, variant, flash_method)]
+    if output_format == "json":
+        print(json.dumps(matches, indent=2))
+    else:
+        print("\t".join(LIST_FIELDS))
+        for match in matches:
+            # Tabs & newlines would break up the row, so they're replaced with spaces
+            print("\t".join(" ".join(str(match[name]).split()) for name in LIST_FIELDS))
+    if len(matches) == 0:
+        sys.exit(1)
+
+
+main.add_command(list_command, 'search')
+
+
+def describe_firmware(firmware_list, firmware_obj: Firmware) -> dict:
+    return {
+        'id': firmware_obj.id,
+        'project': str(firmware_list.Projects[firmware_obj.project_id]),
+        'family': str(firmware_obj.family),
+        'name': firmware_obj.name,
+        'version': firmware_obj.version,
+        'variant': firmware_obj.variant,
+        'flash_method': firmware_obj.family.flash_method,
+    }
+
+
+def start_tracing(trace_file: str = None, profile: bool = False):
+    # The trace file is closed (and the profile printed) when click finishes with the command - including when we
+    # exit early via sys.exit()
+    tracer = tracing.get_tracer()
+    context = click.get_current_context()
+    if trace_file is not None:
+        writer = tracing.JsonLinesWriter(trace_file)
+        tracer.register_hook(writer)
+        context.call_on_close(writer.close)
+    if profile:
+        context.call_on_close(lambda: print("\n" + tracing.format_profile(tracer.events, tracer.elapsed())))
+
+
+def select_project(firmware_list, project_name=None):
+    if project_name is not None:
+        selected_project_id = firmware_list.get_project_id(project_name)
+        if selected_project_id is None:
+            print(f"Unable to find project '{project_name}'. Exiting.")
+            sys.exit(1)
+        return selected_project_id
+
     # Prompt user to select a Project
     projects = firmware_list.get_project_list()
     print("\nSelect a Project:")
@@ -134,7 +294,11 @@ def select_firmware(firmware_list):
         print(f"{idx}. {project}")
 
     project_choice = int(input("\nEnter the number of your choice: ")) - 1
-    selected_project_id = firmware_list.get_project_id(projects[project_choice])
+    return firmware_list.get_project_id(projects[project_choice])
+
+
+def select_firmware(firmware_list, project_name=None):
+    selected_project_id = select_project(firmware_list, project_name)
 
     # Prompt user to select a DeviceFamily
     device_families = firmware_list.get_device_family_list(selected_project_id)
@@ -159,6 +323,38 @@ def select_firmware(firmware_list):
     return selected_firmware, selected_family
 
 
+def auto_select_firmware(firmware_list, project_name=None, serial_port=None):
+    selected_project_id = select_project(firmware_list, project_name)
+
+    print("\nIdentifying connected devices...")
+    devices = chip_detection.identify_devices(chip_detection.candidate_ports([serial_port] if serial_port else None))
+    for device in devices:
+        print(device)
+
+    # Find every (device, device family) pair that the selected project has firmware for
+    matches = []
+    for device in devices:
+        for family_id in firmware_list.get_device_family_ids_for_detection(selected_project_id, device.detection_family):
+            matches.append((device, family_id))
+
+    if len(matches) == 0:
+        print("No connected devices match any of the firmware available for this project. Exiting.")
+        sys.exit(1)
+    elif len(matches) == 1:
+        selected_device, selected_family_id = matches[0]
+    else:
+        print("\nMultiple compatible devices detected:")
+        for idx, (device, family_id) in enumerate(matches, 1):
+            print(f"{idx}. {device.serial_port} - {firmware_list.DeviceFamilies[family_id]}")
+        selected_device, selected_family_id = matches[int(input("\nEnter the number of your choice: ")) - 1]
+
+    # The firmware list is ordered by brewflasher.com, with the recommended firmware first
+    selected_family = firmware_list.DeviceFamilies[selected_family_id]
+    selected_firmware = firmware_list.get_project_firmware(selected_project_id, selected_family_id)[0]
+    print(f"\nDetected {selected_family} on {selected_device.serial_port}")
+    return selected_firmware, selected_family, selected_device.serial_port
+
+
 def check_for_avrdude() -> bool:
     if which("avrdude") is not None or which("avrdude.exe") is not None:
         print("avrdude found on the path - Arduino installations can proceed.")
@@ -168,14 +364,18 @@ def check_for_avrdude() -> bool:
         return False
 
 
-def select_baud_rate() -> int:
+def select_baud_rate() -> int or str:
     # Prompt user to select a baud rate
     print("\nSelect baud rate (speed) to flash at. Recommended to try 460800 first, and 115200 if that fails:")
     for idx, rate in enumerate(__supported_baud_rates__, 1):
         print(f"{idx}. {rate}")
+    print(f"{len(__supported_baud_rates__) + 1}. Automatic (start fast, and slow down if flashing fails)")
 
     baud_rate_choice = int(input("\nEnter the number of your choice: ")) - 1
-    selected_baud_rate = __supported_baud_rates__[baud_rate_choice]
+    if baud_rate_choice == len(__supported_baud_rates__):
+        selected_baud_rate = ADAPTIVE_BAUD
+    else:
+        selected_baud_rate = __supported_baud_rates__[baud_rate_choice]
     print(f"Selected: {selected_baud_rate}")
 
     return selected_baud_rate
@@ -207,130 +407,100 @@ def detect_new_devices():
         return new_devices_enriched[device_choice]['device']
 
 
-def flash_firmware_using_whatever_is_appropriate(firmware_obj: Firmware, baud:str, serial_port:str, erase_before_flash:bool) -> bool:
+def prepare_firmware_for_flashing(firmware_obj: Firmware) -> bool:
     # Initial checks
     if firmware_obj.family is None or firmware_obj is None:
         print("Must select the project, device family, and firmware to flash before flashing.")
         return False
 
-    print("Verifying firmware list is up-to-date before downloading...")
-    if not firmware_obj.pre_flash_web_verify(brewflasher_version=__version__, flasher="BrewFlasher CLI"):
+    # The firmware is verified against BrewFlasher.com while it downloads, rather than before, as neither depends on
+    # the other. Downloaded files are checksummed, so nothing is lost if the firmware then turns out to be outdated.
+    print("Downloading firmware & verifying firmware list is up-to-date...")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        verification = executor.submit(firmware_obj.pre_flash_web_verify, brewflasher_version=__version__,
+                                       flasher="BrewFlasher CLI")
+        downloaded = firmware_obj.download_to_file()
+
+    try:
+        verified = verification.result()
+    except Exception as e:
+        print(f"Unable to verify the firmware with BrewFlasher.com ({e}).")
+        verified = False
+    if not verified:
         print("Firmware list is not up to date. Relaunch BrewFlasher and try again.")
         return False
 
-    print("Downloading firmware...")
-    if not firmware_obj.download_to_file():
+    if not downloaded:
         print("Error - unable to download firmware.\n")
         return False
     print("Downloaded successfully!\n")
+    return True
 
-    if firmware_obj.family.flash_method == "esptool":
-        # Construct the command based on device family
-        device_name = firmware_obj.family.name
-        command_extension = []
-
-        if device_name in ["ESP32", "ESP32-S2", "ESP32-C3"]:
-            flash_options = {
-                "ESP32": ["esp32", "0x10000"],
-                "ESP32-S2": ["esp32s2", "-z", "--flash_mode", "dio", "--flash_freq", "80m", "0x10000"],
-                "ESP32-C3": ["esp32c3", "-z", "--flash_mode", "dio", "--flash_freq", "80m", "0x10000"]
-            }
-            command_extension.extend(["--chip", flash_options[device_name][0], "--baud", str(baud),
-                                      "--before", "default_reset", "--after", "hard_reset", "write_flash"])
-            command_extension.extend(flash_options[device_name][1:])
-            command_extension.append(firmware_obj.full_filepath("firmware"))
-
-            if firmware_obj.download_url_partitions and firmware_obj.checksum_partitions:
-                command_extension.extend(["0x8000", firmware_obj.full_filepath("partitions")])
-
-            if firmware_obj.family.download_url_bootloader and firmware_obj.family.checksum_bootloader:
-                boot_address = "0x0" if device_name == "ESP32-C3" else "0x1000"
-                command_extension.extend([boot_address, firmware_obj.full_filepath("bootloader")])
-
-        elif device_name == "ESP8266":
-            command_extension.extend(["--chip", "esp8266", "write_flash", "0x00000",
-                                      firmware_obj.full_filepath("firmware")])
-        else:
-            print("Invalid device family detected. Relaunch BrewFlasher and try again.")
-            return False
-
-        # For both ESP32 and ESP8266 we can directly flash an image to SPIFFS/LittleFS/OTAData
-        if firmware_obj.download_url_spiffs and firmware_obj.checksum_spiffs and len(firmware_obj.spiffs_address) > 2:
-            command_extension.append(firmware_obj.spiffs_address)
-            command_extension.append(firmware_obj.full_filepath("spiffs"))
-
-        if (firmware_obj.family.download_url_otadata and firmware_obj.family.checksum_otadata and
-                len(firmware_obj.family.otadata_address) > 2):
-            # We need to flash the otadata section. The location is dependent on the partition scheme
-            command_extension.append(firmware_obj.family.otadata_address)
-            command_extension.append(firmware_obj.full_filepath("otadata"))
-
-        # Construct the main command
-        command = ["--port", serial_port] + command_extension
-        if erase_before_flash:
-            command.extend(["--erase-all"])
-
-        # There is a breaking change in esptool 3.0 that changes the flash size from detect to keep. We want to
-        # support "detect" by default.
-        command.extend(["-fs", "detect"])
-
-        print(f"Esptool command: esptool.py {' '.join(command)}\n")
-
-    elif firmware_obj.family.flash_method == "avrdude":
-        command = [
-            "avrdude",
-            "-p", "atmega328p",
-            "-c", "arduino",
-            "-P", serial_port,
-            "-D",  # Disable auto erase - may want to make this configurable in the future
-            "-U", f"flash:w:{firmware_obj.full_filepath('firmware')}:i"
-        ]
-
-        print("Avrdude command: avrdude %s\n" % " ".join(command))
 
-    else:
-        raise ValueError("Invalid flash method detected. Update BrewFlasher and try again.")
-
-    # Handle 1200 bps touch for certain devices
-    if firmware_obj.family.use_1200_bps_touch:
-        try:
-            sleep(0.1)
-            print("Performing 1200 bps touch")
-            with serial.Serial(serial_port, baudrate=1200, timeout=5, write_timeout=0) as ser:
-                sleep(1.5)
-                print("...done\n")
-        except SerialException as e:
-            sleep(0.1)
-            print("\nUnable to perform 1200bps touch.")
-            print("Ensure correct serial port and try again or set device into 'flash' mode manually.")
-            print("Instructions: http://www.brewflasher.com/manualflash/")
-            raise e
+def flash_firmware_using_whatever_is_appropriate(firmware_obj: Firmware, baud:str, serial_port:str, erase_before_flash:bool,
+                                                 incremental: bool = False, merge_images: bool = False) -> bool:
+    if not prepare_firmware_for_flashing(firmware_obj):
+        return False
 
-    try:
-        if firmware_obj.family.flash_method == "esptool":
-            esptool.main(command)
-        elif firmware_obj.family.flash_method == "avrdude":
-            subprocess.run(command)
-    except SerialException as e:
-        sleep(0.1)
-        raise e
-    except Exception as e:
-        sleep(0.1)
-        print("Firmware flashing FAILED. esptool.py raised an error.")
-        print("")
-        print("Try flashing again, or try flashing with a slower speed.")
-        print("")
-        if firmware_obj.family.use_1200_bps_touch:
-            print("")
-            print("Alternatively, you may need to manually set the device into 'flash' mode.")
-            print("")
-            print("For instructions on how to do this, check this website:\nhttp://www.brewflasher.com/manualflash/")
+    flash_job = build_flash_job(firmware_obj, baud, erase_before_flash, incremental, merge_images)
+    if flash_job is None:
+        print("Invalid device family detected. Relaunch BrewFlasher and try again.")
         return False
 
-    # The last line printed by esptool is "Staying in bootloader." -> some indication that the process is
-    # done is needed
+    return run_flash_job(flash_job, serial_port)
+
+
+def flash_fleet_of_devices(firmware_obj: Firmware, baud: str, serial_ports: list, erase_before_flash: bool,
+                           max_workers: int = None, incremental: bool = False, merge_images: bool = False):
+    # Downloads & verifies the firmware once, and then flashes it to every device in serial_ports in parallel
+    # asyncio adds noticeably to startup time, so the engine is only imported when it is used
+    from brewflasher_cli.engine import DeviceJob, run_device_jobs
+
+    if len(serial_ports) == 0:
+        print("No serial ports matched --ports. Exiting.")
+        sys.exit(1)
+
+    print(f"Devices to flash: {', '.join(serial_ports)}")
+    obtain_user_confirmation(f"Do you want to flash {len(serial_ports)} device(s) with {firmware_obj}?")
+
+    print(f"Flashing {len(serial_ports)} device(s)...")
+    jobs = [DeviceJob(firmware_id=firmware_obj.id, serial_port=serial_port, baud=baud,
+                      erase_before_flash=erase_before_flash, incremental=incremental, merge_images=merge_images,
+                      firmware=firmware_obj) for serial_port in serial_ports]
+    results = run_device_jobs(jobs, max_flashes=max_workers, flasher_version=__version__)
+    for result in results:
+        if not result.success and result.output:
+            print(f"\n--- Output from {result.serial_port} ---\n{result.output}")
     print("")
-    print("Firmware successfully flashed. Reset device to switch back to normal boot mode.")
+    print(format_fleet_results(results))
+
+    firmware_obj.remove_downloaded_firmware()  # Clean up the downloaded firmware files
+    sys.exit(0 if all(result.success for result in results) else 1)
+
+
+def flash_devices_as_connected(firmware_obj: Firmware, baud: str, erase_before_flash: bool, max_workers: int,
+                               incremental: bool = False, merge_images: bool = False):
+    # Downloads the firmware once, and then flashes it to each matching device as soon as it is plugged in
+    if not prepare_firmware_for_flashing(firmware_obj):
+        sys.exit(1)
+
+    flash_job = build_flash_job(firmware_obj, baud, erase_before_flash, incremental, merge_images)
+    if flash_job is None:
+        print("Invalid device family detected. Relaunch BrewFlasher and try again.")
+        sys.exit(1)
+
+    detection_family = firmware_obj.family.detection_family
+    print(f"\nWaiting for {firmware_obj.family} devices to be connected. Each one will be flashed with {firmware_obj} "
+          f"as soon as it is detected.")
+    print("Devices that are already connected will be ignored. Press Ctrl+C to stop.\n")
+    results = run_production_line(flash_job, lambda port: serial_integration.is_candidate_port(port, detection_family),
+                                  max_workers)
+
+    if len(results) > 0:
+        print("")
+        print(format_fleet_results(results))
+    firmware_obj.remove_downloaded_firmware()  # Clean up the downloaded firmware files
+    sys.exit(0 if all(result.success for result in results) else 1)
 
 
 if __name__ == "__main__":
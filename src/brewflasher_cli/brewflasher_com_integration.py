@@ -1,15 +1,38 @@
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 import os.path
-from typing import Dict, List
-import requests
-import copy
+import tempfile
+import threading
+from time import perf_counter
+from typing import BinaryIO, Dict, List, Tuple
 import sys
-from . import fhash
+from . import fhash, mirror, tracing, transport
+from .binary_cache import get_binary_cache, is_cacheable
+from .catalog_cache import CatalogCache
+from .catalog_stream import NOT_LOADED, CatalogRows, intern_string, iter_json_array, slotted
+from .transport import DOWNLOAD_CHUNK_SIZE
+from .verify_cache import DEFAULT_VERIFY_MAX_AGE, get_verify_cache, verify_key
 
 
-BREWFLASHER_COM_URL = "https://www.brewflasher.com/firmware"
+# Can be pointed somewhere else using the BREWFLASHER_COM_URL environment variable (or --source) - either another
+# server (e.g. the stub server in benchmarks/) or a mirror on disk (see mirror.py)
+BREWFLASHER_COM_URL = os.environ.get("BREWFLASHER_COM_URL", "https://www.brewflasher.com/firmware")
 MODEL_VERSION = 3
 
+# The brewflasher.com endpoints that together make up the firmware catalog, keyed by the name used in load_timings
+CATALOG_ENDPOINTS = {
+    'projects': "/api/project_list/all/",
+    'families': "/api/firmware_family_list/",
+    'firmware': "/api/firmware_list/all/",
+}
+# The endpoints that are large enough to be worth parsing as they are streamed, rather than loading all at once
+STREAMED_CATALOG_ENDPOINTS = ('firmware',)
+# The attributes firmware can be searched by using FirmwareList.search_firmware
+SEARCH_FIELDS = ('project', 'family', 'version', 'variant', 'flash_method')
+# Long descriptive text that is only needed once a firmware has been selected, so it is left in the catalog (on disk)
+# until it is first accessed rather than being held in memory for every firmware
+LAZY_FIRMWARE_FIELDS = ("description", "variant_description", "post_install_instructions")
+
 
 @dataclass
 class DeviceFamily:
@@ -17,6 +40,8 @@ class DeviceFamily:
     flash_method: str = ""
     detection_family: str = ""
     id: int = 0
+    # Every firmware for this family - across all projects - in the order brewflasher.com lists it. Families are shared
+    # between projects, so use FirmwareList.get_project_firmware (or Project.firmware_ids) for a single project's.
     firmware: List['Firmware'] = field(default_factory=list)
     use_1200_bps_touch: bool = False
     download_url_bootloader: str = ""
@@ -39,12 +64,65 @@ class Project:
     project_url: str = ""
     documentation_url: str = ""
     show: str = ""  # TODO - Ditch this entirely
+    # The (shared) DeviceFamily objects that this project has firmware for, keyed by family id
     device_families: Dict[int, DeviceFamily] = field(default_factory=dict)
+    # The ids of this project's firmware for each device family, keyed by family id
+    firmware_ids: Dict[int, List[int]] = field(default_factory=dict)
 
     def __str__(self):
         return self.name
 
 
+class DownloadProgress:
+    """Tracks the combined progress of several parallel downloads, printing a running total to interactive terminals"""
+
+    REFRESH_INTERVAL = 0.5
+
+    def __init__(self):
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self._started_at = perf_counter()
+        self._stopped_at = None
+        self._done = threading.Event()
+        self._reporter = None
+
+    def add(self, num_bytes: int):
+        with self._lock:
+            self.bytes_received += num_bytes
+
+    @property
+    def elapsed(self) -> float:
+        return (self._stopped_at or perf_counter()) - self._started_at
+
+    def _describe(self) -> str:
+        elapsed = self.elapsed
+        throughput = self.bytes_received / elapsed if elapsed > 0 else 0
+        return "{:.1f} MB in {:.1f}s ({:.1f} MB/s)".format(self.bytes_received / 1e6, elapsed, throughput / 1e6)
+
+    def _report(self):
+        while not self._done.wait(self.REFRESH_INTERVAL):
+            print("\rDownloaded " + self._describe(), end="", flush=True)
+        print("\r", end="", flush=True)
+
+    def start(self):
+        self._started_at = perf_counter()
+        if sys.stdout.isatty():
+            self._reporter = threading.Thread(target=self._report, daemon=True)
+            self._reporter.start()
+
+    def stop(self):
+        self._stopped_at = perf_counter()
+        self._done.set()
+        if self._reporter is not None:
+            self._reporter.join()
+
+    def summary(self) -> str:
+        if self.bytes_received == 0:
+            return "All files were already downloaded."
+        return "Downloaded " + self._describe()
+
+
+@slotted(lazy_fields=LAZY_FIRMWARE_FIELDS)
 @dataclass
 class Firmware:
     name: str = ""
@@ -78,7 +156,8 @@ class Firmware:
         return str_rep
 
     @classmethod
-    def download_file(cls, full_path, url, checksum, check_checksum, force_download):
+    def download_file(cls, full_path, url, checksum, check_checksum, force_download,
+                      chunk_size: int = DOWNLOAD_CHUNK_SIZE, progress=None):
         if os.path.isfile(full_path):
             if force_download:  # If we're just going to force the download anyways, just kill the file
                 os.remove(full_path)
@@ -92,88 +171,155 @@ class Firmware:
         if len(url) < 12:  # If we don't have a URL, we can't download anything
             return False
 
-        # So either we don't have a downloaded copy (or it's invalid). Let's download a new one.
-        r = requests.get(url, stream=True)
-
-        with open(full_path, str("wb")) as f:
-            for chunk in r.iter_content():
-                f.write(chunk)
+        # So either we don't have a downloaded copy (or it's invalid). Let's download a new one. The file is streamed
+        # into a temporary file next to full_path and hashed as it arrives, so there is no need to read it back from
+        # disk to check the checksum. It is only moved into place once it has been confirmed to be valid.
+        fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(full_path) + ".", suffix=".part",
+                                         dir=os.path.dirname(full_path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                downloaded_checksum = transport.download(url, f, chunk_size=chunk_size, progress=progress)
 
-        # Now, let's check that the file is valid (but only if check_checksum is true)
-        if check_checksum:
-            if os.path.isfile(full_path):
-                # If the file already exists check the checksum (and delete if it fails)
-                if checksum != fhash.hash_of_file(full_path):
-                    os.remove(full_path)
-                    return False
-            else:
+            # Now, let's check that the file is valid (but only if check_checksum is true)
+            if check_checksum and checksum != downloaded_checksum:
                 return False
+
+            os.replace(temp_path, full_path)
+            fhash.remember_hash(full_path, downloaded_checksum)  # Saves rehashing the file the next time it's used
+        except transport.download_errors(url):
+            return False
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
         # The file is valid (or we aren't checking checksums). Return the path.
         return True
 
+    def part_checksum(self, bintype: str) -> str:
+        # Returns the expected sha256 checksum of the given part of this firmware (or "" if there isn't one)
+        if bintype == "firmware":
+            return self.checksum
+        elif bintype == "partitions":
+            return self.checksum_partitions
+        elif bintype == "spiffs":
+            return self.checksum_spiffs
+        elif bintype == "bootloader" and self.family is not None:
+            return self.family.checksum_bootloader
+        elif bintype == "otadata" and self.family is not None:
+            return self.family.checksum_otadata
+        return ""
+
     def full_filepath(self, bintype: str):
+        if is_cacheable(self.part_checksum(bintype)):
+            # Parts with a known checksum are stored in the (content-addressed) binary cache
+            return get_binary_cache().path_for(self.part_checksum(bintype))
+
         if getattr(sys, 'frozen', False):
             cur_filepath = os.path.dirname(os.path.realpath(sys._MEIPASS))
         else:
             cur_filepath = os.path.dirname(os.path.realpath(__file__))
         return os.path.join(cur_filepath, bintype + ".bin")
 
-    def download_to_file(self, check_checksum: bool = True, force_download: bool = False):
+    def parts_to_download(self) -> List[Tuple[str, str, str]]:
+        # Returns (bintype, description, url) for each part of this firmware that needs to be downloaded
+        parts = []
         # If this is a multipart firmware (e.g. ESP32, with partitions or SPIFFS) then download the additional parts.
         if len(self.download_url_partitions) > 12:
-            print("Downloading partitions file...")
-            if not self.download_file(self.full_filepath("partitions"), self.download_url_partitions,
-                                      self.checksum_partitions, check_checksum, force_download):
-                print("Error downloading partitions file!")
-                return False
-
+            parts.append(("partitions", "partitions", self.download_url_partitions))
         if len(self.download_url_spiffs) > 12 and len(self.spiffs_address) > 2:
-            print("Downloading SPIFFS/LittleFS file...")
-            if not self.download_file(self.full_filepath("spiffs"), self.download_url_spiffs,
-                                      self.checksum_spiffs, check_checksum, force_download):
-                print("Error downloading SPIFFS/LittleFS file!")
-                return False
-
+            parts.append(("spiffs", "SPIFFS/LittleFS", self.download_url_spiffs))
         if len(self.family.download_url_bootloader) > 12:
-            print("Downloading bootloader file...")
-            if not self.download_file(self.full_filepath("bootloader"), self.family.download_url_bootloader,
-                                      self.family.checksum_bootloader, check_checksum, force_download):
-                print("Error downloading bootloader file!")
-                return False
-
+            parts.append(("bootloader", "bootloader", self.family.download_url_bootloader))
         if len(self.family.download_url_otadata) > 12 and len(self.family.otadata_address) > 2:
-            print("Downloading otadata file...")
-            if not self.download_file(self.full_filepath("otadata"), self.family.download_url_otadata,
-                                      self.family.checksum_otadata, check_checksum, force_download):
-                print("Error downloading otadata file!")
-                return False
-
+            parts.append(("otadata", "otadata", self.family.download_url_otadata))
         # Always download the main firmware
-        print("Downloading main firmware file...")
-        return self.download_file(self.full_filepath("firmware"), self.download_url, self.checksum, check_checksum,
-                                  force_download)
+        parts.append(("firmware", "main firmware", self.download_url))
+        # URLs in a mirrored catalog are relative to the mirror
+        return [(bintype, description, mirror.resolve_url(url, BREWFLASHER_COM_URL))
+                for bintype, description, url in parts]
+
+    def download_to_file(self, check_checksum: bool = True, force_download: bool = False):
+        # All of the parts are downloaded in parallel. If any of them fail, the whole download fails - parts that did
+        # download stay in the binary cache (as they have been checksummed) but anything else gets cleaned up.
+        binary_cache = get_binary_cache()
+        parts = self.parts_to_download()
+        progress = DownloadProgress()
+
+        def download_part(bintype: str, url: str) -> bool:
+            with tracing.phase("download", part=bintype) as event:
+                def received(num_bytes: int):
+                    event.bytes += num_bytes
+                    progress.add(num_bytes)
+
+                event.success = self.download_file(self.full_filepath(bintype), url, self.part_checksum(bintype),
+                                                   check_checksum, force_download, progress=received)
+                event.detail['cached'] = event.success and event.bytes == 0
+                return event.success
+
+        print("Downloading {} file{}...".format(", ".join(description for _, description, _ in parts),
+                                               "s" if len(parts) > 1 else ""))
+        progress.start()
+        with ThreadPoolExecutor(max_workers=len(parts)) as executor:
+            futures = {bintype: executor.submit(download_part, bintype, url) for bintype, _, url in parts}
+        progress.stop()
+        fhash.save_memo()  # Once for every part, rather than as each one finishes
+
+        failed_parts = []
+        for bintype, description, _ in parts:
+            try:
+                downloaded = futures[bintype].result()
+            except Exception:
+                downloaded = False
+            if not downloaded:
+                failed_parts.append(description)
+            elif is_cacheable(self.part_checksum(bintype)):
+                binary_cache.record_use(self.part_checksum(bintype))
+
+        if len(failed_parts) > 0:
+            print("Error downloading {} file{}!".format(", ".join(failed_parts), "s" if len(failed_parts) > 1 else ""))
+            self.remove_downloaded_firmware()
+            return False
+
+        print(progress.summary())
+        # Now that everything we need is pinned, make room for it by removing anything that hasn't been used recently
+        binary_cache.evict()
+        return True
+
+    def pre_flash_web_verify(self, brewflasher_version, flasher="BrewFlasher",
+                             max_age: float = DEFAULT_VERIFY_MAX_AGE):
+        """Recheck that the checksum we have cached is still the one that brewflasher.com reports
 
-    def pre_flash_web_verify(self, brewflasher_version, flasher="BrewFlasher"):
-        """Recheck that the checksum we have cached is still the one that brewflasher.com reports"""
+        A successful check is remembered for max_age seconds (see verify_cache) - pass 0 to always ask brewflasher.com"""
+        key = verify_key(BREWFLASHER_COM_URL, self.id, self.checksum)
         request_dict = {
             'firmware_id': self.id,
             'flasher': flasher,
             'flasher_version': brewflasher_version
         }
         url = BREWFLASHER_COM_URL + "/api/flash_verify/"
-        r = requests.post(url, json=request_dict)
-        response = r.json()
-        if response['status'] == "success":
-            if response['message'] == self.checksum:
-                return True
-        return False
+        with tracing.phase("verify") as event:
+            if mirror.is_local_source(BREWFLASHER_COM_URL):
+                # A mirror on disk answers this itself, from the checksums recorded when it was synced
+                event.detail['source'] = "mirror"
+                event.success = mirror.mirrored_checksum(BREWFLASHER_COM_URL, self.id) == self.checksum
+            elif max_age > 0 and get_verify_cache().is_verified(key, max_age):
+                event.detail['source'] = "cache"
+            else:
+                event.detail['source'] = "network"
+                response = transport.post_json(url, request_dict)
+                event.success = response['status'] == "success" and response['message'] == self.checksum
+                if event.success and max_age > 0:
+                    get_verify_cache().record_verified(key, max_age)
+        return event.success
 
     def remove_downloaded_firmware(self):
-        """Delete the downloaded firmware files"""
+        """Delete the downloaded firmware files (other than those kept in the binary cache for reuse)"""
 
         firmware_types = ["bootloader", "firmware", "partitions", "spiffs", "otadata"]
 
         for firmware_type in firmware_types:
+            if is_cacheable(self.part_checksum(firmware_type)):
+                continue
             if os.path.exists(self.full_filepath(firmware_type)):
                 os.remove(self.full_filepath(firmware_type))
 
@@ -182,16 +328,98 @@ class Firmware:
 class FirmwareList:
     DeviceFamilies: Dict[int, DeviceFamily] = field(default_factory=dict)
     Projects: Dict[int, Project] = field(default_factory=dict)
-    # TODO - Double check valid_family_ids now that we support Arduino here
-    valid_family_ids: List[int] = field(default_factory=list)
+    Firmwares: Dict[int, Firmware] = field(default_factory=dict)
+    # Seconds spent fetching each of CATALOG_ENDPOINTS (plus building the catalog) during the last load_from_website
+    load_timings: Dict[str, float] = field(default_factory=dict)
+    # Where each of CATALOG_ENDPOINTS came from during the last load_from_website (see CatalogCache.fetch)
+    load_sources: Dict[str, str] = field(default_factory=dict)
+    # Why each of CATALOG_ENDPOINTS that couldn't be fetched during the last load_from_website failed
+    load_errors: Dict[str, str] = field(default_factory=dict)
+    catalog_cache: CatalogCache = field(default=None, repr=False, compare=False)
+    # Lookup indexes, built by build_indexes() once the catalog is loaded
+    _project_ids_by_name: Dict[str, int] = field(default_factory=dict, repr=False, compare=False)
+    _family_ids_by_name: Dict[Tuple[int, str], int] = field(default_factory=dict, repr=False, compare=False)
+    _firmware_by_name: Dict[Tuple[int, int, str], Firmware] = field(default_factory=dict, repr=False, compare=False)
+    _indexes_built: bool = field(default=False, repr=False, compare=False)
+    # The ids of the firmware with each (lowercased) value of each of SEARCH_FIELDS, built when first searched
+    _search_index: Dict[str, Dict[str, List[int]]] = field(default=None, repr=False, compare=False)
+    _searchable_firmware_ids: List[int] = field(default_factory=list, repr=False, compare=False)
 
     def __str__(self):
         return "Device Families"
 
-    def load_projects_from_website(self) -> bool:
-        url = BREWFLASHER_COM_URL + "/api/project_list/all/"
-        response = requests.get(url)
-        data = response.json()
+    def get_catalog_cache(self) -> CatalogCache:
+        if self.catalog_cache is None or self.catalog_cache.base_url != BREWFLASHER_COM_URL:
+            self.catalog_cache = CatalogCache(BREWFLASHER_COM_URL)
+        return self.catalog_cache
+
+    def open_catalog_endpoint(self, endpoint: str, max_catalog_age: float = None) -> (BinaryIO, str):
+        # As fetch_catalog_endpoint, but returns the endpoint's (unparsed) JSON as an open binary file
+        url = BREWFLASHER_COM_URL + CATALOG_ENDPOINTS[endpoint]
+        if mirror.is_local_source(BREWFLASHER_COM_URL):
+            return open(mirror.endpoint_file(mirror.local_path(BREWFLASHER_COM_URL), CATALOG_ENDPOINTS[endpoint]),
+                        "rb"), "mirror"
+        if max_catalog_age is not None:
+            try:
+                path, source = self.get_catalog_cache().fetch_path(endpoint, url, max_catalog_age)
+                return open(path, "rb"), source
+            except OSError:
+                pass  # e.g. the cache directory isn't writable - stream it straight from brewflasher.com instead
+
+        catalog_file = tempfile.TemporaryFile()
+        try:
+            transport.get_to_file(url, catalog_file)
+        except BaseException:
+            catalog_file.close()
+            raise
+        catalog_file.seek(0)
+        return catalog_file, "network"
+
+    def fetch_catalog_endpoint(self, endpoint: str, max_catalog_age: float = None, stream: bool = False):
+        # If max_catalog_age is None the on-disk catalog cache is bypassed entirely. If stream is set, an open binary
+        # file is returned (see open_catalog_endpoint) rather than the parsed data.
+        start = perf_counter()
+        url = BREWFLASHER_COM_URL + CATALOG_ENDPOINTS[endpoint]
+        with tracing.phase("catalog", part=endpoint) as event:
+            if stream:
+                data, source = self.open_catalog_endpoint(endpoint, max_catalog_age)
+            elif mirror.is_local_source(BREWFLASHER_COM_URL):
+                # A mirror on disk is already as fast as the catalog cache would be
+                data, source = mirror.read_endpoint(BREWFLASHER_COM_URL, CATALOG_ENDPOINTS[endpoint]), "mirror"
+            elif max_catalog_age is None:
+                data, source = transport.get_json(url), "network"
+            else:
+                data, source = self.get_catalog_cache().fetch(endpoint, url, max_catalog_age)
+            event.detail['source'] = source
+        self.load_timings[endpoint] = perf_counter() - start
+        self.load_sources[endpoint] = source
+        return data
+
+    def fetch_catalog(self, max_catalog_age: float = None, stream_endpoints=()) -> Dict[str, list] or None:
+        """Fetches every catalog endpoint in parallel. Returns None if any of them could not be loaded.
+
+        Endpoints in stream_endpoints are returned as open files to be parsed as they are read (see iter_json_array)."""
+        with ThreadPoolExecutor(max_workers=len(CATALOG_ENDPOINTS)) as executor:
+            futures = {endpoint: executor.submit(self.fetch_catalog_endpoint, endpoint, max_catalog_age,
+                                                 endpoint in stream_endpoints)
+                       for endpoint in CATALOG_ENDPOINTS}
+        catalog = {}
+        for endpoint, future in futures.items():
+            try:
+                catalog[endpoint] = future.result()
+            except Exception as e:
+                self.load_errors[endpoint] = (str(e).strip().splitlines() or [e.__class__.__name__])[0]
+        if len(self.load_errors) > 0:
+            for data in catalog.values():
+                if hasattr(data, "close"):
+                    data.close()  # A streamed endpoint that did open - nothing is going to read it now
+            return None
+        return catalog
+
+    def load_projects_from_website(self, data: list = None) -> bool:
+        self._indexes_built = False
+        if data is None:
+            data = self.fetch_catalog_endpoint('projects')
 
         if len(data) > 0:
             for row in data:
@@ -202,7 +430,7 @@ class FirmwareList:
                                           description=row['description'], support_url=row['support_url'],
                                           project_url=row['project_url'], documentation_url=row['documentation_url'],
                                           show=row['show_in_standalone_flasher'])
-                    self.Projects[row['id']] = copy.deepcopy(new_project)
+                    self.Projects[row['id']] = new_project
                 except:
                     print("\nUnable to load projects from BrewFlasher.com.")
                     print("Please check your internet connection and try launching BrewFlasher again.\nIf you continue "
@@ -212,13 +440,13 @@ class FirmwareList:
             return True
         return False  # We didn't get data back from Brewflasher.com, or there was an error
 
-    def load_families_from_website(self, load_esptool_only: bool = True) -> bool:
-        try:
-            url = BREWFLASHER_COM_URL + "/api/firmware_family_list/"
-            response = requests.get(url)
-            data = response.json()
-        except:
-            return False
+    def load_families_from_website(self, load_esptool_only: bool = True, data: list = None) -> bool:
+        self._indexes_built = False
+        if data is None:
+            try:
+                data = self.fetch_catalog_endpoint('families')
+            except:
+                return False
 
         if len(data) > 0:
             for row in data:
@@ -235,10 +463,9 @@ class FirmwareList:
                                               use_1200_bps_touch=row['use_1200_bps_touch'])
                     if new_family.flash_method != "esptool" and load_esptool_only:
                         continue  # Only save families that use esptool if this is BrewFlasher Desktop
-                    self.DeviceFamilies[new_family.id] = copy.deepcopy(new_family)
-                    self.valid_family_ids.append(new_family.id)
-                    for this_project in self.Projects:
-                        self.Projects[this_project].device_families[new_family.id] = copy.deepcopy(new_family)
+                    # Families are shared between projects - they get attached to a project in
+                    # load_firmware_from_website once we know that the project has firmware for them
+                    self.DeviceFamilies[new_family.id] = new_family
                 except:
                     print("\nUnable to load device families from BrewFlasher.com.")
                     print("Please check your internet connection and try launching BrewFlasher again.\nIf you continue "
@@ -248,51 +475,103 @@ class FirmwareList:
             return True
         return False  # We didn't get data back from Brewflasher.com, or there was an error
 
-    def load_firmware_from_website(self) -> bool:
-        # This is intended to be run after load_families_from_website
-        try:
-            url = BREWFLASHER_COM_URL + "/api/firmware_list/all/"
-            response = requests.get(url)
-            data = response.json()
-        except:
-            return False
+    def load_firmware_from_website(self, data: list = None, stream: BinaryIO = None) -> bool:
+        # This is intended to be run after load_families_from_website. The firmware list is by far the largest part of
+        # the catalog, so unless it is passed in as data it is parsed as it is streamed (from disk, or brewflasher.com)
+        self._indexes_built = False
+        if data is None and stream is None:
+            try:
+                stream = self.fetch_catalog_endpoint('firmware', stream=True)
+            except:
+                return False
 
-        if len(data) > 0:
-            # Then loop through the data we received and recreate it again
-            for row in data:
-                if row['family_id'] not in self.valid_family_ids:
+        if stream is not None:
+            catalog_rows = CatalogRows(stream)
+            rows = ((row, (catalog_rows, offset, length)) for row, offset, length in iter_json_array(stream))
+        else:
+            rows = ((row, None) for row in data)
+
+        loaded_rows = 0
+        new_firmware_list = []
+        parsed = False
+        try:
+            # Then loop through the data we received and recreate it again. Nothing is added to the catalog until every
+            # row has been parsed, so a list that turns out to be cut off part way through doesn't leave it half-filled.
+            for row, catalog_row in rows:
+                loaded_rows += 1
+                if row['family_id'] not in self.DeviceFamilies:
                     continue  # The family ID has been excluded (e.g. Arduino, and esptool only is selected)
+                if row['project_id'] not in self.Projects:
+                    continue  # The project failed to load (or doesn't exist)
 
+                # Values that are shared between firmware (e.g. versions, or a partition table used across a family)
+                # are interned so each is only held in memory once. When streaming, long descriptive text is left in
+                # the catalog on disk until it is needed (see LAZY_FIRMWARE_FIELDS).
+                text = {name: row[name] if catalog_row is None else NOT_LOADED for name in LAZY_FIRMWARE_FIELDS}
                 new_firmware = Firmware(
-                    name=row['name'], version=row['version'], family_id=row['family_id'],
-                    family=self.DeviceFamilies[row['family_id']],
-                    variant=row['variant'], is_fermentrack_supported=row['is_fermentrack_supported'],
-                    in_error=row['in_error'], description=row['description'],
-                    variant_description=row['variant_description'], download_url=row['download_url'],
-                    post_install_instructions=row['post_install_instructions'], weight=row['weight'],
-                    download_url_partitions=row['download_url_partitions'],
-                    download_url_spiffs=row['download_url_spiffs'], checksum=row['checksum'],
-                    checksum_partitions=row['checksum_partitions'], checksum_spiffs=row['checksum_spiffs'],
-                    spiffs_address=row['spiffs_address'], project_id=row['project_id'], id=row['id'],
+                    name=intern_string(row['name']), version=intern_string(row['version']),
+                    family_id=row['family_id'], family=self.DeviceFamilies[row['family_id']],
+                    variant=intern_string(row['variant']),
+                    is_fermentrack_supported=intern_string(row['is_fermentrack_supported']),
+                    in_error=intern_string(row['in_error']), download_url=row['download_url'],
+                    weight=intern_string(row['weight']),
+                    download_url_partitions=intern_string(row['download_url_partitions']),
+                    download_url_spiffs=intern_string(row['download_url_spiffs']), checksum=row['checksum'],
+                    checksum_partitions=intern_string(row['checksum_partitions']),
+                    checksum_spiffs=intern_string(row['checksum_spiffs']),
+                    spiffs_address=intern_string(row['spiffs_address']), project_id=row['project_id'], id=row['id'],
+                    **text
                 )
+                if catalog_row is not None:
+                    new_firmware._catalog_row = catalog_row
+
+                new_firmware_list.append(new_firmware)
+            parsed = True
+        except ValueError:
+            pass  # The firmware list was cut off or corrupt
+        finally:
+            if not parsed and stream is not None:
+                # Nothing will be read from the stream later on. If it was downloaded to a temporary file, closing it
+                # also deletes it.
+                stream.close()
+
+        if not parsed:
+            # If the firmware list came from the catalog cache, don't use that copy again
+            if self.catalog_cache is not None:
+                self.catalog_cache.invalidate('firmware')
+            return False
 
-                # Add the firmware to the appropriate DeviceFamily's list
-                self.DeviceFamilies[new_firmware.family_id].firmware.append(new_firmware)
-                self.Projects[new_firmware.project_id].device_families[new_firmware.family_id].firmware.append(
-                    new_firmware)
+        for new_firmware in new_firmware_list:
+            # Add the firmware to the appropriate DeviceFamily's list, and index it under its project
+            self.Firmwares[new_firmware.id] = new_firmware
+            new_firmware.family.firmware.append(new_firmware)
+            this_project = self.Projects[new_firmware.project_id]
+            this_project.device_families.setdefault(new_firmware.family_id, new_firmware.family)
+            this_project.firmware_ids.setdefault(new_firmware.family_id, []).append(new_firmware.id)
+
+        if loaded_rows > 0:
+            # Families get attached to projects in the order their firmware shows up - put them back in the order that
+            # brewflasher.com lists them in
+            family_order = {family_id: position for position, family_id in enumerate(self.DeviceFamilies)}
+            for this_project in self.Projects.values():
+                this_project.device_families = {
+                    family_id: this_project.device_families[family_id]
+                    for family_id in sorted(this_project.device_families, key=family_order.get)
+                }
 
             return True  # Firmware table is updated
         return False  # We didn't get data back from Brewflasher.com, or there was an error
 
     def cleanse_projects(self):
+        self._indexes_built = False
         for this_project_id in list(self.Projects):
             this_project = self.Projects[this_project_id]
             for this_device_family_id in list(
                     this_project.device_families):  # Iterate the list as we're deleting members
-                this_device_family = this_project.device_families[this_device_family_id]
-                if len(this_device_family.firmware) <= 0:
+                if len(this_project.firmware_ids.get(this_device_family_id, [])) <= 0:
                     # If there aren't any firmware instances in this device family, delete it
                     del this_project.device_families[this_device_family_id]
+                    this_project.firmware_ids.pop(this_device_family_id, None)
 
             # Once we've run through and cleaned up the device family list for this project, check if anything remains
             if len(this_project.device_families) <= 0:
@@ -300,15 +579,109 @@ class FirmwareList:
                 # Delete the project.
                 del self.Projects[this_project_id]
 
-    # We need to load everything in a specific order for it to work
-    def load_from_website(self, load_esptool_only: bool = True) -> bool:
-        if self.load_projects_from_website():
-            if self.load_families_from_website(load_esptool_only):
-                if self.load_firmware_from_website():
+    def get_project_firmware(self, project_id, family_id) -> List[Firmware]:
+        # Returns the firmware available for the given project & device family (or an empty list if there is none)
+        if project_id not in self.Projects:
+            return []
+        return [self.Firmwares[firmware_id] for firmware_id in
+                self.Projects[project_id].firmware_ids.get(family_id, [])]
+
+    # The endpoints are fetched concurrently, but we need to build everything in a specific order for it to work
+    def load_from_website(self, load_esptool_only: bool = True, max_catalog_age: float = None) -> bool:
+        self.load_timings = {}
+        self.load_sources = {}
+        self.load_errors = {}
+        catalog = self.fetch_catalog(max_catalog_age, stream_endpoints=STREAMED_CATALOG_ENDPOINTS)
+        if catalog is None:
+            return False
+
+        start = perf_counter()
+        if self.load_projects_from_website(catalog['projects']):
+            if self.load_families_from_website(load_esptool_only, catalog['families']):
+                if self.load_firmware_from_website(stream=catalog['firmware']):
                     self.cleanse_projects()
+                    self.build_indexes()
+                    self.load_timings['build'] = perf_counter() - start
                     return True
         return False
 
+    def build_indexes(self):
+        """(Re)builds the name-based lookup indexes used by get_project_id, get_device_family_id & get_firmware
+
+        This is called by load_from_website once the catalog is loaded (and by the lookups themselves, if the catalog
+        was loaded piece by piece). The indexes are only swapped in once complete, so a lookup on another thread never
+        sees a partly built one."""
+        project_ids_by_name = {}
+        family_ids_by_name = {}
+        firmware_by_name = {}
+
+        # setdefault is used throughout so that - as with a linear search - the first match wins if names are repeated
+        for this_project_id, this_project in self.Projects.items():
+            project_ids_by_name.setdefault(str(this_project), this_project_id)
+            for this_family_id, this_family in this_project.device_families.items():
+                family_ids_by_name.setdefault((this_project_id, str(this_family)), this_family_id)
+                for this_firmware in self.get_project_firmware(this_project_id, this_family_id):
+                    firmware_by_name.setdefault((this_project_id, this_family_id, str(this_firmware)), this_firmware)
+
+        self._project_ids_by_name = project_ids_by_name
+        self._family_ids_by_name = family_ids_by_name
+        self._firmware_by_name = firmware_by_name
+        self._search_index = None
+        self._indexes_built = True
+
+    def _ensure_indexes(self):
+        if not self._indexes_built:
+            self.build_indexes()
+
+    def _ensure_search_index(self):
+        # Only flashing needs the name-based indexes, so this is built separately - the first time something searches
+        self._ensure_indexes()
+        if self._search_index is not None:
+            return
+        self._search_index = {field_name: {} for field_name in SEARCH_FIELDS}
+        self._searchable_firmware_ids = []
+        for this_project_id, this_project in self.Projects.items():
+            for this_family_id, this_family in this_project.device_families.items():
+                for this_firmware in self.get_project_firmware(this_project_id, this_family_id):
+                    values = (str(this_project), str(this_family), this_firmware.version, this_firmware.variant,
+                              this_family.flash_method)
+                    for field_name, value in zip(SEARCH_FIELDS, values):
+                        self._search_index[field_name].setdefault(value.lower(), []).append(this_firmware.id)
+                    self._searchable_firmware_ids.append(this_firmware.id)
+
+    def search_firmware(self, project: str = None, family: str = None, version: str = None, variant: str = None,
+                        flash_method: str = None) -> List[Firmware]:
+        """Returns the firmware that matches every filter that was given (ignoring case), in the order they are listed
+        on brewflasher.com. With no filters, every firmware that can be flashed is returned."""
+        self._ensure_search_index()
+        filters = zip(SEARCH_FIELDS, (project, family, version, variant, flash_method))
+        id_lists = [self._search_index[field_name].get(value.lower(), []) for field_name, value in filters
+                    if value is not None]
+        if len(id_lists) == 0:
+            return [self.Firmwares[firmware_id] for firmware_id in self._searchable_firmware_ids]
+
+        # Walk the shortest list, checking each firmware against the rest
+        id_lists.sort(key=len)
+        other_ids = [set(ids) for ids in id_lists[1:]]
+        return [self.Firmwares[firmware_id] for firmware_id in id_lists[0]
+                if all(firmware_id in ids for ids in other_ids)]
+
+    def describe_load_timings(self) -> str:
+        descriptions = []
+        for name, seconds in self.load_timings.items():
+            if name in self.load_sources:
+                descriptions.append("{} {:.2f}s ({})".format(name, seconds, self.load_sources[name]))
+            else:
+                descriptions.append("{} {:.2f}s".format(name, seconds))
+        return ", ".join(descriptions)
+
+    def describe_load_errors(self) -> str:
+        return ", ".join("{}: {}".format(name, error) for name, error in self.load_errors.items())
+
+    def is_offline(self) -> bool:
+        # True if any part of the catalog had to be loaded from the cache because brewflasher.com was unreachable
+        return "offline" in self.load_sources.values()
+
     def get_project_list(self):
         available_projects = []
         for this_project_id in self.Projects:
@@ -319,10 +692,8 @@ class FirmwareList:
 
     def get_project_id(self, project_str) -> int or None:
         # Returns the id in self.Projects for the project with the selected name, or returns None if it cannot be found
-        for this_project_id in self.Projects:
-            if str(self.Projects[this_project_id]) == project_str:
-                return this_project_id
-        return None
+        self._ensure_indexes()
+        return self._project_ids_by_name.get(project_str)
 
     def get_device_family_id(self, project_id, device_family_str) -> int or None:
         # Returns the id in self.Projects for the project with the selected name, or returns None if it cannot be found
@@ -330,10 +701,8 @@ class FirmwareList:
             # The project_id was invalid - Return None
             return None
 
-        for this_family_id in self.Projects[project_id].device_families:
-            if str(self.Projects[project_id].device_families[this_family_id]) == device_family_str:
-                return this_family_id
-        return None
+        self._ensure_indexes()
+        return self._family_ids_by_name.get((project_id, device_family_str))
 
     def get_device_family_list(self, selected_project_id=None):
         if selected_project_id is None:  # We weren't given a project_id - return a blank list
@@ -348,6 +717,13 @@ class FirmwareList:
             available_devices = ["Unable to download device family list"]
         return available_devices
 
+    def get_device_family_ids_for_detection(self, project_id, detection_family) -> List[int]:
+        # Returns the ids of the project's device families that match a detected chip (e.g. "esp32s2")
+        if project_id not in self.Projects or not detection_family:
+            return []
+        return [family_id for family_id, family in self.Projects[project_id].device_families.items()
+                if family.detection_family == detection_family]
+
     def get_firmware_list(self, selected_project_id=None, selected_family_id=None):
         if selected_project_id is None:  # We weren't given a project_id - return a blank list
             return [""]
@@ -359,7 +735,7 @@ class FirmwareList:
             return [""]
         # Iterate over the list of device_families to populate the list
         available_firmware = []
-        for this_firmware in self.Projects[selected_project_id].device_families[selected_family_id].firmware:
+        for this_firmware in self.get_project_firmware(selected_project_id, selected_family_id):
             available_firmware.append(str(this_firmware))
         if len(available_firmware) == 0:
             available_firmware = ["Unable to download firmware list"]
@@ -373,11 +749,15 @@ class FirmwareList:
         if family_id not in self.Projects[project_id].device_families:
             # The family_id was invalid  - Return None
             return None
-        # Iterate through the list of firmware to find the appropriate one
-        for this_firmware in self.Projects[project_id].device_families[family_id].firmware:
-            if str(this_firmware) == firmware_str:
-                return this_firmware
-        return None
+        self._ensure_indexes()
+        return self._firmware_by_name.get((project_id, family_id, firmware_str))
+
+    def get_firmware_by_id(self, firmware_id) -> Firmware or None:
+        # Returns the Firmware with the given id (which may be passed as a string, e.g. from the command line)
+        try:
+            return self.Firmwares.get(int(firmware_id))
+        except (TypeError, ValueError):
+            return None
 
 
 if __name__ == "__main__":
@@ -0,0 +1,41 @@
+import os
+import sys
+import threading
+from typing import Iterable
+
+
+def user_cache_dir(*subdirs: str) -> str:
+    """Returns (and creates, if needed) a per-user BrewFlasher cache directory, optionally under subdirs
+
+    The location can be overridden by setting the BREWFLASHER_CACHE_DIR environment variable."""
+    base_dir = os.environ.get("BREWFLASHER_CACHE_DIR", "")
+    if not base_dir:
+        if sys.platform == "win32":
+            base_dir = os.path.join(os.environ.get("LOCALAPPDATA", os.path.expanduser("~")), "BrewFlasher", "Cache")
+        elif sys.platform == "darwin":
+            base_dir = os.path.join(os.path.expanduser("~"), "Library", "Caches", "BrewFlasher")
+        else:
+            base_dir = os.path.join(os.environ.get("XDG_CACHE_HOME", "") or os.path.expanduser("~/.cache"),
+                                    "brewflasher")
+
+    path = os.path.join(base_dir, *subdirs)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def write_file_atomically(path: str, contents: bytes):
+    """Writes contents to path such that concurrent readers see either the old file or the new one - never a mix"""
+    write_chunks_atomically(path, [contents])
+
+
+def write_chunks_atomically(path: str, chunks: Iterable[bytes]):
+    """As write_file_atomically, but writes each of chunks as it arrives (e.g. a response that is being streamed)"""
+    temp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(temp_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
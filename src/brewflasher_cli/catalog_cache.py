@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import threading
+from dataclasses import dataclass
+from time import time
+
+from . import transport
+from .cache_dir import user_cache_dir, write_chunks_atomically, write_file_atomically
+
+
+# How long (in seconds) a cached catalog is used as-is before it is revalidated against brewflasher.com
+DEFAULT_MAX_CATALOG_AGE = 5 * 60
+# How long (in seconds) past DEFAULT_MAX_CATALOG_AGE a stale catalog can still be used immediately while it is
+# revalidated in the background. Past this point we wait for the revalidation to complete before continuing.
+STALE_WHILE_REVALIDATE = 24 * 60 * 60
+
+
+def load_json_file(path: str):
+    with open(path, "rb") as f:
+        return json.loads(f.read().decode("utf-8"))
+
+
+@dataclass
+class CachedEndpoint:
+    path: str  # The cached response body (the catalog data, as JSON)
+    etag: str = ""
+    last_modified: str = ""
+    fetched_at: float = 0.0
+
+    @property
+    def age(self) -> float:
+        return time() - self.fetched_at
+
+
+class CatalogCache:
+    """On-disk copy of the brewflasher.com catalog endpoints, along with the validators needed to revalidate them"""
+
+    def __init__(self, base_url: str, directory: str = None):
+        self.base_url = base_url
+        # Catalogs from different sources (e.g. a local mirror vs. brewflasher.com) are cached separately
+        self.directory = directory or user_cache_dir("catalog", hashlib.sha1(base_url.encode()).hexdigest()[:12])
+        self.refresh_threads = []
+
+    def _data_path(self, endpoint: str) -> str:
+        return os.path.join(self.directory, endpoint + ".json")
+
+    def _meta_path(self, endpoint: str) -> str:
+        return os.path.join(self.directory, endpoint + ".meta.json")
+
+    def read(self, endpoint: str) -> CachedEndpoint or None:
+        # The data itself isn't read here - the firmware list is large enough that it is parsed as it is streamed from
+        # disk rather than loaded all at once (see FirmwareList.load_firmware_from_website)
+        try:
+            with open(self._meta_path(endpoint), "r") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None  # Either we don't have a cached copy, or it's corrupt - either way, treat it as a cache miss
+        if not os.path.isfile(self._data_path(endpoint)):
+            return None
+        return CachedEndpoint(path=self._data_path(endpoint), etag=meta.get('etag', ""),
+                              last_modified=meta.get('last_modified', ""), fetched_at=meta.get('fetched_at', 0.0))
+
+    def _write_meta(self, endpoint: str, etag: str, last_modified: str):
+        meta = {'url': self.base_url, 'etag': etag, 'last_modified': last_modified, 'fetched_at': time()}
+        write_file_atomically(self._meta_path(endpoint), json.dumps(meta).encode("utf-8"))
+
+    def invalidate(self, endpoint: str):
+        """Drops the cached copy of endpoint (e.g. because it turned out to be corrupt), so it is fetched again"""
+        # The metadata goes first - without it, whatever is left of the data is never used
+        for path in (self._meta_path(endpoint), self._data_path(endpoint)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def revalidate(self, endpoint: str, url: str, cached: CachedEndpoint = None, background: bool = False) -> str:
+        """Conditionally fetches url, updating the cache. Returns the path of the (possibly unchanged) catalog data.
+
+        The response is streamed straight to disk, so it is never held in memory in its entirety. See
+        transport.get_conditional for background."""
+        if cached is None:
+            response = transport.get_conditional(url, stream=True, background=background)
+        else:
+            response = transport.get_conditional(url, cached.etag, cached.last_modified, stream=True,
+                                                 background=background)
+
+        with response:
+            if response.status_code == 304 and cached is not None:
+                try:
+                    self._write_meta(endpoint, cached.etag, cached.last_modified)
+                except OSError:
+                    pass
+                return cached.path
+
+            # The data gets written before the metadata, so an interrupted write can't mark an old payload as fresh
+            write_chunks_atomically(self._data_path(endpoint),
+                                    response.iter_content(chunk_size=transport.DOWNLOAD_CHUNK_SIZE))
+        try:
+            self._write_meta(endpoint, response.headers.get("ETag", ""), response.headers.get("Last-Modified", ""))
+        except OSError:
+            pass  # We'll just fetch it again next time
+        return self._data_path(endpoint)
+
+    def _revalidate_in_background(self, endpoint: str, url: str, cached: CachedEndpoint):
+        import requests
+
+        def refresh():
+            try:
+                self.revalidate(endpoint, url, cached, background=True)
+            except (requests.RequestException, OSError, ValueError):
+                pass  # We'll try again next time
+
+        # A daemon thread, so that a slow or unreachable brewflasher.com can't stop us from exiting. The data is written
+        # atomically, so a refresh that is cut short leaves the cached copy as it was.
+        refresh_thread = threading.Thread(target=refresh, name="catalog-refresh-" + endpoint, daemon=True)
+        refresh_thread.start()
+        self.refresh_threads.append(refresh_thread)
+
+    def fetch(self, endpoint: str, url: str, max_age: float = DEFAULT_MAX_CATALOG_AGE) -> (list, str):
+        """Returns the data for endpoint, along with where it came from (see fetch_path)"""
+        path, source = self.fetch_path(endpoint, url, max_age)
+        try:
+            return load_json_file(path), source
+        except ValueError:
+            # The cached copy is corrupt - drop it and try again, this time from brewflasher.com
+            self.invalidate(endpoint)
+            path, source = self.fetch_path(endpoint, url, max_age)
+            return load_json_file(path), source
+
+    def fetch_path(self, endpoint: str, url: str, max_age: float = DEFAULT_MAX_CATALOG_AGE) -> (str, str):
+        """Returns the path of the cached data for endpoint, along with where it came from ("cache", "stale",
+        "offline" or "network")
+
+        A cached copy younger than max_age is returned without touching the network. A copy that is stale (but within
+        the STALE_WHILE_REVALIDATE window) is returned immediately while it is revalidated in the background. Anything
+        older is revalidated before returning, falling back to the cached copy if brewflasher.com can't be reached."""
+        cached = self.read(endpoint)
+
+        if cached is not None and max_age > 0:
+            if cached.age <= max_age:
+                return cached.path, "cache"
+            if cached.age <= max_age + STALE_WHILE_REVALIDATE:
+                self._revalidate_in_background(endpoint, url, cached)
+                return cached.path, "stale"
+
+        import requests
+
+        try:
+            return self.revalidate(endpoint, url, cached), "network"
+        except (requests.RequestException, OSError):
+            if cached is None:
+                raise
+            return cached.path, "offline"
+
+    def wait_for_refresh(self, timeout: float = None):
+        for refresh_thread in self.refresh_threads:
+            refresh_thread.join(timeout)
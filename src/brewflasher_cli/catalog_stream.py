@@ -0,0 +1,161 @@
+import codecs
+import json
+import re
+import sys
+import threading
+from dataclasses import fields
+from typing import BinaryIO, Iterator, Tuple
+
+
+# The firmware catalog is read from disk in chunks of this size, so it never has to be held in memory all at once
+STREAM_CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = re.compile(r"[ \t\r\n]*")
+
+
+def iter_json_array(fileobj: BinaryIO, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[Tuple[object, int, int]]:
+    """Parses the JSON array in fileobj one element at a time, yielding (element, byte offset, length in bytes)
+
+    Only the element being parsed (plus up to a chunk of the file) is held in memory at once, rather than the entire
+    document and everything in it as with json.load(). The offset and length can be used to read the element back
+    out of the file later (see CatalogRows). Raises ValueError if fileobj doesn't contain a valid JSON array."""
+    scan_once = json.JSONDecoder().scan_once
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0  # Index in buffer of the next character to be parsed
+    byte_offset = 0  # Offset in the file of buffer[position]
+    at_eof = False
+    # While everything read so far is ASCII, characters and bytes line up, so lengths don't need to be re-encoded
+    all_ascii = True
+
+    def read_more() -> bool:
+        nonlocal buffer, position, at_eof, all_ascii
+        if at_eof:
+            return False
+        chunk = fileobj.read(chunk_size)
+        at_eof = len(chunk) == 0
+        text = text_decoder.decode(chunk, final=at_eof)
+        all_ascii = all_ascii and len(text) == len(chunk)
+        buffer = buffer[position:] + text
+        position = 0
+        return True
+
+    def next_character() -> str:
+        # Skips any whitespace, returning the next character (or "" at the end of the file)
+        nonlocal position, byte_offset
+        while True:
+            skipped = _WHITESPACE.match(buffer, position).end() - position
+            position += skipped
+            byte_offset += skipped
+            if position < len(buffer):
+                return buffer[position]
+            if not read_more():
+                return ""
+
+    if next_character() != "[":
+        raise ValueError("Expected a JSON array")
+    position += 1
+    byte_offset += 1
+    if next_character() == "]":
+        return
+
+    while True:
+        next_character()
+        while True:
+            # The scanner can't tell us if an element has been cut off at the end of the buffer (e.g. 12 of 123), so
+            # only trust it once there is something after the element - or there is nothing more to read
+            try:
+                element, end = scan_once(buffer, position)
+                if end < len(buffer) or at_eof:
+                    break
+            except (StopIteration, ValueError):
+                if at_eof:
+                    raise ValueError("Invalid JSON at byte {} of the JSON array".format(byte_offset)) from None
+            read_more()
+
+        length = end - position if all_ascii else len(buffer[position:end].encode("utf-8"))
+        yield element, byte_offset, length
+        position = end
+        byte_offset += length
+
+        # Elements are almost always followed directly by a comma, so check for that before skipping any whitespace
+        separator = buffer[position] if position < len(buffer) else ""
+        if separator != ",":
+            separator = next_character()
+        if separator == "]":
+            return
+        if separator != ",":
+            raise ValueError("Expected ',' or ']' at byte {} of the JSON array".format(byte_offset))
+        position += 1
+        byte_offset += 1
+
+
+class CatalogRows:
+    """An open copy of a catalog endpoint, that rows can be read back out of by the offsets from iter_json_array"""
+
+    def __init__(self, fileobj: BinaryIO):
+        self._file = fileobj
+        self._lock = threading.Lock()
+
+    def read(self, offset: int, length: int) -> dict:
+        with self._lock:
+            self._file.seek(offset)
+            return json.loads(self._file.read(length).decode("utf-8"))
+
+    def close(self):
+        self._file.close()
+
+
+# Placeholder for the value of a LazyField that hasn't been read from the catalog yet
+NOT_LOADED = object()
+
+
+class LazyField:
+    """A field of a slotted dataclass that - if set to NOT_LOADED - is only read from the catalog when first accessed
+
+    The record's _catalog_row must be set to (CatalogRows, offset, length) for the row the record was built from. The
+    rest of the record's lazy fields are loaded at the same time, as they tend to be wanted together."""
+
+    def __init__(self, name: str, slot, lazy_fields: Tuple[str, ...]):
+        self.name = name
+        self._slot = slot  # The member descriptor for the slot the value is actually stored in
+        self._lazy_fields = lazy_fields
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        value = self._slot.__get__(instance, owner)
+        if value is NOT_LOADED:
+            rows, offset, length = instance._catalog_row
+            row = rows.read(offset, length)
+            for name in self._lazy_fields:
+                if getattr(type(instance), name)._slot.__get__(instance, owner) is NOT_LOADED:
+                    setattr(instance, name, row.get(name, ""))
+            value = self._slot.__get__(instance, owner)
+        return value
+
+    def __set__(self, instance, value):
+        self._slot.__set__(instance, value)
+
+
+def slotted(cls=None, lazy_fields: Tuple[str, ...] = ()):
+    """Class decorator that gives a dataclass __slots__ - as @dataclass(slots=True) does on Python 3.10+ - making each
+    instance a good deal smaller. Any lazy_fields are made LazyFields. Must be applied above @dataclass."""
+    def wrap(cls):
+        field_names = [f.name for f in fields(cls)]
+        cls_dict = {key: value for key, value in cls.__dict__.items()
+                    if key not in field_names and key not in ("__dict__", "__weakref__")}
+        cls_dict['__slots__'] = tuple(name for name in field_names if name not in lazy_fields) + \
+            tuple("_lazy_" + name for name in lazy_fields) + (("_catalog_row",) if lazy_fields else ())
+        slotted_cls = type(cls)(cls.__name__, cls.__bases__, cls_dict)
+        for name in lazy_fields:
+            setattr(slotted_cls, name, LazyField(name, slotted_cls.__dict__["_lazy_" + name], lazy_fields))
+        return slotted_cls
+
+    return wrap if cls is None else wrap(cls)
+
+
+def intern_string(value):
+    # Catalog values that repeat across firmware (names, versions, shared partition tables, etc.) are interned so that
+    # each distinct value is only held in memory once
+    return sys.intern(value) if type(value) is str else value
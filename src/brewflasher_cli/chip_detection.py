@@ -0,0 +1,104 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List
+
+from . import serial_integration
+
+
+# Baud rate used to talk to the ROM bootloader while identifying a chip. Every ESP chip syncs reliably at this speed.
+PROBE_BAUD = 115200
+PROBE_CONNECT_ATTEMPTS = 2
+
+
+@dataclass
+class ChipInfo:
+    serial_port: str
+    # The DeviceFamily.detection_family this device belongs to (e.g. "esp32s2"), or "" if it couldn't be identified
+    detection_family: str = ""
+    chip_name: str = ""
+    mac: str = ""
+    flash_size: str = ""
+    error: str = ""
+
+    def __str__(self):
+        if not self.detection_family:
+            return "{}: unidentified ({})".format(self.serial_port, self.error or "no response")
+        details = [self.chip_name or self.detection_family]
+        if self.mac:
+            details.append("MAC " + self.mac)
+        if self.flash_size:
+            details.append(self.flash_size + " flash")
+        return "{}: {}".format(self.serial_port, ", ".join(details))
+
+
+def detection_family_for_chip(chip_name: str) -> str:
+    # esptool's chip names (e.g. "ESP32-S2") map onto BrewFlasher's detection families (e.g. "esp32s2")
+    return chip_name.lower().replace("-", "")
+
+
+def probe_chip(serial_port: str, baud: int = PROBE_BAUD) -> ChipInfo:
+    """Resets the device on serial_port into its ROM bootloader and asks it what chip it is"""
+    from esptool.cmds import detect_chip, DETECTED_FLASH_SIZES
+
+    info = ChipInfo(serial_port=serial_port)
+    try:
+        esp = detect_chip(serial_port, baud, connect_attempts=PROBE_CONNECT_ATTEMPTS)
+    except Exception as e:
+        # esptool's errors can span several lines (with hints) - the first line is enough here
+        info.error = (str(e).strip().splitlines() or [e.__class__.__name__])[0]
+        return info
+
+    try:
+        info.chip_name = esp.CHIP_NAME
+        info.detection_family = detection_family_for_chip(esp.CHIP_NAME)
+        try:
+            info.mac = ":".join("{:02x}".format(b) for b in esp.read_mac())
+            # The top byte of the flash ID encodes the size of the flash chip
+            info.flash_size = DETECTED_FLASH_SIZES.get(esp.flash_id() >> 16, "")
+        except Exception:
+            pass  # The chip type is what matters - the rest is just nice to show the user
+    finally:
+        try:
+            esp.hard_reset()
+        except Exception:
+            pass
+        esp._port.close()
+    return info
+
+
+def identify_port(port, probe: bool = True) -> ChipInfo:
+    """Identifies the device on port (a ListPortInfo), from its vid/pid if that's unambiguous or by probing it"""
+    families = serial_integration.families_for_device(port.vid, port.pid, include_generic=False)
+    if len(families) == 1:
+        return ChipInfo(serial_port=port.device, detection_family=families[0],
+                        chip_name=serial_integration.check_known_devices(families[0], port.pid, port.vid)['name'])
+    if not probe:
+        return ChipInfo(serial_port=port.device, error="ambiguous USB-serial chip")
+    return probe_chip(port.device)
+
+
+def candidate_ports(serial_ports: List[str] = None) -> List:
+    """Returns the ListPortInfo of every USB serial port that could be a flashable device (limited to serial_ports)"""
+    from serial.tools.list_ports_common import ListPortInfo
+
+    ports = []
+    for port in serial_integration.comports():
+        if serial_ports and port.device not in serial_ports:
+            continue
+        if port.vid is None and not serial_ports:
+            continue  # Not a USB device (e.g. a built-in UART)
+        ports.append(port)
+
+    # Ports that were asked for by name but that pyserial doesn't list (e.g. pseudo-terminals) can still be probed
+    for serial_port in serial_ports or []:
+        if not any(port.device == serial_port for port in ports):
+            ports.append(ListPortInfo(serial_port))
+    return ports
+
+
+def identify_devices(ports: List) -> List[ChipInfo]:
+    """Identifies the devices on several ports in parallel (probing each of them where needed)"""
+    if len(ports) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=len(ports)) as executor:
+        return list(executor.map(identify_port, ports))
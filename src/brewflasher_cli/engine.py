@@ -0,0 +1,336 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field, replace
+from time import perf_counter
+from typing import Dict, List
+
+from . import tracing, transport
+from .brewflasher_com_integration import Firmware, FirmwareList
+from .catalog_cache import DEFAULT_MAX_CATALOG_AGE
+from .fleet import FleetResult, flash_worker
+from .flashing import FlashJob, build_flash_job, perform_1200bps_touch, uses_native_programmer
+from .stk500 import AVR_PARTS, program_avr
+
+
+# The stages each DeviceJob goes through, in order. verify and download run at the same time.
+STAGES = ("lookup", "verify", "download", "touch", "flash")
+# How long (in seconds) each stage can take before the job is failed. None means no limit.
+DEFAULT_STAGE_TIMEOUTS = {
+    'lookup': 60,
+    'verify': 60,
+    'download': 10 * 60,
+    'touch': 15,
+    'flash': 10 * 60,
+}
+# Most devices flashed at once using the built-in STK500 programmer (each uses a thread) if max_flashes isn't set
+MAX_NATIVE_FLASHES = 64
+# Most devices flashed at once by frozen builds (each uses a worker process) if max_flashes isn't set
+MAX_FLASH_PROCESSES = 16
+# The parent of the brewflasher_cli package, so flash subprocesses can import it even when it isn't installed
+_PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@dataclass
+class DeviceJob:
+    """A request to flash one firmware (from the catalog) to the device on one serial port"""
+    firmware_id: int
+    serial_port: str
+    baud: str
+    erase_before_flash: bool
+    incremental: bool = False
+    merge_images: bool = False
+    # If the firmware has already been looked up (e.g. it was selected interactively), it is used as-is
+    firmware: Firmware = field(default=None, repr=False)
+
+
+@dataclass
+class DeviceJobResult(FleetResult):
+    firmware_id: int = 0
+    # The stage that failed (or "" if the job succeeded)
+    failed_stage: str = ""
+    # Seconds spent in each stage the job reached
+    stage_durations: Dict[str, float] = field(default_factory=dict)
+    cancelled: bool = False
+
+
+class StageFailed(Exception):
+    def __init__(self, stage: str, message: str):
+        super().__init__("{} failed: {}".format(stage, message))
+        self.stage = stage
+
+
+class FlashEngine:
+    """Runs DeviceJobs as pipelines of stages (see STAGES), with any number of jobs sharing one event loop
+
+    Network work (loading the catalog, verifying & downloading firmware) runs on a thread pool and is shared between
+    jobs for the same firmware, so it overlaps with devices that are already flashing. Each flash runs esptool/avrdude
+    in its own subprocess, which is killed if the job times out or is cancelled. Arduino devices that the built-in
+    STK500 programmer can flash are flashed on a thread instead, which stops after the current page when cancelled.
+    Other stages that run on threads can't be interrupted, so when they time out the job fails straight away but the
+    thread is left to finish in the background.
+
+    Use as an async context manager, or call close() once finished:
+
+        async with FlashEngine() as engine:
+            results = await engine.run_jobs(jobs)
+    """
+
+    def __init__(self, firmware_list: FirmwareList = None, max_catalog_age: float = DEFAULT_MAX_CATALOG_AGE,
+                 stage_timeouts: Dict[str, float] = None, max_flashes: int = None, flasher_version: str = "",
+                 flasher: str = "BrewFlasher CLI"):
+        self.firmware_list = firmware_list
+        self.max_catalog_age = max_catalog_age
+        self.stage_timeouts = dict(DEFAULT_STAGE_TIMEOUTS, **(stage_timeouts or {}))
+        self.max_flashes = max_flashes
+        self.flasher_version = flasher_version
+        self.flasher = flasher
+        self._executor = ThreadPoolExecutor(max_workers=transport.POOL_SIZE, thread_name_prefix="engine")
+        # Kept apart from _executor so that a large batch of devices being flashed can't hold up downloads
+        self._flash_executor = ThreadPoolExecutor(max_workers=max_flashes or MAX_NATIVE_FLASHES,
+                                                  thread_name_prefix="flash")
+        # Worker processes used by frozen builds to flash, created on first use (see _flash_in_process)
+        self._process_executor = None
+        # Work shared between jobs (loading the catalog, and verifying/downloading each firmware), keyed by what it is
+        self._shared = {}  # type: Dict[tuple, asyncio.Future]
+        # asyncio primitives are bound to the event loop they are created in, so these are created on first use
+        self._flash_slots = None  # type: asyncio.Semaphore
+        self._port_locks = {}  # type: Dict[str, asyncio.Lock]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self._flash_executor.shutdown(wait=False)
+        if self._process_executor is not None:
+            if sys.version_info >= (3, 9):
+                # Flashes that are still queued are dropped, rather than being started after we've finished
+                self._process_executor.shutdown(wait=False, cancel_futures=True)
+            else:
+                self._process_executor.shutdown(wait=False)
+
+    async def _in_thread(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    async def _once(self, key: tuple, function, *args):
+        # Runs function on a thread the first time key is asked for, with everyone else waiting on the same result.
+        # The shared work is shielded, so one job being cancelled doesn't cancel it for the others.
+        if key not in self._shared:
+            self._shared[key] = asyncio.ensure_future(self._in_thread(function, *args))
+        return await asyncio.shield(self._shared[key])
+
+    async def _stage(self, result: DeviceJobResult, stage: str, awaitable):
+        start = perf_counter()
+        try:
+            return await asyncio.wait_for(awaitable, self.stage_timeouts.get(stage))
+        except asyncio.TimeoutError:
+            raise StageFailed(stage, "timed out after {}s".format(self.stage_timeouts[stage])) from None
+        finally:
+            result.stage_durations[stage] = perf_counter() - start
+
+    async def get_firmware_list(self) -> FirmwareList:
+        """Returns the catalog, loading it (once, however many jobs ask for it) if it wasn't passed in"""
+        if self.firmware_list is None:
+            firmware_list = await self._once(("catalog",), self._load_firmware_list)
+            if firmware_list is None:
+                self._shared.pop(("catalog",), None)  # Let the next job try again
+                raise StageFailed("lookup", "unable to load the firmware list")
+            self.firmware_list = firmware_list
+        return self.firmware_list
+
+    def _load_firmware_list(self) -> FirmwareList or None:
+        firmware_list = FirmwareList()
+        if not firmware_list.load_from_website(load_esptool_only=False, max_catalog_age=self.max_catalog_age):
+            return None
+        return firmware_list
+
+    async def lookup(self, job: DeviceJob) -> Firmware:
+        if job.firmware is not None:
+            return job.firmware
+        firmware = (await self.get_firmware_list()).get_firmware_by_id(job.firmware_id)
+        if firmware is None or firmware.family is None:
+            raise StageFailed("lookup", "firmware {} isn't in the firmware list".format(job.firmware_id))
+        return firmware
+
+    async def verify(self, firmware: Firmware):
+        try:
+            verified = await self._once(("verify", firmware.id), firmware.pre_flash_web_verify, self.flasher_version,
+                                        self.flasher)
+        except Exception as e:
+            self._shared.pop(("verify", firmware.id), None)  # Let the next job try again
+            raise StageFailed("verify", "unable to verify the firmware with BrewFlasher.com ({})".format(e)) from None
+        if not verified:
+            raise StageFailed("verify", "the firmware list is out of date")
+
+    async def download(self, firmware: Firmware):
+        if not await self._once(("download", firmware.id), firmware.download_to_file):
+            self._shared.pop(("download", firmware.id), None)  # Let the next job try again
+            raise StageFailed("download", "unable to download the firmware")
+
+    async def touch(self, serial_port: str) -> str:
+        """Resets the device on serial_port into its bootloader. Returns the port to flash."""
+        try:
+            return await self._in_thread(perform_1200bps_touch, serial_port)
+        except Exception as e:
+            raise StageFailed("touch", str(e) or e.__class__.__name__) from None
+
+    def _flash_natively(self, flash_job: FlashJob, serial_port: str, cancelled: threading.Event) -> FleetResult:
+        # Runs on a thread, so output is collected from the programmer rather than by redirecting stdout (which would
+        # capture every other thread's output too). The flash phase is recorded directly, so there are no events to
+        # pass back.
+        result = FleetResult(serial_port=serial_port)
+        output = []
+        part = AVR_PARTS[flash_job.avr_part]
+        start = perf_counter()
+        try:
+            with tracing.phase("flash", serial_port=serial_port, method=part.protocol, baud=str(part.baud)) as event:
+                event.bytes = program_avr(serial_port, part, flash_job.regions[0][1], log=output.append,
+                                          cancelled=cancelled)
+            result.success = True
+        except Exception as e:
+            result.error = str(e) or e.__class__.__name__
+        result.duration = perf_counter() - start
+        result.output = "".join(line + "\n" for line in output)
+        return result
+
+    async def flash(self, flash_job: FlashJob, serial_port: str) -> FleetResult:
+        """Flashes flash_job in a subprocess (killing it if this is cancelled), returning what it printed & timed"""
+        if uses_native_programmer(flash_job):
+            cancelled = threading.Event()
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self._flash_executor, self._flash_natively,
+                                                                        flash_job, serial_port, cancelled)
+            except BaseException:  # Including cancellation - stop the programmer at the next page
+                cancelled.set()
+                raise
+
+        if getattr(sys, 'frozen', False):
+            return await self._flash_in_process(flash_job, serial_port)
+
+        environment = dict(os.environ)
+        environment['PYTHONPATH'] = os.pathsep.join(filter(None, [_PACKAGE_ROOT, environment.get('PYTHONPATH')]))
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "brewflasher_cli.engine", stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, env=environment)
+        request = json.dumps({'job': asdict(flash_job), 'serial_port': serial_port}).encode("utf-8")
+        try:
+            stdout, stderr = await process.communicate(request)
+        except BaseException:  # Including cancellation (and timeouts, which cancel us)
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+
+        try:
+            response = json.loads(stdout.decode("utf-8"))
+        except ValueError:
+            return FleetResult(serial_port=serial_port, error="flash process exited with status {}".format(
+                process.returncode), output=stderr.decode("utf-8", "replace"))
+        events = [tracing.TraceEvent(**event) for event in response.pop('events')]
+        result = FleetResult(**dict(response, events=events))
+        result.output += stderr.decode("utf-8", "replace")  # e.g. avrdude, which writes straight to the terminal
+        return result
+
+    async def _flash_in_process(self, flash_job: FlashJob, serial_port: str) -> FleetResult:
+        # Frozen builds can't run "python -m", so flash in a worker process instead. A flash that has started can't be
+        # killed if this is cancelled (it is left to finish in the background), but one that is still queued is dropped.
+        if self._process_executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            import multiprocessing
+            # spawn (rather than fork) gives each worker a clean copy of esptool on every platform
+            self._process_executor = ProcessPoolExecutor(max_workers=self.max_flashes or MAX_FLASH_PROCESSES,
+                                                         mp_context=multiprocessing.get_context("spawn"))
+        return await asyncio.get_running_loop().run_in_executor(self._process_executor, flash_worker, flash_job,
+                                                                serial_port)
+
+    async def _run_stages(self, job: DeviceJob, result: DeviceJobResult):
+        firmware = await self._stage(result, "lookup", self.lookup(job))
+        result.firmware_id = firmware.id
+
+        # Neither of these depends on the other, so they run at the same time. Both are left to finish (even if one
+        # fails) so that the shared download is complete for any other jobs waiting on it.
+        outcomes = await asyncio.gather(self._stage(result, "verify", self.verify(firmware)),
+                                        self._stage(result, "download", self.download(firmware)),
+                                        return_exceptions=True)
+        for outcome in outcomes:
+            if isinstance(outcome, BaseException):
+                raise outcome
+
+        flash_job = build_flash_job(firmware, job.baud, job.erase_before_flash, job.incremental, job.merge_images)
+        if flash_job is None:
+            raise StageFailed("lookup", "invalid device family")
+
+        if self._flash_slots is None:
+            self._flash_slots = asyncio.Semaphore(self.max_flashes or sys.maxsize)
+        port_lock = self._port_locks.setdefault(job.serial_port, asyncio.Lock())
+        # Only one job can use a port at once, and waiting for a free slot/port isn't counted against any stage
+        async with port_lock, self._flash_slots:
+            serial_port = job.serial_port
+            if flash_job.use_1200_bps_touch:
+                serial_port = await self._stage(result, "touch", self.touch(serial_port))
+                flash_job = replace(flash_job, use_1200_bps_touch=False)  # Already done
+
+            flashed = await self._stage(result, "flash", self.flash(flash_job, serial_port))
+        result.output, result.events = flashed.output, flashed.events
+        for event in flashed.events:
+            tracing.get_tracer().record(event)
+        if not flashed.success:
+            raise StageFailed("flash", flashed.error or "flashing failed")
+
+    async def run_job(self, job: DeviceJob) -> DeviceJobResult:
+        """Runs job through every stage, returning how it went. This never raises - if a stage fails (or times out), the
+        result says which one and why. Cancelling this kills the job's flash (if it has started)."""
+        result = DeviceJobResult(serial_port=job.serial_port, firmware_id=job.firmware_id)
+        start = perf_counter()
+        try:
+            await self._run_stages(job, result)
+            result.success = True
+        except StageFailed as e:
+            result.failed_stage, result.error = e.stage, str(e)
+        except asyncio.CancelledError:
+            result.cancelled, result.error = True, "cancelled"
+            raise
+        except Exception as e:
+            result.error = str(e) or e.__class__.__name__
+        finally:
+            result.duration = perf_counter() - start
+        return result
+
+    async def run_jobs(self, jobs: List[DeviceJob]) -> List[DeviceJobResult]:
+        """Runs every job at the same time, returning their results in the same order. Cancelling this cancels all of
+        them."""
+        outcomes = await asyncio.gather(*[self.run_job(job) for job in jobs], return_exceptions=True)
+        return [outcome if isinstance(outcome, DeviceJobResult) else
+                DeviceJobResult(serial_port=job.serial_port, firmware_id=job.firmware_id, cancelled=True,
+                                error=str(outcome) or "cancelled")
+                for job, outcome in zip(jobs, outcomes)]
+
+
+def run_device_jobs(jobs: List[DeviceJob], **engine_options) -> List[DeviceJobResult]:
+    """Runs jobs on a new event loop (see FlashEngine.run_jobs), for callers that aren't already using asyncio"""
+    async def run_all():
+        async with FlashEngine(**engine_options) as engine:
+            return await engine.run_jobs(jobs)
+    return asyncio.run(run_all())
+
+
+def _flash_subprocess_main():
+    # Entry point for the subprocess that FlashEngine.flash runs. The job is read from stdin as JSON, and the result is
+    # written to stdout as JSON. Anything else that would have gone to stdout (e.g. from avrdude) goes to stderr.
+    result_stream = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    request = json.load(sys.stdin)
+    result = flash_worker(FlashJob(**request['job']), request['serial_port'])
+    json.dump(asdict(result), result_stream)
+    result_stream.close()
+
+
+if __name__ == "__main__":
+    _flash_subprocess_main()
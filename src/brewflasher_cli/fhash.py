@@ -1,4 +1,24 @@
+import atexit
 import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from .cache_dir import user_cache_dir, write_file_atomically
+
+
+# Files are hashed in blocks of this size. Larger reads mean fewer trips through Python per megabyte, which adds up
+# when hashing multi-megabyte SPIFFS images on SD card backed Raspberry Pis.
+HASH_BLOCK_SIZE = 1024 * 1024
+# Maximum number of hashes kept in the persisted memo (the oldest are dropped first)
+MAX_MEMO_ENTRIES = 512
+
+_memo = {}  # type: Dict[str, str]
+_memo_loaded = False
+_memo_dirty = False  # Set when the memo has changed since it was last saved (see save_memo)
+_memo_lock = threading.Lock()
 
 
 def hash_bytestr_iter(bytesiter, hasher, ashexstr=False):
@@ -15,6 +35,107 @@ def file_as_blockiter(afile, blocksize=65536):
             block = afile.read(blocksize)
 
 
+def _memo_path() -> str:
+    return os.path.join(user_cache_dir(), "hash_memo.json")
+
+
+def _memo_key(fname) -> str or None:
+    # A file is assumed to be unchanged if it is the same inode with the same size and modification time
+    try:
+        stat = os.stat(fname)
+    except OSError:
+        return None
+    return "{}|{}|{}|{}|{}".format(os.path.realpath(fname), stat.st_dev, stat.st_ino, stat.st_size,
+                                   stat.st_mtime_ns)
+
+
+def _load_memo():
+    # Must be called with _memo_lock held
+    global _memo_loaded
+    if _memo_loaded:
+        return
+    _memo_loaded = True
+    try:
+        with open(_memo_path(), "r") as f:
+            _memo.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+
+
+def _save_memo():
+    # Must be called with _memo_lock held
+    global _memo_dirty
+    while len(_memo) > MAX_MEMO_ENTRIES:
+        del _memo[next(iter(_memo))]
+    try:
+        write_file_atomically(_memo_path(), json.dumps(_memo).encode("utf-8"))
+    except OSError:
+        pass  # The memo is purely an optimization
+    _memo_dirty = False
+
+
+def save_memo():
+    """Writes out any hashes remembered since the memo was last saved. This is done once a batch of files has been
+    hashed (see hash_files), and when we exit - rather than for every file - as the whole memo is rewritten each time."""
+    with _memo_lock:
+        if _memo_dirty:
+            _save_memo()
+
+
+atexit.register(save_memo)  # For anything remembered since the last batch was saved
+
+
+def _remember(key, sha256_hexstr):
+    global _memo_dirty
+    with _memo_lock:
+        _load_memo()
+        _memo.pop(key, None)  # Move the entry to the end, so it is the last to be dropped
+        _memo[key] = sha256_hexstr
+        _memo_dirty = True
+
+
+def remember_hash(fname, sha256_hexstr):
+    """Records the sha256 of a file whose contents we already know the hash of (e.g. because we just wrote it)"""
+    key = _memo_key(fname)
+    if key is not None:
+        _remember(key, sha256_hexstr)
+
+
+def _hash_file_contents(fname) -> str:
+    hasher = hashlib.sha256()
+    block = bytearray(HASH_BLOCK_SIZE)
+    block_view = memoryview(block)
+    with open(fname, 'rb', buffering=0) as f:
+        # hashlib releases the GIL while hashing large blocks, so this can be run in parallel threads (see hash_files)
+        for bytes_read in iter(lambda: f.readinto(block), 0):
+            hasher.update(block_view[:bytes_read])
+    return hasher.hexdigest()
+
+
 # hash_of_file takes a file name, and returns the text sha256 hash of the file (for confirming file validity)
-def hash_of_file(fname):
-    return hash_bytestr_iter(file_as_blockiter(open(fname, 'rb')), hashlib.sha256(), True)
+def hash_of_file(fname, use_memo=True):
+    if not use_memo:
+        return _hash_file_contents(fname)
+
+    key = _memo_key(fname)
+    if key is not None:
+        with _memo_lock:
+            _load_memo()
+            if key in _memo:
+                return _memo[key]
+
+    sha256_hexstr = _hash_file_contents(fname)
+    if key is not None and key == _memo_key(fname):  # Don't memoize the hash if the file changed while we hashed it
+        _remember(key, sha256_hexstr)
+    return sha256_hexstr
+
+
+def hash_files(fnames: List[str], max_workers: int = 4, use_memo=True) -> Dict[str, str]:
+    """Hashes several files in parallel, returning a dict of file name -> sha256 hash"""
+    if len(fnames) <= 1:
+        hashes = {fname: hash_of_file(fname, use_memo) for fname in fnames}
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            hashes = dict(zip(fnames, executor.map(lambda fname: hash_of_file(fname, use_memo), fnames)))
+    save_memo()
+    return hashes
@@ -0,0 +1,357 @@
+import os
+import subprocess
+from dataclasses import dataclass, field, replace
+from time import monotonic, sleep
+from typing import List, Tuple
+
+from . import tracing
+from .baud_profile import ADAPTIVE_BAUD, BaudProfileStore, profile_key
+from .brewflasher_com_integration import Firmware
+from .incremental import plan_incremental_flash
+from .merged_image import merge_flash_regions
+from .serial_integration import comports, is_bootloader_port
+from .stk500 import AVR_PARTS, part_for_family, program_avr
+
+
+# write_flash options (and the address of the main firmware) for each ESP32-based device family
+ESP32_FLASH_OPTIONS = {
+    "ESP32": ["esp32", "0x10000"],
+    "ESP32-S2": ["esp32s2", "-z", "--flash_mode", "dio", "--flash_freq", "80m", "0x10000"],
+    "ESP32-C3": ["esp32c3", "-z", "--flash_mode", "dio", "--flash_freq", "80m", "0x10000"]
+}
+
+# The baud rate esptool writes at when it isn't given --baud
+ESPTOOL_DEFAULT_BAUD = "115200"
+
+# How often (in seconds) the serial ports are checked while waiting for a device to restart into its bootloader
+TOUCH_POLL_INTERVAL = 0.05
+# How long a device has to drop off the bus after a 1200bps touch. Boards whose USB connection doesn't restart (e.g.
+# those behind a USB to UART bridge) are flashed on the same port once this has passed. Boards with native USB drop
+# off within a few hundred milliseconds.
+TOUCH_DISCONNECT_TIMEOUT = 1.0
+# How long a device that has dropped off the bus has to come back (as its bootloader) before the touch has failed
+TOUCH_REENUMERATION_TIMEOUT = 10.0
+
+
+@dataclass
+class FlashJob:
+    """Everything needed to flash an already-downloaded firmware to a device
+
+    Unlike Firmware, this doesn't reference the rest of the catalog, so it is cheap to send to a worker process."""
+    flash_method: str
+    device_name: str
+    baud: str
+    erase_before_flash: bool
+    use_1200_bps_touch: bool = False
+    # If set, regions that already match the contents of the device's flash are skipped (esptool only)
+    incremental: bool = False
+    chip: str = ""
+    # The AVR microcontroller being flashed (a key of stk500.AVR_PARTS) - avrdude only
+    avr_part: str = ""
+    write_flash_options: List[str] = field(default_factory=list)
+    # (address, path) for each image to be written, in the order they are passed to esptool. avrdude only ever gets
+    # a single image, which has no address.
+    regions: List[Tuple[str, str]] = field(default_factory=list)
+
+
+def build_flash_job(firmware_obj: Firmware, baud: str, erase_before_flash: bool, incremental: bool = False,
+                    merge_images: bool = False) -> FlashJob or None:
+    """Works out what needs to be written where to flash firmware_obj. Returns None if the device family is invalid.
+
+    If merge_images is set (and the flash is being erased first), nearby regions are merged into a single image so
+    esptool only has to set up one write for them."""
+    family = firmware_obj.family
+    job = FlashJob(flash_method=family.flash_method, device_name=family.name, baud=str(baud),
+                   erase_before_flash=erase_before_flash, use_1200_bps_touch=family.use_1200_bps_touch,
+                   incremental=incremental)
+
+    if family.flash_method == "esptool":
+        # Construct the regions based on device family
+        if job.device_name in ESP32_FLASH_OPTIONS:
+            job.chip = ESP32_FLASH_OPTIONS[job.device_name][0]
+            job.write_flash_options = ESP32_FLASH_OPTIONS[job.device_name][1:-1]
+            job.regions.append((ESP32_FLASH_OPTIONS[job.device_name][-1], firmware_obj.full_filepath("firmware")))
+
+            if firmware_obj.download_url_partitions and firmware_obj.checksum_partitions:
+                job.regions.append(("0x8000", firmware_obj.full_filepath("partitions")))
+
+            if family.download_url_bootloader and family.checksum_bootloader:
+                boot_address = "0x0" if job.device_name == "ESP32-C3" else "0x1000"
+                job.regions.append((boot_address, firmware_obj.full_filepath("bootloader")))
+
+        elif job.device_name == "ESP8266":
+            job.chip = "esp8266"
+            job.regions.append(("0x00000", firmware_obj.full_filepath("firmware")))
+        else:
+            return None
+
+        # For both ESP32 and ESP8266 we can directly flash an image to SPIFFS/LittleFS/OTAData
+        if firmware_obj.download_url_spiffs and firmware_obj.checksum_spiffs and len(firmware_obj.spiffs_address) > 2:
+            job.regions.append((firmware_obj.spiffs_address, firmware_obj.full_filepath("spiffs")))
+
+        if family.download_url_otadata and family.checksum_otadata and len(family.otadata_address) > 2:
+            # We need to flash the otadata section. The location is dependent on the partition scheme
+            job.regions.append((family.otadata_address, firmware_obj.full_filepath("otadata")))
+
+        if merge_images and len(job.regions) > 1:
+            if erase_before_flash:
+                job.regions = merge_flash_regions(job.regions, job.chip)
+            else:
+                # The padding between merged regions would overwrite anything stored there (e.g. WiFi settings in NVS)
+                print("Firmware images are only merged when erasing flash first - writing them separately.")
+
+    elif family.flash_method == "avrdude":
+        job.avr_part = part_for_family(family).name
+        job.regions.append(("", firmware_obj.full_filepath("firmware")))
+
+    else:
+        raise ValueError("Invalid flash method detected. Update BrewFlasher and try again.")
+
+    return job
+
+
+def build_flash_command(job: FlashJob, serial_port: str) -> List[str]:
+    """Returns the esptool arguments (or the full avrdude command line) needed to flash job to serial_port"""
+    if job.flash_method == "esptool":
+        command = ["--port", serial_port, "--chip", job.chip]
+        if job.baud != ADAPTIVE_BAUD:
+            # Every chip is written at the rate that was asked for (or that run_flash_job_adaptively settled on).
+            # run_flash_job swaps ADAPTIVE_BAUD for a real rate before we get here, so it's only ever seen when a
+            # command is built to be shown rather than run - in which case esptool's default (115200bps) applies.
+            command.extend(["--baud", job.baud])
+        if job.device_name in ESP32_FLASH_OPTIONS:
+            command.extend(["--before", "default_reset", "--after", "hard_reset"])
+        command.append("write_flash")
+        command.extend(job.write_flash_options)
+        for address, path in job.regions:
+            command.extend([address, path])
+
+        if job.erase_before_flash:
+            command.extend(["--erase-all"])
+
+        # There is a breaking change in esptool 3.0 that changes the flash size from detect to keep. We want to
+        # support "detect" by default.
+        command.extend(["-fs", "detect"])
+        return command
+
+    elif job.flash_method == "avrdude":
+        part = AVR_PARTS[job.avr_part]
+        return [
+            "avrdude",
+            "-p", part.name,
+            "-c", part.programmer,
+            "-b", str(part.baud),
+            "-P", serial_port,
+            "-D",  # Disable auto erase - may want to make this configurable in the future
+            "-U", f"flash:w:{job.regions[0][1]}:i"
+        ]
+
+    raise ValueError("Invalid flash method detected. Update BrewFlasher and try again.")
+
+
+def describe_flash_command(job: FlashJob, command: List[str]) -> str:
+    if job.flash_method == "esptool":
+        return f"Esptool command: esptool.py {' '.join(command)}\n"
+    return "Avrdude command: avrdude %s\n" % " ".join(command)
+
+
+def uses_native_programmer(job: FlashJob) -> bool:
+    """Returns True if job is flashed using the built-in STK500 programmer (see stk500) rather than by running avrdude.
+    avrdude is only needed for parts whose bootloader doesn't speak STK500 (e.g. the Leonardo's)."""
+    return job.flash_method == "avrdude" and AVR_PARTS[job.avr_part].protocol != ""
+
+
+def _pick_bootloader_port(new_ports: list, original_vid: int or None, disconnected: bool) -> str or None:
+    # Several ports can show up at once (e.g. other devices being plugged in on a production line). The bootloader's
+    # own USB ids are the surest sign, then anything from the same manufacturer as the device we touched. Until the
+    # device has dropped off the bus, nothing else can be its bootloader.
+    for matches in (is_bootloader_port, lambda port: original_vid is not None and port.vid == original_vid):
+        for port in new_ports:
+            if matches(port):
+                return port.device
+    if disconnected and len(new_ports) > 0:
+        return new_ports[0].device
+    return None
+
+
+def wait_for_bootloader_port(serial_port: str, ports_before: dict,
+                             disconnect_timeout: float = TOUCH_DISCONNECT_TIMEOUT,
+                             reenumeration_timeout: float = TOUCH_REENUMERATION_TIMEOUT) -> str or None:
+    """Waits for the device on serial_port to restart into its bootloader, returning the port it is now on
+
+    ports_before maps the device name of each port that was present before the touch to its ListPortInfo. Returns
+    None if the device dropped off the bus but its bootloader never appeared."""
+    started_at = monotonic()
+    disconnected_at = None
+    original_vid = getattr(ports_before.get(serial_port), 'vid', None)
+    # Ports that showed up before the device dropped off the bus (and weren't its bootloader) belong to something else
+    unrelated_ports = set(ports_before)
+
+    while True:
+        ports = {port.device: port for port in comports()}
+        if serial_port not in ports and disconnected_at is None:
+            disconnected_at = monotonic()
+        new_ports = [port for device, port in ports.items() if device not in unrelated_ports]
+        bootloader_port = _pick_bootloader_port(new_ports, original_vid, disconnected_at is not None)
+        if bootloader_port is not None:
+            return bootloader_port
+        unrelated_ports.update(port.device for port in new_ports)
+
+        if serial_port not in ports:
+            if monotonic() - disconnected_at >= reenumeration_timeout:
+                return None
+        elif disconnected_at is not None:
+            return serial_port  # The bootloader came back under the same name
+        elif monotonic() - started_at >= disconnect_timeout:
+            return serial_port  # The device reset without dropping off the bus
+        sleep(TOUCH_POLL_INTERVAL)
+
+
+def perform_1200bps_touch(serial_port: str) -> str:
+    """Resets the device on serial_port into its bootloader, returning the port to flash it on
+
+    Boards with native USB (e.g. the Leonardo) drop off the bus and come back as their bootloader - often on a
+    different port - so rather than waiting a fixed time, this watches for the bootloader's port to appear."""
+    import serial
+    from serial import SerialException
+
+    try:
+        with tracing.phase("touch", serial_port=serial_port) as event:
+            print("Performing 1200 bps touch")
+            ports_before = {port.device: port for port in comports()}
+            with serial.Serial(serial_port, baudrate=1200, timeout=5, write_timeout=0) as ser:
+                ser.dtr = False  # Opening (and closing) the port at 1200bps is what triggers the reset
+            bootloader_port = wait_for_bootloader_port(serial_port, ports_before)
+            if bootloader_port is None:
+                raise SerialException(f"{serial_port} disconnected, but didn't come back in bootloader mode")
+            event.detail['bootloader_port'] = bootloader_port
+            if bootloader_port != serial_port:
+                print(f"...done - device restarted as {bootloader_port}\n")
+            else:
+                print("...done\n")
+            return bootloader_port
+    except SerialException as e:
+        print("\nUnable to perform 1200bps touch.")
+        print("Ensure correct serial port and try again or set device into 'flash' mode manually.")
+        print("Instructions: http://www.brewflasher.com/manualflash/")
+        raise e
+
+
+def print_flash_failure_help(job: FlashJob):
+    print("Firmware flashing FAILED. esptool.py raised an error.")
+    print("")
+    print("Try flashing again, or try flashing with a slower speed.")
+    print("")
+    if job.use_1200_bps_touch:
+        print("")
+        print("Alternatively, you may need to manually set the device into 'flash' mode.")
+        print("")
+        print("For instructions on how to do this, check this website:\nhttp://www.brewflasher.com/manualflash/")
+
+
+def execute_flash_job(job: FlashJob, serial_port: str):
+    """Runs esptool/avrdude (or the built-in STK500 programmer) for job, raising an exception if flashing fails"""
+    # Handle 1200 bps touch for certain devices. The device may come back on a different port, so the command is only
+    # built once we know where it is.
+    if job.use_1200_bps_touch:
+        serial_port = perform_1200bps_touch(serial_port)
+
+    if uses_native_programmer(job):
+        part = AVR_PARTS[job.avr_part]
+        with tracing.phase("flash", serial_port=serial_port, method=part.protocol, baud=str(part.baud)) as event:
+            event.bytes = program_avr(serial_port, part, job.regions[0][1])
+        return
+
+    command = build_flash_command(job, serial_port)
+    print(describe_flash_command(job, command))
+
+    with tracing.phase("flash", serial_port=serial_port, method=job.flash_method, baud=job.baud) as event:
+        event.bytes = sum(os.path.getsize(path) for _, path in job.regions if os.path.exists(path))
+        if job.flash_method == "esptool":
+            # esptool is slow to import, so it is only loaded once we are actually about to flash something
+            import esptool
+            esptool.main(command)
+        elif job.flash_method == "avrdude":
+            subprocess.run(command, check=True)
+
+
+def esptool_baud(job: FlashJob) -> str:
+    """Returns the baud rate that esptool writes job at - esptool's default, unless build_flash_command passes --baud"""
+    command = build_flash_command(job, "")
+    return command[command.index("--baud") + 1] if "--baud" in command else ESPTOOL_DEFAULT_BAUD
+
+
+def run_flash_job_adaptively(job: FlashJob, serial_port: str, profiles: BaudProfileStore = None) -> bool:
+    """Flashes job starting at the fastest baud rate known to work for this device, stepping down on failure"""
+    from serial import SerialException
+
+    profiles = profiles or BaudProfileStore()
+    key = profile_key(serial_port, job.chip)
+    rates = profiles.rates_to_try(key)
+
+    for attempt, rate in enumerate(rates):
+        try:
+            execute_flash_job(replace(job, baud=str(rate)), serial_port)
+        except SerialException as e:
+            sleep(0.1)
+            raise e
+        except Exception as e:
+            sleep(0.1)
+            message = (str(e).strip().splitlines() or [e.__class__.__name__])[0]
+            if "Failed to connect" in message:
+                # The initial sync always happens at 115200bps, so a slower rate won't help
+                print_flash_failure_help(job)
+                return False
+            profiles.record_failure(key, rate)
+            if attempt + 1 < len(rates):
+                print(f"\nFlashing at {rate}bps failed ({message}). Retrying at {rates[attempt + 1]}bps...\n")
+                continue
+            print_flash_failure_help(job)
+            return False
+
+        profiles.record_success(key, rate)
+        print("")
+        print(f"Firmware successfully flashed at {rate}bps. Reset device to switch back to normal boot mode.")
+        return True
+    return False
+
+
+def run_flash_job(job: FlashJob, serial_port: str) -> bool:
+    """Flashes job to serial_port using esptool or avrdude. Raises SerialException if the port can't be used."""
+    from serial import SerialException
+
+    adaptive = job.baud == ADAPTIVE_BAUD and job.flash_method == "esptool"
+
+    if job.incremental and job.flash_method == "esptool" and not job.erase_before_flash:
+        # Compare what's already on the device against what we're about to write, and only write what differs
+        print("Comparing the device's flash against the firmware...")
+        with tracing.phase("compare", serial_port=serial_port) as event:
+            plan = plan_incremental_flash(job.regions, serial_port, job.chip)
+            event.detail['bytes_skipped'] = plan.bytes_skipped
+            event.detail['regions_skipped'] = len(plan.skipped_regions)
+        print(plan.describe(BaudProfileStore().rates_to_try(profile_key(serial_port, job.chip))[0]
+                            if adaptive else esptool_baud(job)))
+        if len(plan.kept_regions) == 0:
+            print("")
+            print("The device already has this firmware - nothing to flash.")
+            return True
+        job = replace(job, regions=plan.kept_regions)
+
+    if adaptive:
+        return run_flash_job_adaptively(job, serial_port)
+
+    try:
+        execute_flash_job(job, serial_port)
+    except SerialException as e:
+        sleep(0.1)
+        raise e
+    except Exception as e:
+        sleep(0.1)
+        print_flash_failure_help(job)
+        return False
+
+    # The last line printed by esptool is "Staying in bootloader." -> some indication that the process is
+    # done is needed
+    print("")
+    print("Firmware successfully flashed. Reset device to switch back to normal boot mode.")
+    return True
@@ -0,0 +1,91 @@
+import contextlib
+import glob
+import io
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from fnmatch import fnmatch
+from time import perf_counter
+from typing import List
+
+from . import tracing
+from .flashing import FlashJob, run_flash_job
+from .serial_integration import comports
+
+
+@dataclass
+class FleetResult:
+    serial_port: str
+    success: bool = False
+    duration: float = 0.0
+    error: str = ""
+    # Everything esptool/avrdude printed while flashing this port
+    output: str = ""
+    # The phases timed while flashing this port (see tracing) - workers can't call the parent process's trace hooks
+    # directly, so these are passed back and replayed by collect_result
+    events: List[tracing.TraceEvent] = field(default_factory=list)
+
+
+def expand_serial_ports(port_specs: List[str]) -> List[str]:
+    """Expands a list of serial ports - which may be comma separated, or globs like /dev/ttyUSB* - into port names"""
+    available_ports = [p.device for p in comports()]
+    expanded_ports = []
+
+    for port_spec in port_specs:
+        for port_pattern in port_spec.split(","):
+            port_pattern = port_pattern.strip()
+            if len(port_pattern) == 0:
+                continue
+            if any(c in port_pattern for c in "*?["):
+                # Match against the device nodes on disk (for /dev/...) as well as the ports pyserial knows about
+                matches = sorted(set(glob.glob(port_pattern)) |
+                                 {port for port in available_ports if fnmatch(port, port_pattern)})
+            else:
+                matches = [port_pattern]
+            for port in matches:
+                if port not in expanded_ports:
+                    expanded_ports.append(port)
+    return expanded_ports
+
+
+def flash_worker(job: FlashJob, serial_port: str) -> FleetResult:
+    # This runs in a separate process per device, as esptool keeps global state that isn't safe to share between
+    # concurrent flashes. Output is captured (rather than printed) so that parallel flashes don't interleave.
+    result = FleetResult(serial_port=serial_port)
+    output = io.StringIO()
+    tracer = tracing.get_tracer()
+    first_event = len(tracer.events)  # Worker processes are reused, so skip anything recorded for a previous device
+    start = perf_counter()
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        try:
+            result.success = run_flash_job(job, serial_port)
+            if not result.success:
+                result.error = "Flashing failed"
+        except BaseException as e:  # esptool can raise SystemExit, which shouldn't take down the whole pool
+            result.error = str(e) or e.__class__.__name__
+    result.duration = perf_counter() - start
+    result.output = output.getvalue()
+    result.events = tracer.events[first_event:]
+    return result
+
+
+def collect_result(future: Future, serial_port: str) -> FleetResult:
+    """Returns the result of a flash_worker future, recording the phases it timed with this process's tracer"""
+    try:
+        result = future.result()
+    except Exception as e:  # e.g. the worker process died
+        return FleetResult(serial_port=serial_port, error=str(e) or e.__class__.__name__)
+    for event in result.events:
+        tracing.get_tracer().record(event)
+    return result
+
+
+def format_fleet_results(results: List[FleetResult]) -> str:
+    port_width = max([len("Port")] + [len(result.serial_port) for result in results])
+    lines = ["{:<{width}}  {:<6}  {:>8}  {}".format("Port", "Result", "Duration", "Error", width=port_width)]
+    for result in results:
+        lines.append("{:<{width}}  {:<6}  {:>7.1f}s  {}".format(result.serial_port,
+                                                             "OK" if result.success else "FAILED", result.duration,
+                                                             result.error, width=port_width))
+    succeeded = sum(1 for result in results if result.success)
+    lines.append("{} of {} devices flashed successfully".format(succeeded, len(results)))
+    return "\n".join(lines)
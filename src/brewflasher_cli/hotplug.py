@@ -0,0 +1,171 @@
+import multiprocessing
+import signal
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from time import monotonic, sleep
+from typing import Callable, List
+
+from .flashing import FlashJob
+from .fleet import FleetResult, collect_result, flash_worker
+from .serial_integration import comports, is_bootloader_port
+
+
+# How often (in seconds) the list of serial ports is polled for changes
+POLL_INTERVAL = 0.25
+# How long a new port has to be present before it is reported, which lets the device finish enumerating
+SETTLE_TIME = 0.5
+# How long a port has to be gone before it is treated as having been unplugged. Boards that briefly drop off the bus
+# when they reset (e.g. at the end of flashing) are not treated as new boards when they reappear.
+REMOVAL_TIME = 2.0
+# How long after a device has been flashed that it is ignored if it (re)appears. Boards reset with a 1200bps touch drop
+# off the bus for longer than REMOVAL_TIME while in their bootloader, and would otherwise be flashed again when the new
+# firmware starts.
+FLASH_COOLDOWN = 10.0
+
+
+def port_identity(port) -> tuple:
+    # Identifies the device on a port (a ListPortInfo from comports()), so it can be recognised if it comes back -
+    # possibly under a different name. Without a serial number, the best we can do is the port name and USB ids (and
+    # only identities like this start with the port name - see PortWatcher._forget_port).
+    if port.serial_number:
+        return port.vid, port.serial_number
+    return port.device, port.vid, port.pid
+
+
+class PortWatcher:
+    """Watches for serial ports being connected, debouncing the churn that happens while USB devices (re)enumerate"""
+
+    def __init__(self, port_filter: Callable = None, include_existing: bool = False,
+                 settle_time: float = SETTLE_TIME, removal_time: float = REMOVAL_TIME):
+        self.port_filter = port_filter
+        self.settle_time = settle_time
+        self.removal_time = removal_time
+        self._first_seen = {}  # Port name -> when it (last) appeared
+        self._last_seen = {}  # Port name -> when it was last seen
+        self._reported = set()
+        # Identities (see port_identity) of devices being flashed -> when they stop being ignored (or None while the
+        # flash is still running)
+        self._busy = {}
+
+        if not include_existing:
+            # Anything already connected when we start is treated as having been reported already
+            now = monotonic()
+            for port in comports():
+                self._first_seen[port.device] = now
+                self._last_seen[port.device] = now
+                self._reported.add(port.device)
+
+    def mark_busy(self, port):
+        """Ignores port (and the device on it, even if it comes back under another name) while it is being flashed"""
+        self._busy[port_identity(port)] = None
+
+    def mark_done(self, port, cooldown: float = FLASH_COOLDOWN):
+        """Keeps ignoring port for cooldown seconds after it has been flashed, while the new firmware starts up"""
+        self._busy[port_identity(port)] = monotonic() + cooldown
+
+    def _is_busy(self, port, now: float) -> bool:
+        key = port_identity(port)
+        if key not in self._busy:
+            return False
+        if self._busy[key] is None or now < self._busy[key]:
+            return True
+        del self._busy[key]
+        return False
+
+    def _forget_port(self, device: str):
+        # A device without a serial number is only identified by its port, so once that port has been unplugged, the
+        # next device plugged into it has to be treated as a different one - even if it's the same model (e.g. when
+        # boards are being swapped on a production line). Devices that are still being flashed are kept, as they can
+        # be gone for a while in their bootloader.
+        for key in [key for key, until in self._busy.items() if key[0] == device and until is not None]:
+            del self._busy[key]
+
+    def poll(self) -> List:
+        """Returns the ports (as ListPortInfo) that have newly arrived and settled since the last poll"""
+        now = monotonic()
+        arrivals = []
+
+        for port in comports():
+            self._last_seen[port.device] = now
+            self._first_seen.setdefault(port.device, now)
+            if self._is_busy(port, now):
+                # A device we're flashing (or just flashed) coming back. Treat it as reported, so that it isn't picked
+                # up as a new device once the cooldown ends.
+                self._reported.add(port.device)
+                continue
+            if port.device in self._reported or now - self._first_seen[port.device] < self.settle_time:
+                continue
+            if is_bootloader_port(port):
+                continue  # A device mid-flash (e.g. after a 1200bps touch) rather than one that was just plugged in
+            self._reported.add(port.device)
+            if self.port_filter is None or self.port_filter(port):
+                arrivals.append(port)
+
+        # Forget about ports that have been gone long enough that we can consider them unplugged
+        for device in list(self._last_seen):
+            if now - self._last_seen[device] >= self.removal_time:
+                del self._last_seen[device]
+                self._first_seen.pop(device, None)
+                self._reported.discard(device)
+                self._forget_port(device)
+            elif self._last_seen[device] != now:
+                # The port is missing, but hasn't been gone long enough to count. Restart its settle timer in case it
+                # is replaced by a different device.
+                self._first_seen[device] = now
+
+        return arrivals
+
+
+def _ignore_interrupts():
+    # Ctrl+C is sent to every process in the foreground process group. Workers ignore it so that devices that are
+    # mid-flash when the production line is stopped get to finish, rather than being left half-written.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _format_result(result: FleetResult) -> str:
+    timestamp = datetime.now().strftime("%H:%M:%S")
+    if result.success:
+        return "[{}] {}: flashed successfully in {:.1f}s".format(timestamp, result.serial_port, result.duration)
+    return "[{}] {}: FAILED after {:.1f}s ({})".format(timestamp, result.serial_port, result.duration, result.error)
+
+
+def run_production_line(job: FlashJob, port_filter: Callable = None, max_workers: int = 4,
+                        poll_interval: float = POLL_INTERVAL) -> List[FleetResult]:
+    """Flashes job to every matching device as soon as it is connected, until interrupted with Ctrl+C"""
+    watcher = PortWatcher(port_filter=port_filter)
+    results = []
+    in_flight = {}
+    started_at = monotonic()
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=_ignore_interrupts) as executor:
+        try:
+            while True:
+                for port in watcher.poll():
+                    print("[{}] {}: detected {}, flashing...".format(datetime.now().strftime("%H:%M:%S"),
+                                                                     port.device, port.description))
+                    watcher.mark_busy(port)
+                    in_flight[executor.submit(flash_worker, job, port.device)] = port
+
+                if len(in_flight) > 0:
+                    done, _ = wait(list(in_flight), timeout=poll_interval, return_when=FIRST_COMPLETED)
+                else:
+                    done = set()
+                    sleep(poll_interval)
+
+                for future in done:
+                    port = in_flight.pop(future)
+                    watcher.mark_done(port)
+                    result = collect_result(future, port.device)
+                    results.append(result)
+                    succeeded = sum(1 for r in results if r.success)
+                    per_hour = succeeded / ((monotonic() - started_at) / 3600)
+                    print("{} - {} flashed, {} failed ({:.0f} boards/hour)".format(
+                        _format_result(result), succeeded, len(results) - succeeded, per_hour))
+        except KeyboardInterrupt:
+            if len(in_flight) > 0:
+                print("\nStopping - waiting for {} device(s) that are still being flashed...".format(len(in_flight)))
+            for future, port in in_flight.items():
+                results.append(collect_result(future, port.device))
+
+    return results
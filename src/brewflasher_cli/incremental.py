@@ -0,0 +1,88 @@
+import hashlib
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import Callable, List, Tuple
+
+
+# Baud rate used to compare flash contents. Only digests are sent back, so there is no need to go any faster.
+COMPARE_BAUD = 115200
+
+
+@dataclass
+class IncrementalPlan:
+    # (address, path) pairs that need to be written, and those that already match what's on the device
+    kept_regions: List[Tuple[str, str]] = field(default_factory=list)
+    skipped_regions: List[Tuple[str, str]] = field(default_factory=list)
+    bytes_skipped: int = 0
+    compare_seconds: float = 0.0
+
+    def estimated_seconds_saved(self, baud) -> float:
+        # Serial links carry 10 bits per byte (start + 8 data + stop). Compression means that this overestimates the
+        # time for highly compressible images, but it's a reasonable upper bound.
+        return self.bytes_skipped * 10 / int(baud) - self.compare_seconds
+
+    def describe(self, baud) -> str:
+        if len(self.skipped_regions) == 0:
+            return "No regions on the device match the firmware - writing everything."
+        return "Skipping {} of {} regions that already match the device ({:.1f} MB, ~{:.0f}s saved)".format(
+            len(self.skipped_regions), len(self.skipped_regions) + len(self.kept_regions), self.bytes_skipped / 1e6,
+            max(self.estimated_seconds_saved(baud), 0))
+
+
+def local_region_md5(path: str) -> Tuple[str, int]:
+    """Returns the md5 (and length) of an image as esptool writes it - padded with 0xFF to a multiple of 4 bytes"""
+    with open(path, "rb") as f:
+        image = f.read()
+    image += b"\xff" * (-len(image) % 4)
+    return hashlib.md5(image).hexdigest(), len(image)
+
+
+def connect_to_chip(serial_port: str, chip: str):
+    """Connects to the ROM bootloader on serial_port and loads esptool's flasher stub (which can hash any region)"""
+    from esptool.cmds import detect_chip
+    esp = detect_chip(serial_port, COMPARE_BAUD)
+    if esp.CHIP_NAME.lower().replace("-", "") != chip:
+        raise ValueError("Expected {} but found {}".format(chip, esp.CHIP_NAME))
+    return esp.run_stub()
+
+
+def plan_incremental_flash(regions: List[Tuple[str, str]], serial_port: str, chip: str,
+                           connect: Callable = connect_to_chip) -> IncrementalPlan:
+    """Compares each region's local image against the device's flash, dropping any regions that already match
+
+    connect is called with (serial_port, chip) and must return a connected esptool ESPLoader (or something that
+    behaves like one). If we can't talk to the device, every region is kept."""
+    plan = IncrementalPlan()
+    start = perf_counter()
+
+    try:
+        esp = connect(serial_port, chip)
+    except Exception as e:
+        print("Unable to read the device's flash for incremental flashing ({}) - writing everything.".format(
+            (str(e).strip().splitlines() or [e.__class__.__name__])[0]))
+        plan.kept_regions = list(regions)
+        return plan
+
+    try:
+        for address, path in regions:
+            local_md5, length = local_region_md5(path)
+            try:
+                device_md5 = esp.flash_md5sum(int(address, 0), length)
+            except Exception:
+                device_md5 = None  # e.g. the region extends past the end of this device's flash
+            if device_md5 == local_md5:
+                plan.skipped_regions.append((address, path))
+                plan.bytes_skipped += length
+            else:
+                plan.kept_regions.append((address, path))
+    finally:
+        try:
+            # Leave the device as we found it, so that either esptool (or the user) can reset into the firmware
+            esp.hard_reset()
+        except Exception:
+            pass
+        if hasattr(esp, "_port"):
+            esp._port.close()
+
+    plan.compare_seconds = perf_counter() - start
+    return plan
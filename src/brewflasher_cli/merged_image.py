@@ -0,0 +1,74 @@
+import hashlib
+import os
+from typing import List, Tuple
+
+from . import fhash
+from .binary_cache import BinaryCache, get_binary_cache
+from .cache_dir import write_file_atomically
+
+
+# Regions separated by more than this are written separately rather than being merged, as esptool would otherwise
+# have to write (and the flash chip program) the padding between them. On a typical ESP32 this merges the
+# bootloader, partition table, otadata & app, while leaving a SPIFFS/LittleFS image at the end of flash separate.
+MAX_MERGE_GAP = 64 * 1024
+
+
+def merge_key(regions: List[Tuple[str, str]], chip: str) -> str:
+    # Identifies a merged image by what went into it, so it can be reused without merging again. The images are hashed
+    # in parallel (though usually they were hashed when downloaded, so this is just a lookup in the hash memo).
+    hashes = fhash.hash_files([path for _, path in regions])
+    parts = ["{}:{:#x}:{}".format(chip, int(address, 0), hashes[path]) for address, path in regions]
+    return hashlib.sha256("|".join(sorted(parts)).encode("utf-8")).hexdigest()
+
+
+def merge_regions(regions: List[Tuple[str, str]]) -> bytes:
+    """Merges (address, path) regions into a single image that starts at the lowest address, padded with 0xFF"""
+    merged = bytearray()
+    start = min(int(address, 0) for address, _ in regions)
+    for address, path in sorted(regions, key=lambda region: int(region[0], 0)):
+        offset = int(address, 0) - start
+        if offset < len(merged):
+            raise ValueError("Region at {} overlaps the previous region".format(address))
+        merged += b"\xff" * (offset - len(merged))
+        with open(path, "rb") as f:
+            merged += f.read()
+    merged += b"\xff" * (-len(merged) % 4)
+    return bytes(merged)
+
+
+def group_regions(regions: List[Tuple[str, str]], max_gap: int = MAX_MERGE_GAP) -> List[List[Tuple[str, str]]]:
+    # Splits regions (sorted by address) into groups where each region starts within max_gap of the previous one's end
+    groups = []
+    previous_end = None
+    for address, path in sorted(regions, key=lambda region: int(region[0], 0)):
+        length = os.path.getsize(path)
+        if previous_end is None or int(address, 0) - previous_end > max_gap:
+            groups.append([])
+        groups[-1].append((address, path))
+        previous_end = int(address, 0) + length
+    return groups
+
+
+def merge_flash_regions(regions: List[Tuple[str, str]], chip: str,
+                        cache: BinaryCache = None) -> List[Tuple[str, str]]:
+    """Returns regions with each group of nearby regions replaced by a single merged image
+
+    Merged images are kept in the binary cache, keyed by the checksums of the regions that went into them, so the
+    merge only happens once for a batch of devices. The padding between merged regions overwrites whatever was
+    there, so this should only be used when the flash is being erased anyway."""
+    cache = cache or get_binary_cache()
+    merged_regions = []
+
+    for group in group_regions(regions):
+        if len(group) == 1:
+            merged_regions.extend(group)
+            continue
+
+        cache_key = "merged-" + merge_key(group, chip)
+        merged_path = cache.path_for(cache_key)
+        if not os.path.isfile(merged_path):
+            write_file_atomically(merged_path, merge_regions(group))
+        cache.record_use(cache_key)
+        merged_regions.append((min((address for address, _ in group), key=lambda a: int(a, 0)), merged_path))
+
+    return merged_regions
@@ -0,0 +1,192 @@
+import json
+import os
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from time import time
+from typing import Dict, List, Tuple
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+from . import fhash
+from .binary_cache import is_cacheable
+from .cache_dir import write_file_atomically
+
+
+# A mirror is a directory laid out like brewflasher.com: each catalog endpoint is stored as index.json under the same
+# path as on brewflasher.com (e.g. api/project_list/all/index.json), with binaries stored by checksum under binaries/.
+# URLs in a mirrored catalog are relative to the mirror, so the directory can be copied (or served) from anywhere.
+MIRROR_INFO_FILE = "mirror.json"
+MIRROR_BINARY_DIR = "binaries"
+# Number of binaries downloaded at once when syncing a mirror
+DEFAULT_MIRROR_JOBS = 8
+
+# The URL (and checksum) fields of each type of catalog row that reference a binary
+FAMILY_BINARY_FIELDS = [("download_url_bootloader", "checksum_bootloader"), ("download_url_otadata", "checksum_otadata")]
+FIRMWARE_BINARY_FIELDS = [("download_url", "checksum"), ("download_url_partitions", "checksum_partitions"),
+                          ("download_url_spiffs", "checksum_spiffs")]
+
+
+def is_local_source(source: str) -> bool:
+    """Returns True if source (e.g. BREWFLASHER_COM_URL) is a directory on disk rather than a web server"""
+    return not source.startswith(("http://", "https://"))
+
+
+def local_path(source: str) -> str:
+    if source.startswith("file:"):
+        return url2pathname(urlparse(source).path)
+    return os.path.abspath(os.path.expanduser(source))
+
+
+def resolve_url(url: str, source: str) -> str:
+    """Returns url, made absolute (relative to source) if it is relative - as it is in a mirrored catalog"""
+    if len(url) == 0 or "://" in url:
+        return url
+    if is_local_source(source):
+        return pathlib.Path(local_path(source), *url.split("/")).as_uri()
+    return source.rstrip("/") + "/" + url
+
+
+def endpoint_file(directory: str, endpoint_path: str) -> str:
+    # e.g. "/api/project_list/all/" -> <directory>/api/project_list/all/index.json
+    return os.path.join(directory, *[p for p in endpoint_path.split("/") if p], "index.json")
+
+
+def read_endpoint(source: str, endpoint_path: str) -> list:
+    with open(endpoint_file(local_path(source), endpoint_path), "rb") as f:
+        return json.loads(f.read().decode("utf-8"))
+
+
+_mirror_info = {}  # type: Dict[Tuple[str, float], dict]
+
+
+def read_mirror_info(source: str) -> dict:
+    path = os.path.join(local_path(source), MIRROR_INFO_FILE)
+    key = (path, os.stat(path).st_mtime)
+    if key not in _mirror_info:
+        with open(path, "r") as f:
+            _mirror_info[key] = json.load(f)
+    return _mirror_info[key]
+
+
+def mirrored_checksum(source: str, firmware_id: int) -> str or None:
+    """Returns the checksum the mirror at source has for the given firmware (the local equivalent of flash_verify)"""
+    try:
+        return read_mirror_info(source)['checksums'].get(str(firmware_id))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+@dataclass
+class MirrorResult:
+    downloaded: int = 0
+    already_mirrored: int = 0
+    # Binaries without a checksum can't be stored by checksum (or checked), so they are left pointing at the source
+    without_checksum: int = 0
+    pruned: int = 0
+    failed: List[str] = field(default_factory=list)
+
+    def __str__(self):
+        summary = "{} file(s) downloaded, {} already mirrored".format(self.downloaded, self.already_mirrored)
+        if self.without_checksum > 0:
+            summary += ", {} without a checksum skipped".format(self.without_checksum)
+        if self.pruned > 0:
+            summary += ", {} no longer needed removed".format(self.pruned)
+        if len(self.failed) > 0:
+            summary += ", {} FAILED".format(len(self.failed))
+        return summary
+
+
+def _mirror_binaries(rows: List[dict], url_fields: List[Tuple[str, str]], source: str,
+                     binaries: Dict[str, str]) -> int:
+    # Points each binary referenced by rows at its (checksum named) copy in the mirror, adding it to binaries
+    # (checksum -> source URL) so that it gets downloaded. Returns the number of binaries without a (usable) checksum,
+    # which are left pointing at the source - the checksum becomes a filename, so it can't be anything but a checksum.
+    without_checksum = 0
+    for row in rows:
+        for url_field, checksum_field in url_fields:
+            url, checksum = row.get(url_field) or "", (row.get(checksum_field) or "").lower()
+            if len(url) == 0:
+                continue
+            if not is_cacheable(checksum) or checksum.startswith("merged-"):
+                row[url_field] = resolve_url(url, source)
+                without_checksum += 1
+                continue
+            binaries.setdefault(checksum, resolve_url(url, source))
+            row[url_field] = MIRROR_BINARY_DIR + "/" + checksum + ".bin"
+    return without_checksum
+
+
+def sync_mirror(directory: str, source: str, max_workers: int = DEFAULT_MIRROR_JOBS,
+                prune: bool = False) -> MirrorResult:
+    """Copies the catalog at source, along with every binary it references, into directory
+
+    Binaries that are already in the mirror (and match their checksum) aren't downloaded again. The catalog is only
+    written once every binary has been downloaded, so a failed sync leaves the previous copy of the mirror usable."""
+    from .brewflasher_com_integration import CATALOG_ENDPOINTS, DownloadProgress, Firmware
+
+    result = MirrorResult()
+    if is_local_source(source):
+        catalog = {endpoint: read_endpoint(source, path) for endpoint, path in CATALOG_ENDPOINTS.items()}
+    else:
+        from . import transport
+        with ThreadPoolExecutor(max_workers=len(CATALOG_ENDPOINTS)) as executor:
+            futures = {endpoint: executor.submit(transport.get_json, source + path)
+                       for endpoint, path in CATALOG_ENDPOINTS.items()}
+        catalog = {endpoint: future.result() for endpoint, future in futures.items()}
+
+    binaries = {}  # type: Dict[str, str]
+    result.without_checksum += _mirror_binaries(catalog['families'], FAMILY_BINARY_FIELDS, source, binaries)
+    result.without_checksum += _mirror_binaries(catalog['firmware'], FIRMWARE_BINARY_FIELDS, source, binaries)
+
+    binary_dir = os.path.join(directory, MIRROR_BINARY_DIR)
+    os.makedirs(binary_dir, exist_ok=True)
+    # Binaries already in the mirror are rehashed (in parallel) to check they are intact before being kept
+    existing = [os.path.join(binary_dir, checksum + ".bin") for checksum in binaries]
+    existing_hashes = fhash.hash_files([path for path in existing if os.path.isfile(path)], max_workers=max_workers)
+    to_download = {}
+    for (checksum, url), path in zip(binaries.items(), existing):
+        if existing_hashes.get(path) == checksum:
+            result.already_mirrored += 1
+        else:
+            to_download[checksum] = url
+
+    progress = DownloadProgress()
+    progress.start()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            checksum: executor.submit(Firmware.download_file, os.path.join(binary_dir, checksum + ".bin"), url,
+                                      checksum, True, True, progress=progress.add)
+            for checksum, url in to_download.items()
+        }
+    progress.stop()
+    fhash.save_memo()  # Once for every binary, rather than as each one finishes
+    for checksum, future in futures.items():
+        try:
+            downloaded = future.result()
+        except Exception:
+            downloaded = False
+        if downloaded:
+            result.downloaded += 1
+        else:
+            result.failed.append(to_download[checksum])
+    if len(result.failed) > 0:
+        return result
+
+    for endpoint, path in CATALOG_ENDPOINTS.items():
+        os.makedirs(os.path.dirname(endpoint_file(directory, path)), exist_ok=True)
+        write_file_atomically(endpoint_file(directory, path), json.dumps(catalog[endpoint]).encode("utf-8"))
+    mirror_info = {
+        'source': source,
+        'synced_at': time(),
+        # Used to answer pre_flash_web_verify without brewflasher.com
+        'checksums': {str(row['id']): row['checksum'] for row in catalog['firmware']},
+    }
+    write_file_atomically(os.path.join(directory, MIRROR_INFO_FILE), json.dumps(mirror_info).encode("utf-8"))
+
+    if prune:
+        for filename in os.listdir(binary_dir):
+            if filename.endswith(".bin") and filename[:-4] not in binaries:
+                os.remove(os.path.join(binary_dir, filename))
+                result.pruned += 1
+    return result
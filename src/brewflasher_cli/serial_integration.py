@@ -1,5 +1,3 @@
-import serial.tools.list_ports
-
 known_devices = {
     'arduino': [
         # Those with 'generic': False are virtually guaranteed to be Arduinos
@@ -25,18 +23,48 @@ known_devices = {
     ],
     'esp8266': [
         {'vid': 0x1D50, 'pid': 0x607D, 'name': "Generic CP2104 USB-Serial Chip", 'generic': True},
+        {'vid': 0x10C4, 'pid': 0xEA60, 'name': "Generic CP210x USB-Serial Chip", 'generic': True},
+        {'vid': 0x1a86, 'pid': 0x7523, 'name': "Generic CH340 USB-Serial Chip", 'generic': True},
+        {'vid': 0x1a86, 'pid': 0x55D4, 'name': "Generic CH9102 USB-Serial Chip", 'generic': True},
+        {'vid': 0x0403, 'pid': 0x6001, 'name': "Generic FTDI USB-Serial Chip", 'generic': True},
     ],
     'esp32': [
         {'vid': 0x1D50, 'pid': 0x607D, 'name': "Generic CP2104 USB-Serial Chip", 'generic': True},
+        {'vid': 0x10C4, 'pid': 0xEA60, 'name': "Generic CP210x USB-Serial Chip", 'generic': True},
+        {'vid': 0x1a86, 'pid': 0x7523, 'name': "Generic CH340 USB-Serial Chip", 'generic': True},
+        {'vid': 0x1a86, 'pid': 0x55D4, 'name': "Generic CH9102 USB-Serial Chip", 'generic': True},
+        {'vid': 0x0403, 'pid': 0x6001, 'name': "Generic FTDI USB-Serial Chip", 'generic': True},
     ],
     'esp32s2': [
         {'vid': 0x1D50, 'pid': 0x607D, 'name': "Generic CP2104 USB-Serial Chip", 'generic': True},
+        {'vid': 0x10C4, 'pid': 0xEA60, 'name': "Generic CP210x USB-Serial Chip", 'generic': True},
+        {'vid': 0x1a86, 'pid': 0x7523, 'name': "Generic CH340 USB-Serial Chip", 'generic': True},
+        {'vid': 0x1a86, 'pid': 0x55D4, 'name': "Generic CH9102 USB-Serial Chip", 'generic': True},
+        {'vid': 0x303A, 'pid': 0x0002, 'name': "ESP32-S2 Native USB", 'generic': False},
     ],
     'esp32c3': [
         {'vid': 0x1D50, 'pid': 0x607D, 'name': "Generic CP2104 USB-Serial Chip", 'generic': True},
+        {'vid': 0x10C4, 'pid': 0xEA60, 'name': "Generic CP210x USB-Serial Chip", 'generic': True},
+        {'vid': 0x1a86, 'pid': 0x7523, 'name': "Generic CH340 USB-Serial Chip", 'generic': True},
+        {'vid': 0x1a86, 'pid': 0x55D4, 'name': "Generic CH9102 USB-Serial Chip", 'generic': True},
+        {'vid': 0x303A, 'pid': 0x1001, 'name': "ESP32-C3 USB-Serial/JTAG", 'generic': False},
     ]
 }
 
+
+def build_known_devices_index(devices):
+    # Indexes devices (in the same format as known_devices) by (vid, pid). Each entry is a list of (family, device)
+    # pairs - one for each family the device appears under, using the first matching entry as a linear scan would.
+    index = {}
+    for family, device_list in devices.items():
+        for this_device in device_list:
+            matches = index.setdefault((this_device['vid'], this_device['pid']), [])
+            if not any(family == existing_family for existing_family, _ in matches):
+                matches.append((family, this_device))
+    return index
+
+known_devices_by_id = build_known_devices_index(known_devices)
+
 DEVICE_CACHE = []
 
 def check_known_devices(family, pid, vid, return_bool=False):
@@ -48,10 +76,8 @@ def check_known_devices(family, pid, vid, return_bool=False):
         else:
             return unknown_device
 
-    device_list = known_devices[family]
-
-    for this_device in device_list:
-        if this_device['vid'] == vid and this_device['pid'] == pid:
+    for device_family, this_device in known_devices_by_id.get((vid, pid), []):
+        if device_family == family:
             if return_bool:
                 return True
             else:
@@ -62,14 +88,41 @@ def check_known_devices(family, pid, vid, return_bool=False):
     else:
         return unknown_device
 
+def families_for_device(vid, pid, include_generic=True):
+    # Returns the names of every family that a device with the given vid/pid could belong to
+    return [family for family, this_device in known_devices_by_id.get((vid, pid), [])
+            if include_generic or not this_device['generic']]
+
+def is_candidate_port(port, family) -> bool:
+    # Returns True if the port (a ListPortInfo from comports()) could be a device of the given detection family
+    if port.vid is None:
+        return False  # Not a USB device (e.g. a built-in UART), so it can't be something that was just plugged in
+    known_device = check_known_devices(family, port.pid, port.vid)
+    if "Bootloader" in known_device['name']:
+        return False  # The device is mid-flash (e.g. after a 1200bps touch) rather than newly connected
+    if family not in known_devices:
+        return True  # We don't know what this family looks like, so we can't rule anything out
+    return known_device['name'] != "Unknown"
+
+def is_bootloader_port(port) -> bool:
+    # Returns True if the port (a ListPortInfo from comports()) is a device that is sitting in its bootloader, e.g. a
+    # Leonardo after a 1200bps touch (which re-enumerates with a different pid)
+    return any("Bootloader" in this_device['name']
+               for _, this_device in known_devices_by_id.get((port.vid, port.pid), []))
+
+def comports() -> list:
+    # pyserial is imported here (rather than at the top of the file) so it isn't loaded unless we need a serial port
+    import serial.tools.list_ports
+    return list(serial.tools.list_ports.comports())
+
 def cache_current_devices():
     global DEVICE_CACHE
-    ports = list(serial.tools.list_ports.comports())
+    ports = comports()
     DEVICE_CACHE = [p.device for p in ports]
     return DEVICE_CACHE
 
 def compare_current_devices_against_cache(family="arduino"):
-    ports = list(serial.tools.list_ports.comports())
+    ports = comports()
 
     # We read current_devices the same as above
     current_devices = [p.device for p in ports]
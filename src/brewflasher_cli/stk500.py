@@ -0,0 +1,323 @@
+import threading
+from dataclasses import dataclass
+from functools import reduce
+from time import sleep
+from typing import Callable, Dict, List, Tuple
+
+from .brewflasher_com_integration import DeviceFamily
+
+
+STK500V1 = "stk500v1"  # Optiboot & the older ATmegaBOOT (Uno, Nano, Pro Mini, etc.)
+STK500V2 = "stk500v2"  # stk500boot (Mega)
+
+# How long (in seconds) to wait for the bootloader to answer each command once in sync
+RESPONSE_TIMEOUT = 1.0
+# While trying to get in sync, each attempt waits this long for an answer. The bootloader only waits about a second
+# after a reset before starting the existing firmware, so several short attempts work better than a few long ones.
+SYNC_TIMEOUT = 0.2
+SYNC_ATTEMPTS = 10
+
+
+@dataclass(frozen=True)
+class AvrPart:
+    """The AVR microcontroller used by a device family, and how to program it through its bootloader"""
+    name: str  # As passed to avrdude using -p
+    signature: bytes
+    flash_size: int
+    page_size: int
+    # The protocol spoken by the part's usual bootloader, or "" if it can only be flashed using avrdude (e.g. the
+    # Leonardo's Caterina bootloader, which speaks AVR109)
+    protocol: str
+    programmer: str  # As passed to avrdude using -c
+    baud: int
+
+
+AVR_PARTS = {
+    "atmega328p": AvrPart("atmega328p", b"\x1e\x95\x0f", 32 * 1024, 128, STK500V1, "arduino", 115200),
+    "atmega168": AvrPart("atmega168", b"\x1e\x94\x06", 16 * 1024, 128, STK500V1, "arduino", 19200),
+    "atmega1280": AvrPart("atmega1280", b"\x1e\x97\x03", 128 * 1024, 256, STK500V2, "wiring", 57600),
+    "atmega2560": AvrPart("atmega2560", b"\x1e\x98\x01", 256 * 1024, 256, STK500V2, "wiring", 115200),
+    "atmega32u4": AvrPart("atmega32u4", b"\x1e\x95\x87", 32 * 1024, 128, "", "avr109", 57600),
+}
+# Every Arduino device family on BrewFlasher.com used to be flashed as an atmega328p, so that is what any family that
+# isn't listed in DEVICE_FAMILY_PARTS still gets
+DEFAULT_AVR_PART = "atmega328p"
+DEVICE_FAMILY_PARTS = {
+    "Arduino Mega": "atmega2560",
+    "Arduino Mega2560": "atmega2560",
+    "Arduino Mega 2560": "atmega2560",
+    "Arduino Mega1280": "atmega1280",
+    "Arduino Leonardo": "atmega32u4",
+    "Arduino Diecimila": "atmega168",
+}
+
+
+def part_for_family(family: DeviceFamily) -> AvrPart:
+    return AVR_PARTS[DEVICE_FAMILY_PARTS.get(family.name, DEFAULT_AVR_PART)]
+
+
+class ProgrammerError(Exception):
+    pass
+
+
+def parse_intel_hex(text: str) -> List[Tuple[int, bytes]]:
+    """Returns the (address, data) segments of an Intel HEX file, in address order with adjacent segments joined.
+    Raises ValueError if the file is invalid."""
+    segments = []  # type: List[Tuple[int, bytearray]]
+    base_address = 0
+
+    for line_number, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        try:
+            if not line.startswith(":"):
+                raise ValueError
+            record = bytes.fromhex(line[1:])
+        except ValueError:
+            raise ValueError("Invalid Intel HEX record on line {}".format(line_number)) from None
+        if len(record) < 5 or len(record) != record[0] + 5:
+            raise ValueError("Invalid Intel HEX record length on line {}".format(line_number))
+        if sum(record) & 0xff != 0:
+            raise ValueError("Invalid Intel HEX checksum on line {}".format(line_number))
+
+        record_type, data = record[3], record[4:-1]
+        if record_type == 0x00:
+            address = base_address + (record[1] << 8 | record[2])
+            if len(segments) > 0 and segments[-1][0] + len(segments[-1][1]) == address:
+                segments[-1][1].extend(data)
+            else:
+                segments.append((address, bytearray(data)))
+        elif record_type == 0x01:
+            break
+        elif record_type == 0x02:  # Extended segment address
+            base_address = int.from_bytes(data, "big") << 4
+        elif record_type == 0x04:  # Extended linear address
+            base_address = int.from_bytes(data, "big") << 16
+        # Anything else (start addresses) doesn't matter when writing to flash
+
+    segments.sort(key=lambda segment: segment[0])
+    joined = []  # type: List[Tuple[int, bytearray]]
+    for address, data in segments:
+        if len(joined) > 0 and joined[-1][0] + len(joined[-1][1]) >= address:
+            start = address - joined[-1][0]
+            joined[-1][1][start:start + len(data)] = data
+        else:
+            joined.append((address, data))
+    return [(address, bytes(data)) for address, data in joined]
+
+
+def read_intel_hex(path: str) -> List[Tuple[int, bytes]]:
+    with open(path, "r") as f:
+        return parse_intel_hex(f.read())
+
+
+def split_into_pages(segments: List[Tuple[int, bytes]], page_size: int) -> List[Tuple[int, bytes]]:
+    """Returns (address, data) for each flash page that segments write to, with anything not written padded with 0xFF"""
+    pages = {}  # type: Dict[int, bytearray]
+    for address, data in segments:
+        offset = 0
+        while offset < len(data):
+            page_address = (address + offset) // page_size * page_size
+            page = pages.setdefault(page_address, bytearray(b"\xff" * page_size))
+            start = address + offset - page_address
+            chunk = data[offset:offset + page_size - start]
+            page[start:start + len(chunk)] = chunk
+            offset += len(chunk)
+    return [(address, bytes(pages[address])) for address in sorted(pages)]
+
+
+class Stk500v1:
+    """Talks to an STK500v1 (Optiboot) bootloader"""
+    GET_SYNC, ENTER_PROGMODE, LEAVE_PROGMODE = 0x30, 0x50, 0x51
+    LOAD_ADDRESS, PROG_PAGE, READ_PAGE, READ_SIGN = 0x55, 0x64, 0x74, 0x75
+    CRC_EOP, INSYNC, NOSYNC, OK = 0x20, 0x14, 0x15, 0x10
+
+    def __init__(self, port, part: AvrPart):
+        self.port = port
+        self.part = part
+
+    def command(self, request: bytes, response_length: int = 0) -> bytes:
+        self.port.write(request + bytes([self.CRC_EOP]))
+        if self.port.read(1) != bytes([self.INSYNC]):
+            raise ProgrammerError("The bootloader stopped responding (command 0x{:02x})".format(request[0]))
+        response = self.port.read(response_length)
+        if len(response) != response_length or self.port.read(1) != bytes([self.OK]):
+            raise ProgrammerError("The bootloader rejected command 0x{:02x}".format(request[0]))
+        return response
+
+    def connect(self) -> bool:
+        self.port.reset_input_buffer()
+        self.port.write(bytes([self.GET_SYNC, self.CRC_EOP]))
+        return self.port.read(2) == bytes([self.INSYNC, self.OK])
+
+    def read_signature(self) -> bytes:
+        return self.command(bytes([self.READ_SIGN]), 3)
+
+    def enter_progmode(self):
+        self.command(bytes([self.ENTER_PROGMODE]))
+
+    def leave_progmode(self):
+        self.command(bytes([self.LEAVE_PROGMODE]))
+
+    def _load_address(self, address: int):
+        word_address = address // 2
+        self.command(bytes([self.LOAD_ADDRESS, word_address & 0xff, word_address >> 8]))
+
+    def write_page(self, address: int, data: bytes):
+        self._load_address(address)
+        self.command(bytes([self.PROG_PAGE, len(data) >> 8, len(data) & 0xff, ord("F")]) + data)
+
+    def read_page(self, address: int, length: int) -> bytes:
+        self._load_address(address)
+        return self.command(bytes([self.READ_PAGE, length >> 8, length & 0xff, ord("F")]), length)
+
+
+class Stk500v2:
+    """Talks to an STK500v2 (stk500boot) bootloader"""
+    SIGN_ON, LOAD_ADDRESS, ENTER_PROGMODE, LEAVE_PROGMODE = 0x01, 0x06, 0x10, 0x11
+    PROGRAM_FLASH, READ_FLASH, SPI_MULTI = 0x13, 0x14, 0x1d
+    MESSAGE_START, TOKEN, STATUS_CMD_OK = 0x1b, 0x0e, 0x00
+
+    def __init__(self, port, part: AvrPart):
+        self.port = port
+        self.part = part
+        self._sequence = 0
+
+    def command(self, body: bytes) -> bytes:
+        """Sends body as a message, returning the body of the bootloader's answer (after checking it succeeded)"""
+        self._sequence = (self._sequence + 1) & 0xff
+        message = bytes([self.MESSAGE_START, self._sequence, len(body) >> 8, len(body) & 0xff, self.TOKEN]) + body
+        self.port.write(message + bytes([reduce(lambda a, b: a ^ b, message)]))
+
+        header = self.port.read(5)
+        if len(header) != 5 or header[0] != self.MESSAGE_START or header[4] != self.TOKEN:
+            raise ProgrammerError("The bootloader stopped responding (command 0x{:02x})".format(body[0]))
+        answer = self.port.read((header[2] << 8 | header[3]) + 1)
+        if len(answer) != (header[2] << 8 | header[3]) + 1 or reduce(lambda a, b: a ^ b, header + answer) != 0 or \
+                header[1] != self._sequence:
+            raise ProgrammerError("Garbled answer from the bootloader (command 0x{:02x})".format(body[0]))
+        if len(answer) < 3 or answer[0] != body[0] or answer[1] != self.STATUS_CMD_OK:
+            raise ProgrammerError("The bootloader rejected command 0x{:02x}".format(body[0]))
+        return answer[:-1]
+
+    def connect(self) -> bool:
+        self.port.reset_input_buffer()
+        try:
+            self.command(bytes([self.SIGN_ON]))
+        except ProgrammerError:
+            return False
+        return True
+
+    def read_signature(self) -> bytes:
+        # The bootloader answers the ISP "read signature byte" instruction, as the chip itself would over SPI
+        return bytes(self.command(bytes([self.SPI_MULTI, 4, 4, 0, 0x30, 0x00, index, 0x00]))[5] for index in range(3))
+
+    def enter_progmode(self):
+        # The ISP timing parameters are ignored by the bootloader, but are sent as avrdude would
+        self.command(bytes([self.ENTER_PROGMODE, 200, 100, 25, 32, 0, 0x53, 3, 0xac, 0x53, 0x00, 0x00]))
+
+    def leave_progmode(self):
+        self.command(bytes([self.LEAVE_PROGMODE, 1, 1]))
+
+    def _load_address(self, address: int):
+        word_address = address // 2
+        if self.part.flash_size > 128 * 1024:
+            word_address |= 0x80000000  # Tells the bootloader to use extended addressing
+        self.command(bytes([self.LOAD_ADDRESS]) + word_address.to_bytes(4, "big"))
+
+    def write_page(self, address: int, data: bytes):
+        self._load_address(address)
+        self.command(bytes([self.PROGRAM_FLASH, len(data) >> 8, len(data) & 0xff, 0xc1, 10, 0x40, 0x4c, 0x20, 0x00,
+                            0x00]) + data)
+
+    def read_page(self, address: int, length: int) -> bytes:
+        self._load_address(address)
+        return self.command(bytes([self.READ_FLASH, length >> 8, length & 0xff, 0x20]))[2:2 + length]
+
+
+PROTOCOLS = {STK500V1: Stk500v1, STK500V2: Stk500v2}
+
+
+def reset_into_bootloader(port):
+    # Arduino boards are reset by pulling DTR/RTS low, after which the bootloader runs for a short time before starting
+    # the existing firmware. Ports without modem control lines (e.g. pseudo-terminals) can't be reset this way.
+    try:
+        port.dtr, port.rts = False, False
+        sleep(0.25)
+        port.dtr, port.rts = True, True
+        sleep(0.05)
+    except OSError:
+        pass
+
+
+class _ProgressPrinter:
+    # Prints the progress of writing (or verifying) the flash in steps of 25%, so that it is readable when captured
+    STEP = 25
+
+    def __init__(self, action: str, total: int, log: Callable[[str], None]):
+        self.action = action
+        self.total = total
+        self.log = log
+        self._reported = -1
+
+    def update(self, done: int):
+        percent = done * 100 // self.total if self.total > 0 else 100
+        if percent // self.STEP > self._reported:
+            self._reported = percent // self.STEP
+            self.log("{} {:d}%".format(self.action, self._reported * self.STEP))
+
+
+def program_avr(serial_port: str, part: AvrPart, hex_path: str, verify: bool = True,
+                log: Callable[[str], None] = print, cancelled: threading.Event = None) -> int:
+    """Writes the Intel HEX file at hex_path to the flash of the part on serial_port through its bootloader, returning
+    the number of bytes written. Raises ProgrammerError if flashing fails (or cancelled gets set), or SerialException
+    if the port can't be opened.
+
+    Messages (including progress) are passed to log, so that several devices can be flashed at once on different
+    threads without their output being mixed up."""
+    import serial
+
+    if part.protocol not in PROTOCOLS:
+        raise ProgrammerError("The {} can only be flashed using avrdude".format(part.name))
+    pages = split_into_pages(read_intel_hex(hex_path), part.page_size)
+    if len(pages) > 0 and pages[-1][0] + part.page_size > part.flash_size:
+        raise ProgrammerError("The firmware is too large for the {}".format(part.name))
+
+    with serial.Serial(serial_port, baudrate=part.baud, timeout=SYNC_TIMEOUT, write_timeout=RESPONSE_TIMEOUT) as port:
+        bootloader = PROTOCOLS[part.protocol](port, part)
+        reset_into_bootloader(port)
+        if not any(bootloader.connect() for _ in range(SYNC_ATTEMPTS)):
+            raise ProgrammerError("Unable to communicate with the bootloader on {}".format(serial_port))
+        port.timeout = RESPONSE_TIMEOUT
+
+        signature = bootloader.read_signature()
+        if signature != part.signature:
+            raise ProgrammerError("The device's signature ({}) isn't that of the {} ({}) - check the device family "
+                                  "selected".format(signature.hex(), part.name, part.signature.hex()))
+        log("Connected to the {} bootloader ({})".format(part.name, part.protocol))
+        bootloader.enter_progmode()
+
+        progress = _ProgressPrinter("Writing", len(pages), log)
+        for index, (address, data) in enumerate(pages):
+            if cancelled is not None and cancelled.is_set():
+                raise ProgrammerError("Cancelled")
+            progress.update(index)
+            bootloader.write_page(address, data)
+        progress.update(len(pages))
+
+        if verify:
+            progress = _ProgressPrinter("Verifying", len(pages), log)
+            for index, (address, data) in enumerate(pages):
+                if cancelled is not None and cancelled.is_set():
+                    raise ProgrammerError("Cancelled")
+                progress.update(index)
+                if bootloader.read_page(address, len(data)) != data:
+                    raise ProgrammerError("Verification failed - the flash at 0x{:05x} doesn't match the "
+                                          "firmware".format(address))
+            progress.update(len(pages))
+
+        bootloader.leave_progmode()  # Starts the new firmware
+    bytes_written = len(pages) * part.page_size
+    log("{} bytes of flash written{}".format(bytes_written, " and verified" if verify else ""))
+    return bytes_written
@@ -0,0 +1,148 @@
+import contextlib
+import json
+import threading
+from dataclasses import asdict, dataclass, field
+from time import perf_counter, time
+from typing import Callable, List
+
+
+@dataclass
+class TraceEvent:
+    """How long one phase of a flash run (e.g. downloading one part of the firmware) took"""
+    phase: str
+    part: str = ""
+    serial_port: str = ""
+    started_at: float = 0.0  # Unix timestamp
+    duration: float = 0.0  # Seconds
+    bytes: int = 0
+    success: bool = True
+    detail: dict = field(default_factory=dict)
+
+    @property
+    def throughput(self) -> float or None:
+        # Bytes per second, or None if this phase didn't (successfully) transfer anything
+        if self.bytes <= 0 or self.duration <= 0 or not self.success:
+            return None
+        return self.bytes / self.duration
+
+    def to_dict(self) -> dict:
+        event = asdict(self)
+        event['throughput'] = self.throughput
+        return event
+
+
+class Tracer:
+    """Collects a TraceEvent for each phase of a run, and passes each one to the registered hooks as it completes
+
+    Hooks are called with the TraceEvent from whichever thread completed the phase, and should return quickly."""
+
+    def __init__(self):
+        self.events = []  # type: List[TraceEvent]
+        self.started_at = perf_counter()
+        self._hooks = []  # type: List[Callable[[TraceEvent], None]]
+        self._lock = threading.Lock()
+
+    def register_hook(self, hook: Callable[[TraceEvent], None]):
+        with self._lock:
+            self._hooks.append(hook)
+
+    def unregister_hook(self, hook: Callable[[TraceEvent], None]):
+        with self._lock:
+            self._hooks.remove(hook)
+
+    def record(self, event: TraceEvent):
+        with self._lock:
+            self.events.append(event)
+            hooks = list(self._hooks)
+        for hook in hooks:
+            try:
+                hook(event)
+            except Exception:
+                pass  # A broken hook (e.g. a dashboard that can't be reached) shouldn't interrupt flashing
+
+    @contextlib.contextmanager
+    def phase(self, name: str, part: str = "", serial_port: str = "", **detail):
+        """Times the enclosed block, recording it as a TraceEvent. The event is yielded so that bytes, success and
+        detail can be filled in as the phase runs. The phase is marked as failed if the block raises."""
+        event = TraceEvent(phase=name, part=part, serial_port=serial_port, started_at=time(), detail=detail)
+        start = perf_counter()
+        try:
+            yield event
+        except BaseException:
+            event.success = False
+            raise
+        finally:
+            event.duration = perf_counter() - start
+            self.record(event)
+
+    def elapsed(self) -> float:
+        return perf_counter() - self.started_at
+
+
+class JsonLinesWriter:
+    """Tracer hook that writes each event to a file as a line of JSON"""
+
+    def __init__(self, path: str):
+        self._file = open(path, "w")
+        self._lock = threading.Lock()
+
+    def __call__(self, event: TraceEvent):
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(json.dumps(event.to_dict()) + "\n")
+                self._file.flush()  # So that the trace can be followed (e.g. using tail -f) while flashing
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def _format_bytes(num_bytes: int) -> str:
+    if num_bytes <= 0:
+        return ""
+    if num_bytes < 1024 * 1024:
+        return "{:.1f} KB".format(num_bytes / 1024)
+    return "{:.1f} MB".format(num_bytes / (1024 * 1024))
+
+
+def format_profile(events: List[TraceEvent], elapsed: float = None) -> str:
+    """Summarizes events as a table of the total time, bytes and throughput of each phase and part"""
+    totals = {}
+    for event in events:
+        total = totals.setdefault((event.phase, event.part), TraceEvent(phase=event.phase, part=event.part,
+                                                                        detail={'count': 0, 'failed': 0}))
+        total.duration += event.duration
+        total.bytes += event.bytes
+        total.success = total.success and event.success  # Throughput isn't shown if any of the attempts failed
+        total.detail['count'] += 1
+        total.detail['failed'] += 0 if event.success else 1
+
+    part_width = max([len("Part")] + [len(part) for _, part in totals])
+    lines = ["{:<10} {:<{width}} {:>5} {:>6} {:>9} {:>10} {:>12}".format(
+        "Phase", "Part", "Count", "Failed", "Time", "Bytes", "Throughput", width=part_width)]
+    for total in totals.values():
+        throughput = "{}/s".format(_format_bytes(int(total.throughput))) if total.throughput else ""
+        lines.append("{:<10} {:<{width}} {:>5} {:>6} {:>8.2f}s {:>10} {:>12}".format(
+            total.phase, total.part, total.detail['count'], total.detail['failed'] or "", total.duration,
+            _format_bytes(total.bytes), throughput, width=part_width))
+    if elapsed is not None:
+        # Phases can overlap (e.g. parts are downloaded in parallel), so this can be less than the sum of the above
+        lines.append("Total run time: {:.2f}s".format(elapsed))
+    return "\n".join(lines)
+
+
+_default_tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    return _default_tracer
+
+
+def phase(name: str, part: str = "", serial_port: str = "", **detail):
+    """Times the enclosed block using the default tracer (see Tracer.phase)"""
+    return _default_tracer.phase(name, part, serial_port, **detail)
+
+
+def register_hook(hook: Callable[[TraceEvent], None]):
+    """Has hook called with each TraceEvent as it is recorded (e.g. to feed timings into a dashboard)"""
+    _default_tracer.register_hook(hook)
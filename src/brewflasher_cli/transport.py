@@ -0,0 +1,191 @@
+import hashlib
+import threading
+from time import sleep
+from typing import TYPE_CHECKING
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+# requests takes a noticeable amount of time to import on low-powered devices, so it is only imported once something
+# actually needs the network (e.g. not for --help, or when the catalog is served from the cache)
+if TYPE_CHECKING:
+    import requests
+    from urllib3.util.retry import Retry
+
+
+# (connect, read) timeouts, in seconds, applied to every request made through the shared session
+REQUEST_TIMEOUT = (10, 30)
+# (connect, read) timeouts for requests made in the background (e.g. refreshing a stale catalog), which aren't retried
+BACKGROUND_REQUEST_TIMEOUT = (3, 10)
+# Number of times a failed request is retried (with exponential backoff) before giving up
+MAX_RETRIES = 4
+BACKOFF_FACTOR = 0.5
+# Status codes that are worth retrying - everything else is returned to the caller as-is
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Maximum number of keep-alive connections held open per host
+POOL_SIZE = 8
+
+# Firmware binaries are streamed from brewflasher.com in chunks of this size. requests defaults to 1 byte per chunk
+# when iter_content() is called without a size, which is painfully slow on low-powered devices like the Raspberry Pi.
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _build_retry() -> "Retry":
+    from urllib3.util.retry import Retry
+
+    retry_options = {
+        'total': MAX_RETRIES,
+        'backoff_factor': BACKOFF_FACTOR,
+        'status_forcelist': RETRY_STATUS_CODES,
+        'raise_on_status': False,
+    }
+    # flash_verify is a POST, but it doesn't change anything on the server so it is safe to retry
+    try:
+        return Retry(allowed_methods=frozenset(["HEAD", "GET", "POST"]), **retry_options)
+    except TypeError:  # urllib3 < 1.26
+        return Retry(method_whitelist=frozenset(["HEAD", "GET", "POST"]), **retry_options)
+
+
+def get_session() -> "requests.Session":
+    """Returns the pooled session shared by every request made to brewflasher.com (created on first use)"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=_build_retry())
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+    return _session
+
+
+def get_json(url: str, **kwargs):
+    response = get_session().get(url, timeout=REQUEST_TIMEOUT, **kwargs)
+    response.raise_for_status()
+    return response.json()
+
+
+def post_json(url: str, payload: dict, **kwargs):
+    response = get_session().post(url, json=payload, timeout=REQUEST_TIMEOUT, **kwargs)
+    response.raise_for_status()
+    return response.json()
+
+
+def _range_start(response: "requests.Response") -> int or None:
+    # Parses the first byte position out of a "Content-Range: bytes 1000-1999/2000" header
+    content_range = response.headers.get("Content-Range", "")
+    try:
+        return int(content_range.split(" ", 1)[1].split("-", 1)[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def download(url: str, fileobj, chunk_size: int = DOWNLOAD_CHUNK_SIZE, max_resumes: int = MAX_RETRIES,
+             progress=None) -> str:
+    """Streams url into fileobj, returning the sha256 hex digest of everything written.
+
+    If provided, progress is called with the size of each chunk as it is received. If the connection drops partway
+    through the transfer, the download is resumed from where it left off using an HTTP Range request. Servers that
+    don't honor the Range header cause the download to restart from the beginning, in which case progress is called
+    with minus the number of bytes received so far (so that the total reported matches what is actually kept).
+    """
+    if url.startswith("file:"):
+        # e.g. a binary in a mirror on a local disk (see mirror.py)
+        return _copy_local_file(url2pathname(urlparse(url).path), fileobj, chunk_size, progress)
+
+    import requests
+
+    hasher = hashlib.sha256()
+    received = 0
+    attempt = 0
+
+    while True:
+        # Ask for the raw bytes so that Range offsets line up with what we've written to disk
+        headers = {'Accept-Encoding': "identity"}
+        if received > 0:
+            headers['Range'] = "bytes={}-".format(received)
+
+        try:
+            with get_session().get(url, stream=True, headers=headers, timeout=REQUEST_TIMEOUT) as r:
+                if received > 0 and (r.status_code != 206 or _range_start(r) != received):
+                    # The server can't (or won't) pick up where we left off - start over from scratch
+                    fileobj.seek(0)
+                    fileobj.truncate()
+                    hasher = hashlib.sha256()
+                    if progress is not None:
+                        progress(-received)
+                    received = 0
+                    if r.status_code == 416:
+                        continue
+                r.raise_for_status()
+
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    fileobj.write(chunk)
+                    hasher.update(chunk)
+                    received += len(chunk)
+                    if progress is not None:
+                        progress(len(chunk))
+            return hasher.hexdigest()
+        except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
+            attempt += 1
+            if attempt > max_resumes:
+                raise
+            sleep(BACKOFF_FACTOR * (2 ** (attempt - 1)))
+
+
+def download_errors(url: str) -> tuple:
+    """Returns the exceptions download() raises if url can't be downloaded (only importing requests if url needs it)"""
+    if url.startswith("file:"):
+        return (OSError,)
+    import requests
+    return (requests.RequestException, OSError)
+
+
+def _copy_local_file(path: str, fileobj, chunk_size: int, progress=None) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            fileobj.write(chunk)
+            hasher.update(chunk)
+            if progress is not None:
+                progress(len(chunk))
+    return hasher.hexdigest()
+
+
+def get_conditional(url: str, etag: str = "", last_modified: str = "", stream: bool = False,
+                    background: bool = False) -> "requests.Response":
+    """GETs url, asking the server to reply 304 Not Modified if it still matches etag/last_modified
+
+    If stream is set, the body is left to be read using iter_content() (and the response should then be closed). If
+    background is set, a single attempt is made with BACKGROUND_REQUEST_TIMEOUT, rather than retrying."""
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    if background:
+        import requests
+        # Made outside of the shared session, as its adapters retry with backoff
+        response = requests.get(url, headers=headers, timeout=BACKGROUND_REQUEST_TIMEOUT, stream=stream)
+    else:
+        response = get_session().get(url, headers=headers, timeout=REQUEST_TIMEOUT, stream=stream)
+    if response.status_code != 304:
+        try:
+            response.raise_for_status()
+        except Exception:
+            response.close()
+            raise
+    return response
+
+
+def get_to_file(url: str, fileobj, chunk_size: int = DOWNLOAD_CHUNK_SIZE):
+    """Streams the (decompressed) body of url into fileobj, without holding all of it in memory at once"""
+    with get_conditional(url, stream=True) as response:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            fileobj.write(chunk)
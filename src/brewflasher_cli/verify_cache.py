@@ -0,0 +1,56 @@
+import json
+import os
+import threading
+from time import time
+
+from .cache_dir import user_cache_dir, write_file_atomically
+
+
+# How long (in seconds) a successful flash_verify is trusted before brewflasher.com is asked again. This is kept short,
+# as the point of verifying is to catch firmware that has been pulled or replaced since the catalog was loaded.
+DEFAULT_VERIFY_MAX_AGE = 5 * 60
+
+
+def verify_key(source: str, firmware_id: int, checksum: str) -> str:
+    return "{}|{}|{}".format(source, firmware_id, checksum.lower())
+
+
+class VerifyCache:
+    """Remembers which (firmware, checksum) pairs brewflasher.com has recently confirmed, so that flashing the same
+    firmware to a run of devices (e.g. from a script that calls brewflasher once per device) only verifies it once"""
+
+    def __init__(self, path: str = None):
+        self.path = path or os.path.join(user_cache_dir(), "verified_firmware.json")
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def is_verified(self, key: str, max_age: float = DEFAULT_VERIFY_MAX_AGE) -> bool:
+        verified_at = self._load().get(key)
+        return verified_at is not None and 0 <= time() - verified_at <= max_age
+
+    def record_verified(self, key: str, max_age: float = DEFAULT_VERIFY_MAX_AGE):
+        with self._lock:
+            now = time()
+            # Expired entries are dropped as we go, so the file never grows past the firmware verified recently
+            verified = {k: t for k, t in self._load().items() if 0 <= now - t <= max_age}
+            verified[key] = now
+            try:
+                write_file_atomically(self.path, json.dumps(verified).encode("utf-8"))
+            except OSError:
+                pass  # We'll just verify again next time
+
+
+_default_cache = None
+
+
+def get_verify_cache() -> VerifyCache:
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = VerifyCache()
+    return _default_cache